@@ -4,8 +4,13 @@
 import os
 
 from flask import Flask, current_app
+from . import access
+from . import catalogue
 from . import config
 from . import db
+from . import people
+from . import querystats
+from .log import get_log
 from .version import version
 
 # project codename: Digital Research Alliance eXperience
@@ -40,6 +45,15 @@ def create_app(test_config=None):
   # TODO: this needs mergeconf v0.4
   #app.config.from_mapping(conf)
   app.config['DATABASE_URI'] = conf['DATABASE_URI']
+  app.config['DATABASE_POOL_SIZE'] = conf['DATABASE_POOL_SIZE']
+  app.config['DATABASE_POOL_TIMEOUT'] = conf['DATABASE_POOL_TIMEOUT']
+  app.config['DATABASE_POOL_MAX_LIFETIME'] = conf['DATABASE_POOL_MAX_LIFETIME']
+  app.config['DATABASE_POOL_CHECK_IDLE'] = conf['DATABASE_POOL_CHECK_IDLE']
+  app.config['DATABASE_REPLICA_URIS'] = conf['DATABASE_REPLICA_URIS']
+  app.config['DATABASE_REPLICA_RETRY'] = conf['DATABASE_REPLICA_RETRY']
+  app.config['DATABASE_QUERY_STATS'] = conf['DATABASE_QUERY_STATS']
+  app.config['DATABASE_SLOW_QUERY_MS'] = conf['DATABASE_SLOW_QUERY_MS']
+  app.config['SQLITE_PROFILE'] = conf['SQLITE_PROFILE']
   app.config['RESOURCE_URI'] = conf['RESOURCE_URI']
   app.config['LOGIN_URI'] = conf['LOGIN_URI']
   app.config['LOGOUT_URI'] = conf['LOGOUT_URI']
@@ -48,6 +62,26 @@ def create_app(test_config=None):
   app.config['LDAP_PASSWORD'] = conf['LDAP_PASSWORD']
   app.config['LDAP_SKIP_TLS'] = conf['LDAP_SKIP_TLS']
   app.config['LDAP_TLS_REQCERT'] = conf['LDAP_TLS_REQCERT']
+  app.config['LDAP_TIMEOUT'] = conf['LDAP_TIMEOUT']
+  app.config['LDAP_NETWORK_TIMEOUT'] = conf['LDAP_NETWORK_TIMEOUT']
+  app.config['LDAP_CALL_TIMEOUT'] = conf['LDAP_CALL_TIMEOUT']
+  app.config['LDAP_BREAKER_THRESHOLD'] = conf['LDAP_BREAKER_THRESHOLD']
+  app.config['LDAP_BREAKER_RESET'] = conf['LDAP_BREAKER_RESET']
+  app.config['LDAP_POOL_SIZE'] = conf['LDAP_POOL_SIZE']
+  app.config['LDAP_POOL_TIMEOUT'] = conf['LDAP_POOL_TIMEOUT']
+  app.config['LDAP_POOL_MAX_LIFETIME'] = conf['LDAP_POOL_MAX_LIFETIME']
+  app.config['LDAP_POOL_MAX_IDLE'] = conf['LDAP_POOL_MAX_IDLE']
+  app.config['LDAP_PEOPLE_BASE'] = conf['LDAP_PEOPLE_BASE']
+  app.config['LDAP_SYNC_INTERVAL'] = conf['LDAP_SYNC_INTERVAL']
+  app.config['LDAP_SYNC_ACTIVE_DAYS'] = conf['LDAP_SYNC_ACTIVE_DAYS']
+  app.config['LDAP_SYNC_PAGE_SIZE'] = conf['LDAP_SYNC_PAGE_SIZE']
+  app.config['LDAP_SYNC_MAX_AGE'] = conf['LDAP_SYNC_MAX_AGE']
+  app.config['LDAP_CACHE_SIZE'] = conf['LDAP_CACHE_SIZE']
+  app.config['LDAP_CACHE_TTL'] = conf['LDAP_CACHE_TTL']
+  app.config['LDAP_CACHE_NEGATIVE_TTL'] = conf['LDAP_CACHE_NEGATIVE_TTL']
+  app.config['ACCESS_STATS'] = conf['ACCESS_STATS']
+  app.config['ACCESS_REOPTIMIZE_INTERVAL'] = conf['ACCESS_REOPTIMIZE_INTERVAL']
+  app.config['ACCESS_FILTER'] = conf['ACCESS_FILTER']
 
   # load test config, if given
   if test_config:
@@ -61,20 +95,52 @@ def create_app(test_config=None):
 
   init_app(app)
 
+  # time database queries
+  if app.config['DATABASE_QUERY_STATS']:
+    slow = app.config['DATABASE_SLOW_QUERY_MS']
+    querystats.enable_query_stats(slow_threshold=slow / 1000 if slow else None)
+
+  # keep directory attributes of active people synced in the background
+  people.init_sync_scheduler(app)
+
+  # count predicate evaluations to inform ordering of access evaluation
+  if app.config['ACCESS_STATS']:
+    access.enable_access_stats()
+
+  # compile access strings up front so requests don't have to parse them; the
+  # database may not be initialized yet (such as for `init-db`)
+  with app.app_context():
+    try:
+      catalogue.warm_access_cache()
+    # pylint: disable=broad-except
+    except Exception as e:
+      get_log().warning("Could not compile catalogue access strings: %s", e)
+
   from . import dashboard
   app.register_blueprint(dashboard.bp)
 
   from . import auth
   app.register_blueprint(auth.bp)
 
+  from . import status
+  app.register_blueprint(status.bp)
+
   # make custom variables available to all templates
   app.context_processor(inject_custom_vars)
 
   return app
 
 def init_app(app):
+  from . import ldap
   app.teardown_appcontext(db.close_db)
+  app.teardown_appcontext(ldap.close_ldap)
   #app.teardown_appcontext(log.close_log)
   app.cli.add_command(db.init_db_command)
   app.cli.add_command(db.seed_db_command)
   app.cli.add_command(db.upgrade_db_command)
+  app.cli.add_command(db.explain_statements_command)
+  app.cli.add_command(catalogue.refresh_access_rules_command)
+  app.cli.add_command(catalogue.export_catalogue_command)
+  app.cli.add_command(catalogue.import_catalogue_command)
+  app.cli.add_command(catalogue.sync_catalogue_command)
+  app.cli.add_command(people.sync_people_command)
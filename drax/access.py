@@ -1,5 +1,5 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
-# pylint:
+# pylint: disable=global-statement
 #
 """
 Provides a class for evaluating access rights based on LDAP-like conditions.
@@ -26,16 +26,204 @@ The AND and OR nodes are evaluated based on how their children evaluate: an AND
 node evaluates its children left-to-right and returns False on the first False,
 otherwise True; an OR node evaluates to True on the first child that evaluates
 True and False if none do.
+
+Since the same access strings are evaluated over and over (once per service
+per dashboard view), the parse tree can also be compiled into a flat closure
+which does no further interpretation of the tree.  The compile_access()
+function does this and keeps the results in a bounded LRU cache keyed on the
+access string, so each string is parsed only once while it remains in use.
+
+Access rights are evaluated in the form of a Rights object, which maps each
+attribute to a frozenset of its values so that predicates are exact-match,
+constant-time lookups regardless of how many entitlements a user has.  Plain
+dictionaries such as those stored in the session are converted on the way in.
+
+To determine which of a large number of access strings a user satisfies, the
+AccessIndex class maps each (key, value) predicate to the access strings
+referencing it.  As there is no negation, an access string can only be
+satisfied if at least one of its predicates is, so only the access strings
+reachable from the user's own rights need be evaluated at all.
+
+Before compilation the children of AND and OR nodes are reordered so that
+evaluation short-circuits as early and cheaply as possible: under AND, cheap
+children likely to be false come first; under OR, cheap children likely to be
+true.  Without further information predicates are assumed equally likely to
+be true or false, so cheaper children (predicates before subtrees) come first.
+If predicate statistics are enabled, compiled access strings count how often
+each predicate is evaluated and how often it passes, and the observed pass
+rates are used in place of the assumption the next time access strings are
+compiled (see reoptimize_access(), and catalogue.reoptimize_catalogues() which
+also rebuilds the catalogues' access indexes).
+
+For filtering in the database, an access string can also be normalized into
+disjunctive normal form: a list of clauses, each a set of (key, value)
+predicates which must all hold, any one clause sufficing.
 """
 # TODO: needs to be tested for proper syntax evaluation
 # Because who knows what sorts of nonsense people will enter for access strings
 
+import functools
+import hashlib
 import re
+import sys
+from drax.exceptions import AccessSyntaxError
 
-basetok_re = re.compile('^(\\(|\\)|\\||&|[^\\)]+)')
+# tokens are single-character operators and parentheses, or predicates which
+# run up to the next closing parenthesis
+tok_re = re.compile('[()|&]|[^\\)]+')
 predtok_re = re.compile('^(?P<key>\\w+)(?P<op>=)(?P<value>[^\\)]*)$')
 valid_ops = ['=']
 
+# maximum number of compiled access strings to keep around
+ACCESS_CACHE_SIZE = 1024
+
+# assumed probability a predicate is true, when there are no statistics, and
+# number of evaluations of a predicate before its statistics are used instead
+DEFAULT_PROBABILITY = 0.5
+MIN_SAMPLES = 20
+
+# predicate statistics, if enabled
+_stats = None
+
+# maximum number of clauses in disjunctive normal form before giving up, since
+# conversion of an AND of ORs can grow exponentially
+MAX_DNF_CLAUSES = 64
+
+_empty = frozenset()
+
+class Rights:
+  """
+  Normalized representation of a user's access rights.  Built from a dict of
+  attribute names to lists of values (as retrieved from LDAP and stored in the
+  session); a single string value is treated as a one-element list rather
+  than something to be substring-matched.  Values are held in frozensets of
+  interned strings so that checking for a given value is O(1).
+  """
+
+  __slots__ = ('_attrs', '_fingerprint')
+
+  def __init__(self, kv=None):
+    attrs = {}
+    if kv:
+      for (key, values) in kv.items():
+        if isinstance(values, (str, bytes)):
+          values = (values,)
+        attrs[sys.intern(key)] = frozenset(
+          sys.intern(v.decode('utf8') if isinstance(v, bytes) else v)
+          for v in values
+        )
+    self._attrs = attrs
+    self._fingerprint = None
+
+  @classmethod
+  def of(cls, kv):
+    """
+    Return `kv` as a Rights object, converting it if necessary.
+    """
+    if isinstance(kv, cls):
+      return kv
+    return cls(kv)
+
+  def __contains__(self, key):
+    return key in self._attrs
+
+  def __getitem__(self, key):
+    return self._attrs[key]
+
+  def __iter__(self):
+    return iter(self._attrs)
+
+  def __len__(self):
+    return len(self._attrs)
+
+  def __repr__(self):
+    return f"Rights({self.to_dict()!r})"
+
+  def get(self, key, default=_empty):
+    return self._attrs.get(key, default)
+
+  def has(self, key, value):
+    """
+    Whether the attribute `key` has the value `value`.
+    """
+    return value in self._attrs.get(key, _empty)
+
+  def items(self):
+    return self._attrs.items()
+
+  def predicates(self):
+    """
+    Generate (key, value) tuples for every value held.
+    """
+    for (key, values) in self._attrs.items():
+      for value in values:
+        yield (key, value)
+
+  def fingerprint(self):
+    """
+    Return a stable digest of the rights, the same for any two Rights objects
+    holding the same values (regardless of order or duplication in the
+    input), across processes.
+    """
+    if self._fingerprint is None:
+      digest = hashlib.sha256()
+      for key in sorted(self._attrs):
+        values = self._attrs[key]
+        if not values:
+          continue
+        digest.update(key.encode('utf8'))
+        for value in sorted(values):
+          digest.update(b'\0' + value.encode('utf8'))
+        digest.update(b'\1')
+      self._fingerprint = digest.hexdigest()
+    return self._fingerprint
+
+  def to_dict(self):
+    """
+    Return rights as a serializable dict of sorted lists, suitable for storing
+    in the session.
+    """
+    return {key: sorted(values) for (key, values) in self._attrs.items()}
+
+class PredicateStats:
+  """
+  Counts of evaluations and passes for each predicate (key, value) evaluated
+  by compiled access strings.  Counting is not synchronized so under
+  concurrent use the counts are approximate, which suffices for ordering.
+  """
+
+  def __init__(self):
+    self._counts = {}
+
+  def counter(self, key, value):
+    """
+    Return the [evaluations, passes] counter for the given predicate.
+    """
+    return self._counts.setdefault((key, value), [0, 0])
+
+  def probability(self, key, value):
+    """
+    Return observed probability of the given predicate being true, or the
+    default if there are not enough observations.
+    """
+    (evaluations, passes) = self._counts.get((key, value), (0, 0))
+    if evaluations < MIN_SAMPLES:
+      return DEFAULT_PROBABILITY
+    return passes / evaluations
+
+  def report(self):
+    """
+    Report total evaluations and per-predicate counts.
+    """
+    predicates = {
+      f'{key}={value}': {'evaluations': counts[0], 'passes': counts[1]}
+      for ((key, value), counts) in self._counts.items()
+    }
+    return {
+      'evaluations': sum(counts[0] for counts in self._counts.values()),
+      'predicates': predicates
+    }
+
 class Evaluator:
 
   class Node:
@@ -43,7 +231,37 @@ class Evaluator:
     def __init__(self):
       pass
 
-    def evaluate(self, kv):
+    def evaluate(self, rights):
+      raise NotImplementedError
+
+    def compile(self, stats=None):
+      """
+      Return a function of one argument, a Rights object, which evaluates the
+      same as this node.  If `stats` is given the function counts predicate
+      evaluations there.
+      """
+      raise NotImplementedError
+
+    def optimize(self, stats=None):
+      """
+      Reorder subtree for cheapest evaluation, using observed probabilities
+      from `stats` if given.  Returns expected cost of evaluating the subtree
+      (in predicate evaluations) and probability of it being true.
+      """
+      raise NotImplementedError
+
+    def predicates(self):
+      """
+      Generate (key, value) tuples for all predicates in this subtree.
+      """
+      raise NotImplementedError
+
+    def dnf(self, limit):
+      """
+      Return subtree in disjunctive normal form, as a list of frozensets of
+      (key, value) tuples, or None if that would need more than `limit`
+      clauses.
+      """
       raise NotImplementedError
 
   class Predicate(Node):
@@ -55,13 +273,41 @@ class Evaluator:
       self._op = op
       self._value = value
 
-    def evaluate(self, kv):
+    def evaluate(self, rights):
       if self._op == '=':
-        #return kv[self._key] == self._value
         # TODO: generalize with a specifiable comparison function
-        return self._key in kv and self._value in kv[self._key]
+        return self._value in rights.get(self._key)
       raise NotImplementedError(f"Comparison operator '{self._op}' not supported")
 
+    def compile(self, stats=None):
+      if self._op != '=':
+        raise NotImplementedError(f"Comparison operator '{self._op}' not supported")
+
+      key = sys.intern(self._key)
+      value = sys.intern(self._value)
+      if stats is None:
+        return lambda rights: value in rights.get(key)
+
+      counts = stats.counter(key, value)
+      def _counted(rights):
+        counts[0] += 1
+        if value in rights.get(key):
+          counts[1] += 1
+          return True
+        return False
+      return _counted
+
+    def optimize(self, stats=None):
+      if stats is None:
+        return (1, DEFAULT_PROBABILITY)
+      return (1, stats.probability(self._key, self._value))
+
+    def predicates(self):
+      yield (self._key, self._value)
+
+    def dnf(self, limit):
+      return [frozenset([(self._key, self._value)])]
+
   # pylint: disable=abstract-method
   class Decision(Node):
 
@@ -72,33 +318,139 @@ class Evaluator:
     def add(self, node):
       self._children.append(node)
 
+    def _compile_children(self, stats):
+      return tuple(node.compile(stats) for node in self._children)
+
+    def _optimize_children(self, stats, rank):
+      """
+      Sort children by the given ranking of (cost, probability) and return
+      them with their cost and probability, in order.
+      """
+      ranked = [(node.optimize(stats), node) for node in self._children]
+      ranked.sort(key=lambda x: rank(*x[0]))
+      self._children = [node for (_, node) in ranked]
+      return [estimate for (estimate, _) in ranked]
+
+    def predicates(self):
+      for node in self._children:
+        yield from node.predicates()
+
+    def _dnf_children(self, limit):
+      """
+      Return list of children's DNF, or None if any is too large.
+      """
+      children = []
+      for node in self._children:
+        clauses = node.dnf(limit)
+        if clauses is None:
+          return None
+        children.append(clauses)
+      return children
+
   class AndNode(Decision):
 
-    def evaluate(self, kv):
+    def evaluate(self, rights):
       for node in self._children:
-        if not node.evaluate(kv):
+        if not node.evaluate(rights):
           return False
       return True
 
+    def compile(self, stats=None):
+      fns = self._compile_children(stats)
+      if len(fns) == 1:
+        return fns[0]
+
+      def _and(rights):
+        for fn in fns:
+          if not fn(rights):
+            return False
+        return True
+      return _and
+
+    def optimize(self, stats=None):
+      # cheapest per chance of being false (and stopping evaluation) first
+      estimates = self._optimize_children(
+        stats, lambda cost, p: cost / (1 - p) if p < 1 else float('inf'))
+      expected = 0
+      reached = 1
+      for (cost, p) in estimates:
+        expected += reached * cost
+        reached *= p
+      return (expected, reached)
+
+    def dnf(self, limit):
+      children = self._dnf_children(limit)
+      if children is None:
+        return None
+
+      # distribute: every combination of one clause from each child
+      clauses = [frozenset()]
+      for child in children:
+        clauses = list({
+          clause | other for clause in clauses for other in child
+        })
+        if len(clauses) > limit:
+          return None
+      return clauses
+
   class OrNode(Decision):
 
-    def evaluate(self, kv):
+    def evaluate(self, rights):
       for node in self._children:
-        if node.evaluate(kv):
+        if node.evaluate(rights):
           return True
       return False
 
+    def compile(self, stats=None):
+      fns = self._compile_children(stats)
+      if len(fns) == 1:
+        return fns[0]
+
+      def _or(rights):
+        for fn in fns:
+          if fn(rights):
+            return True
+        return False
+      return _or
+
+    def optimize(self, stats=None):
+      # cheapest per chance of being true (and stopping evaluation) first
+      estimates = self._optimize_children(
+        stats, lambda cost, p: cost / p if p > 0 else float('inf'))
+      expected = 0
+      reached = 1
+      for (cost, p) in estimates:
+        expected += reached * cost
+        reached *= 1 - p
+      return (expected, 1 - reached)
+
+    def dnf(self, limit):
+      children = self._dnf_children(limit)
+      if children is None:
+        return None
+
+      clauses = list({clause for child in children for clause in child})
+      if len(clauses) > limit:
+        return None
+      return clauses
+
   @classmethod
-  def buildtree(cls, str):
+  def buildtree(cls, string):
     """
     Builds tree based on input string representing LDAP-like filter.
+
+    The string is scanned once, left to right, so parsing is linear in the
+    length of the string.  Syntax errors raise AccessSyntaxError giving the
+    position in the string where the problem was found.
     """
 
-    # parsing stack used to make tree, idk.
+    # parsing stack used to make tree; holds decision nodes, predicates not
+    # yet attached to a parent, and open parentheses
     stack = []
-    while str:
+    for m in tok_re.finditer(string):
 
-      [tok, str] = basetok_re.split(str)[1:]
+      tok = m.group()
+      pos = m.start()
 
       if tok == '&':
         stack.append(cls.AndNode())
@@ -107,47 +459,257 @@ class Evaluator:
       elif tok == '(':
         stack.append('(')
       elif tok == ')':
+        if len(stack) < 2 or stack[-1] == '(' or stack[-2] != '(':
+          raise AccessSyntaxError(
+            f"Unexpected ')' at position {pos} in '{string}'", pos)
         node = stack.pop()
-        dc = stack.pop()
-        if dc != '(':
-          raise Exception(f"Should not have seen '{dc}' on stack here")
+        stack.pop()
 
-        # last element on stack should be decision node (?); add this one as child
-        if len(stack) > 0:
+        # last element on stack should be decision node; add this one as child
+        if stack:
+          if not isinstance(stack[-1], cls.Decision):
+            raise AccessSyntaxError(
+              f"Group closed at position {pos} in '{string}' does not follow "
+              "'&' or '|'", pos)
           stack[-1].add(node)
         else:  # first element was an open parenthesis, s'fine too
           stack.append(node)
-      # Python 3.8+
-      ## elif m := predtok_re.match(tok):
-      ##   stack.append(cls.Predicate(m['key'], m['op'], m['value']))
-      ## else:
-      ##   raise Exception(f"Hi yeah unexpected {tok} with {str} remaining")
       else:
-        m = predtok_re.match(tok)
-        if m:
-          stack.append(cls.Predicate(m['key'], m['op'], m['value']))
-        else:
-          raise Exception(f"Hi yeah unexpected {tok} with {str} remaining")
+        pm = predtok_re.match(tok)
+        if not pm:
+          raise AccessSyntaxError(
+            f"Invalid predicate '{tok}' at position {pos} in '{string}'", pos)
+        stack.append(cls.Predicate(pm['key'], pm['op'], pm['value']))
 
     # there should be one thing left on the stack
-    if len(stack) > 1:
-      # TODO: proper exception
-      raise Exception(f"There is stuff left on the stack: {stack}")
+    if not stack:
+      raise AccessSyntaxError("Empty access string", 0)
+    if len(stack) > 1 or stack[0] == '(':
+      raise AccessSyntaxError(
+        f"Unexpected end of access string at position {len(string)} in "
+        f"'{string}': unbalanced parentheses or missing operator",
+        len(string))
     return stack.pop()
 
-  def __init__(self, str):
-    self._root = self.__class__.buildtree(str)
+  def __init__(self, string):
+    self._root = self.__class__.buildtree(string)
 
   def evaluate(self, kv):
     """
-    Evaluate decision tree against the given dict `kv` using function `fn`.
+    Evaluate decision tree against the given rights, either a Rights object
+    or a dict `kv` which will be converted to one.
     """
     if not self._root:
       raise Exception(
         "Bad call exception: should not call evaluate() before parse()"
       )
-    return self._root.evaluate(kv)
+    return self._root.evaluate(Rights.of(kv))
 
-def evaluate_access(restrictions, rights):
+  def optimize(self, stats=None):
+    """
+    Reorder decision tree for cheapest evaluation.  Returns expected cost of
+    evaluation and probability of the tree evaluating true.
+    """
+    return self._root.optimize(stats)
+
+  def compile(self, stats=None):
+    """
+    Compile decision tree into a function which evaluates given rights, either
+    a Rights object or a dict to be converted to one.  If `stats` is given the
+    function counts predicate evaluations there.
+    """
+    fn = self._root.compile(stats)
+
+    def _evaluate(rights):
+      if not isinstance(rights, Rights):
+        rights = Rights(rights)
+      return fn(rights)
+    return _evaluate
+
+  def predicates(self):
+    """
+    Return the set of (key, value) tuples for all predicates in the tree.
+    """
+    return set(self._root.predicates())
+
+  def dnf(self, limit=MAX_DNF_CLAUSES):
+    """
+    Return tree in disjunctive normal form, as a list of frozensets of (key,
+    value) tuples, or None if that would need more than `limit` clauses.
+    Clauses which are supersets of others are redundant and removed.
+    """
+    clauses = self._root.dnf(limit)
+    if clauses is None:
+      return None
+    clauses.sort(key=lambda clause: (len(clause), sorted(clause)))
+    minimal = []
+    for clause in clauses:
+      if not any(other <= clause for other in minimal):
+        minimal.append(clause)
+    return minimal
+
+@functools.lru_cache(maxsize=ACCESS_CACHE_SIZE)
+def compile_access(restrictions):
+  """
+  Return compiled evaluation function for the given access string.  Results
+  are cached so that a given string is only parsed once while it is in use.
+  The tree is optimized before compilation, using predicate statistics if
+  they are enabled.
+  """
   evaluator = Evaluator(restrictions)
-  return evaluator.evaluate(rights)
+  evaluator.optimize(_stats)
+  return evaluator.compile(_stats)
+
+def get_access_cache_stats():
+  """
+  Report hits, misses and size of the compiled access string cache.
+  """
+  info = compile_access.cache_info()
+  return {
+    'hits': info.hits,
+    'misses': info.misses,
+    'size': info.currsize,
+    'maxsize': info.maxsize
+  }
+
+def enable_access_stats(enable=True):
+  """
+  Enable or disable collection of predicate statistics.  Compiled access
+  strings are discarded so that they are recompiled accordingly.
+  """
+  global _stats
+  _stats = PredicateStats() if enable else None
+  compile_access.cache_clear()
+
+def get_access_stats():
+  """
+  Report predicate statistics, or None if they are not enabled.
+  """
+  if _stats is None:
+    return None
+  return _stats.report()
+
+def access_stats_enabled():
+  """
+  Whether predicate statistics are being collected.
+  """
+  return _stats is not None
+
+def reoptimize_access():
+  """
+  Discard compiled access strings so that they are recompiled, and so
+  reordered according to the statistics gathered so far.
+  """
+  compile_access.cache_clear()
+
+def evaluate_access(restrictions, rights):
+  return compile_access(restrictions)(rights)
+
+class AccessIndex:
+  """
+  Inverted index over a sequence of access strings, such as those of every
+  service in the catalogue, for determining which are satisfied by a given set
+  of rights without evaluating every one of them.
+
+  Each predicate (key, value) maps to the distinct access strings which
+  reference it.  Given the user's rights, the only candidates are the access
+  strings reachable through the user's own (key, value) pairs; only these are
+  evaluated, using their compiled form.  Entries with no access string are
+  always visible.  Those which are satisfied by no rights at all (an empty
+  '&', for example) are found up front and treated the same way.  Entries
+  with access strings which cannot be parsed are never visible; the errors
+  are available in `errors`.
+  """
+
+  def __init__(self, restrictions):
+    """
+    Build index from `restrictions`, a sequence of access strings or None,
+    one per entry.  Entries are subsequently referred to by position.
+    """
+
+    # positions of entries visible to everybody
+    self._open = []
+
+    # distinct access strings, positions of entries using each, and compiled
+    # evaluation functions
+    self._strings = []
+    self._positions = []
+    self._programs = []
+
+    # predicate index: key -> value -> ids (into the above) of access strings
+    self._index = {}
+
+    # (position, error) for access strings which could not be parsed
+    self.errors = []
+
+    ids = {}
+    nobody = Rights()
+    self._size = 0
+    for (pos, restriction) in enumerate(restrictions):
+      self._size += 1
+      if not restriction:
+        self._open.append(pos)
+        continue
+
+      sid = ids.get(restriction)
+      if sid is None:
+        try:
+          program = compile_access(restriction)
+        except AccessSyntaxError as e:
+          self.errors.append((pos, e))
+          continue
+        sid = ids[restriction] = len(self._strings)
+        self._strings.append(restriction)
+        self._positions.append([])
+        self._programs.append(program)
+        if program(nobody):
+          # vacuously true; no need to index it
+          self._open.append(pos)
+          self._positions[sid] = None
+          continue
+        for (key, value) in Evaluator(restriction).predicates():
+          self._index.setdefault(sys.intern(key), {}).setdefault(
+            sys.intern(value), set()).add(sid)
+      elif self._positions[sid] is None:
+        self._open.append(pos)
+        continue
+      self._positions[sid].append(pos)
+
+    self._values = {key: frozenset(values) for (key, values) in self._index.items()}
+
+  def __len__(self):
+    return self._size
+
+  def unrestricted(self):
+    """
+    Return sorted list of positions of entries visible to everybody.
+    """
+    return list(self._open)
+
+  def candidates(self, rights):
+    """
+    Return the set of ids of access strings which reference at least one of
+    the given rights.
+    """
+    rights = Rights.of(rights)
+    candidates = set()
+    for (key, values) in self._values.items():
+      held = rights.get(key)
+      if not held:
+        continue
+      byvalue = self._index[key]
+      for value in values & held:
+        candidates |= byvalue[value]
+    return candidates
+
+  def visible(self, rights):
+    """
+    Return sorted list of positions of entries visible with the given rights.
+    """
+    rights = Rights.of(rights)
+    visible = list(self._open)
+    for sid in self.candidates(rights):
+      if self._programs[sid](rights):
+        visible.extend(self._positions[sid])
+    visible.sort()
+    return visible
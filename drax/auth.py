@@ -10,7 +10,10 @@ from flask import (
 )
 from werkzeug.exceptions import abort
 from drax.log import get_log
-from drax.ldap import get_ldap
+from drax.exceptions import LdapException
+from drax.ldap import get_person
+from drax.access import Rights
+from drax import people
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -28,6 +31,16 @@ def load_logged_in_user():
     }
 
 
+def get_rights():
+  """
+  Retrieve the current user's access rights as a Rights object.  This is
+  built from the session once per request and reused thereafter.
+  """
+  if 'rights' not in g:
+    g.rights = Rights(session.get('access'))
+  return g.rights
+
+
 def admin_required(view):
   @functools.wraps(view)
   def wrapped_view(**kwargs):
@@ -60,10 +73,16 @@ def login_optional(view):
       if authenticated_user:
 
         # access-related attributes to retrieve
-        access_attrs = ['eduPersonAffiliation', 'eduPersonEntitlement']
-
-        # get user information into session
-        details = get_ldap().get_person(authenticated_user, access_attrs)
+        access_attrs = list(people.ACCESS_ATTRIBUTES)
+
+        # get user information into session; if the directory is unavailable
+        # carry on anonymously rather than hold up the request
+        try:
+          details = get_person(authenticated_user, access_attrs)
+        except LdapException as e:
+          get_log().warning("Could not look up %s, continuing anonymously: %s",
+            authenticated_user, e)
+          details = None
         get_log().debug("LDAP details for %s: %s", authenticated_user, details)
 
         if details:
@@ -80,18 +99,29 @@ def login_optional(view):
             # set this after the rest as this establishes a valid authentication
             session['uid'] = authenticated_user
 
-            # copy into session
-            session['access'] = {}
-            for access in access_attrs:
-              if access in details:
-                session['access'][access] = details[access]
+            # keep details synced for subsequent logins
+            if people.sync_enabled():
+              try:
+                people.record_login(authenticated_user)
+              # pylint: disable=broad-except
+              except Exception as e:
+                get_log().warning("Could not record login of %s: %s",
+                  authenticated_user, e)
+
+            # copy into session, normalized: exact values, no duplicates
+            rights = Rights({
+              access: details[access]
+              for access in access_attrs if access in details
+            })
+            session['access'] = rights.to_dict()
+            g.rights = rights
 
             # check if user has rights to this service
             if 'eduPersonEntitlement' in details:
 
               # has admin rights?
               # TODO: configuration item or something else
-              session['admin'] = 'bleep-blorp' in details['eduPersonEntitlement']
+              session['admin'] = rights.has('eduPersonEntitlement', 'bleep-blorp')
 
               # default for those with admin rights is to show admin view
               session['admin_view'] = session['admin']
@@ -0,0 +1,163 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Circuit breaker for calls to an external service, such as the directory.
+"""
+import concurrent.futures
+import threading
+import time
+from .exceptions import CallTimeout, CircuitOpen
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker:
+  """
+  Thread-safe circuit breaker.  Calls are made through `call()`, and each
+  exception raised of one of the `failures` types, or a call timeout, counts
+  as a failure; other exceptions are passed on but show that the service is
+  answering, so count as successes.  After `threshold` failures in a row
+  the breaker opens, and calls fail at once with CircuitOpen rather than
+  waiting on a service which is down.  After `reset_timeout` seconds it is
+  half open: one call is let through as a probe, closing the breaker if it
+  succeeds and opening it again if not.
+
+  If `call_timeout` is given, calls are made in a pool of `workers` threads
+  and raise CallTimeout if they take longer than that many seconds, so that
+  callers are not held up by a slow service.  The call itself runs on and
+  ties up its worker until it finishes, so calls which time out count as
+  failures; once the breaker opens, no more calls are made.
+  """
+
+  # pylint: disable=too-many-instance-attributes
+  # pylint: disable=too-many-arguments
+  def __init__(self, threshold=5, reset_timeout=30, call_timeout=None, workers=4,
+               failures=(Exception,)):
+    self._threshold = threshold
+    self._reset_timeout = reset_timeout
+    self._call_timeout = call_timeout
+    self._workers = workers
+    self._failure_types = (CallTimeout,) + tuple(failures)
+    self._executor = None
+
+    self._lock = threading.Lock()
+    self._state = CLOSED
+    self._failures = 0
+    self._opened = None
+    self._probing = False
+    self._last_error = None
+
+    self._calls = 0
+    self._failed = 0
+    self._timeouts = 0
+    self._rejected = 0
+    self._opens = 0
+
+  @property
+  def state(self):
+    """
+    Current state, taking into account whether an open breaker is due to be
+    probed.
+    """
+    with self._lock:
+      return self._current_state(time.monotonic())
+
+  def _current_state(self, now):
+    if self._state == OPEN and now - self._opened >= self._reset_timeout:
+      return HALF_OPEN
+    return self._state
+
+  def _admit(self):
+    """
+    Decide whether call may be made; return whether it is a probe.
+    """
+    with self._lock:
+      state = self._current_state(time.monotonic())
+      if state == CLOSED:
+        self._calls += 1
+        return False
+      if state == HALF_OPEN and not self._probing:
+        self._state = HALF_OPEN
+        self._probing = True
+        self._calls += 1
+        return True
+      self._rejected += 1
+      raise CircuitOpen(
+        f"Circuit open after {self._failures} failures: {self._last_error}")
+
+  def _succeeded(self, probe):
+    # only the probe closes the breaker; calls let through before it opened
+    # may finish after
+    with self._lock:
+      if probe:
+        self._probing = False
+        self._state = CLOSED
+        self._failures = 0
+      elif self._state == CLOSED:
+        self._failures = 0
+
+  def _failed_with(self, probe, e):
+    with self._lock:
+      if probe:
+        self._probing = False
+      self._failed += 1
+      self._failures += 1
+      self._last_error = str(e) or e.__class__.__name__
+      if probe or (self._state == CLOSED and self._failures >= self._threshold):
+        self._state = OPEN
+        self._opened = time.monotonic()
+        self._opens += 1
+
+  def _run(self, fn, args, kwargs):
+    if self._call_timeout is None:
+      return fn(*args, **kwargs)
+    with self._lock:
+      if self._executor is None:
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=self._workers, thread_name_prefix='breaker')
+    future = self._executor.submit(fn, *args, **kwargs)
+    try:
+      return future.result(self._call_timeout)
+    except concurrent.futures.TimeoutError:
+      future.cancel()
+      with self._lock:
+        self._timeouts += 1
+      raise CallTimeout(f"Call timed out after {self._call_timeout}s") from None
+
+  def call(self, fn, *args, **kwargs):
+    """
+    Call `fn` with the given arguments, subject to the breaker.
+    """
+    probe = self._admit()
+    try:
+      result = self._run(fn, args, kwargs)
+    except self._failure_types as e:
+      self._failed_with(probe, e)
+      raise
+    except Exception:
+      self._succeeded(probe)
+      raise
+    self._succeeded(probe)
+    return result
+
+  def stats(self):
+    """
+    Report breaker state and statistics.  `failures` is the number of
+    failures in a row; `failed` is the total.
+    """
+    with self._lock:
+      now = time.monotonic()
+      return {
+        'state': self._current_state(now),
+        'failures': self._failures,
+        'threshold': self._threshold,
+        'open_for': now - self._opened if self._state != CLOSED else None,
+        'last_error': self._last_error,
+        'calls': self._calls,
+        'failed': self._failed,
+        'timeouts': self._timeouts,
+        'rejected': self._rejected,
+        'opens': self._opens,
+      }
@@ -0,0 +1,234 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Simple in-process caches for sharing computed results between requests.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+class LruCache:
+  """
+  Thread-safe, size-bounded cache which evicts the least recently used entry
+  when full.  Keeps hit and miss counts for reporting.
+
+  Entries may be tagged with a version, such as that of the data they were
+  derived from; when a different version is given to `validate()` all
+  entries are discarded.
+  """
+
+  def __init__(self, maxsize):
+    self._maxsize = maxsize
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+    self._version = None
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._data[key]
+      except KeyError:
+        self._misses += 1
+        return default
+      self._data.move_to_end(key)
+      self._hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._data[key] = value
+      self._data.move_to_end(key)
+      while len(self._data) > self._maxsize:
+        self._data.popitem(last=False)
+        self._evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def validate(self, version):
+    """
+    Discard all entries if `version` differs from the version last given.
+    """
+    with self._lock:
+      if version != self._version:
+        self._data.clear()
+        self._version = version
+
+  def stats(self):
+    """
+    Report cache statistics.
+    """
+    with self._lock:
+      return {
+        'hits': self._hits,
+        'misses': self._misses,
+        'evictions': self._evictions,
+        'size': len(self._data),
+        'maxsize': self._maxsize,
+        'version': self._version
+      }
+
+class _Flight:
+  """
+  Load in progress, which other callers wanting the same key wait on.
+  """
+
+  def __init__(self):
+    self._done = threading.Event()
+    self._value = None
+    self._error = None
+
+  def finish(self, value=None, error=None):
+    self._value = value
+    self._error = error
+    self._done.set()
+
+  def wait(self):
+    self._done.wait()
+    if self._error is not None:
+      raise self._error
+    return self._value
+
+class TtlCache:
+  """
+  Thread-safe, size-bounded cache of loaded values which expire after `ttl`
+  seconds.  Empty values, such as for lookups that found nothing, expire
+  after `negative_ttl` seconds instead; a TTL of 0 means such values are not
+  kept.  The least recently used entry is evicted when full.
+
+  Values are loaded by `get_or_load()`.  Only one load per key is in progress
+  at a time: callers asking for a key while it is being loaded wait for and
+  share the result, or the exception raised, rather than loading it again.
+  Errors are not cached.
+  """
+
+  def __init__(self, maxsize, ttl, negative_ttl=0):
+    self._maxsize = maxsize
+    self._ttl = ttl
+    self._negative_ttl = negative_ttl
+
+    # entries as (value, time of expiry), most recently used last
+    self._data = OrderedDict()
+
+    # loads in progress, by key
+    self._flights = {}
+
+    self._lock = threading.Lock()
+    self._hits = 0
+    self._negative_hits = 0
+    self._misses = 0
+    self._coalesced = 0
+    self._errors = 0
+    self._evictions = 0
+    self._expirations = 0
+    self._loads = 0
+    self._load_total = 0.0
+    self._load_max = 0.0
+
+  def __len__(self):
+    return len(self._data)
+
+  def get_or_load(self, key, loader):
+    """
+    Return the cached value for `key`, calling `loader()` to load it if it is
+    missing or expired.
+    """
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is not None:
+        (value, expires) = entry
+        if time.monotonic() < expires:
+          self._data.move_to_end(key)
+          if value:
+            self._hits += 1
+          else:
+            self._negative_hits += 1
+          return value
+        del self._data[key]
+        self._expirations += 1
+
+      flight = self._flights.get(key)
+      if flight is not None:
+        self._coalesced += 1
+      else:
+        self._misses += 1
+        self._flights[key] = _Flight()
+
+    if flight is not None:
+      return flight.wait()
+
+    start = time.monotonic()
+    try:
+      value = loader()
+    # pylint: disable=broad-except
+    except BaseException as e:
+      with self._lock:
+        self._errors += 1
+        flight = self._flights.pop(key)
+      flight.finish(error=e)
+      raise
+
+    now = time.monotonic()
+    with self._lock:
+      self._record_load(now - start)
+      ttl = self._ttl if value else self._negative_ttl
+      if ttl > 0:
+        self._data[key] = (value, now + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+          self._data.popitem(last=False)
+          self._evictions += 1
+      flight = self._flights.pop(key)
+    flight.finish(value)
+    return value
+
+  def _record_load(self, elapsed):
+    self._loads += 1
+    self._load_total += elapsed
+    self._load_max = max(self._load_max, elapsed)
+
+  def invalidate(self, key):
+    """
+    Discard the entry for `key`, if any.
+    """
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def stats(self):
+    """
+    Report cache statistics.  Times are in seconds; `hit_rate` counts both
+    positive and negative hits, and callers which waited on another's load.
+    """
+    with self._lock:
+      lookups = self._hits + self._negative_hits + self._misses + self._coalesced
+      return {
+        'hits': self._hits,
+        'negative_hits': self._negative_hits,
+        'misses': self._misses,
+        'coalesced': self._coalesced,
+        'errors': self._errors,
+        'evictions': self._evictions,
+        'expirations': self._expirations,
+        'size': len(self._data),
+        'maxsize': self._maxsize,
+        'ttl': self._ttl,
+        'negative_ttl': self._negative_ttl,
+        'hit_rate':
+          (lookups - self._misses) / lookups if lookups else 0.0,
+        'loads': self._loads,
+        'load_total': self._load_total,
+        'load_max': self._load_max,
+        'load_mean': self._load_total / self._loads if self._loads else 0.0,
+      }
@@ -0,0 +1,665 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Service catalogue as held in the application process.  Each language's listing
+of services is loaded from the database once, along with an AccessIndex over
+the services' access strings, and kept until the catalogue changes.  Changes
+to the catalogue tables bump the catalogue version in the database (by way of
+triggers) so the version is all that need be queried to validate the cache.
+
+Access strings are validated when the catalogue is seeded, so that a bad one
+never reaches the dashboard, and are compiled when the application starts so
+that requests do not parse them.
+
+Alternatively access decisions can be made by the database.  Access strings
+are normalized into disjunctive normal form in the access_rules table when
+the catalogue is loaded, and the user's rights are passed to the query.
+"""
+
+import json
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from .db import get_db
+from .access import (
+  AccessIndex, Evaluator, access_stats_enabled, compile_access,
+  get_access_cache_stats, reoptimize_access
+)
+from .exceptions import AccessSyntaxError, InvalidCatalogue
+from .log import get_log
+from .statements import register_statement
+
+# ---------------------------------------------------------------------------
+#                                                                       sql
+# ---------------------------------------------------------------------------
+
+SQL_GET_CATALOGUE_VERSION = '''
+  SELECT    version
+  FROM      catalogue_version
+'''
+
+SQL_GET_ALL = '''
+  SELECT    category, service, title, description, access, url,
+            NULLIF(icon_url, '') AS icon_url, sso
+  FROM      all_services
+  WHERE     language = ?
+'''
+
+# the catalogue version is checked on every request
+STMT_GET_CATALOGUE_VERSION = register_statement(
+  'get_catalogue_version', SQL_GET_CATALOGUE_VERSION)
+STMT_GET_ALL = register_statement('get_all_services', SQL_GET_ALL, ('en',))
+
+# Services visible given a list of rights as "attribute=value" strings: those
+# with no restriction, those for which any clause has all of its predicates
+# in the list, and those whose access strings have not been normalized (which
+# must then be evaluated by the caller)
+SQL_GET_VISIBLE = '''
+  SELECT    category, service, title, description, access, url,
+            NULLIF(icon_url, '') AS icon_url, sso
+  FROM      all_services
+  WHERE     language = ?
+    AND     (
+              access IS NULL
+              OR access NOT IN (SELECT access FROM access_rules)
+              OR access IN (
+                SELECT    access
+                FROM      access_rules
+                GROUP BY  access, clause
+                HAVING    COUNT(attribute) = SUM(
+                            CASE WHEN attribute || '=' || value IN (?)
+                            THEN 1 ELSE 0 END)
+              )
+            )
+'''
+
+SQL_GET_SERVICE_ACCESS = '''
+  SELECT    service, category, access
+  FROM      service_access
+  WHERE     access IS NOT NULL
+'''
+
+SQL_GET_ACCESS_STRINGS = '''
+  SELECT    DISTINCT access
+  FROM      service_access
+  WHERE     access IS NOT NULL
+'''
+
+SQL_DELETE_ACCESS_RULES = '''
+  DELETE FROM access_rules
+'''
+
+SQL_INSERT_ACCESS_RULE = '''
+  INSERT INTO access_rules (access, clause, attribute, value)
+  VALUES (?, ?, ?, ?)
+'''
+
+# Catalogue tables, in the order they must be loaded, with their key columns
+# and other columns, for import and export
+CATALOGUE_TABLES = (
+  ('categories', ('name',), ('ordr',)),
+  ('titles', ('name', 'language'), ('title',)),
+  ('services', ('name',), ('sso',)),
+  ('service_definitions', ('service', 'language'), ('title', 'description')),
+  ('service_access', ('service', 'category'), ('url', 'access', 'icon_url')),
+)
+
+# columns stored as 0 or 1 by SQLite, exported as booleans
+BOOLEAN_COLUMNS = ('sso',)
+
+# columns which imported records may leave out or give as null, by table;
+# key columns and all others are required
+OPTIONAL_COLUMNS = {
+  'categories': ('ordr',),
+  'service_definitions': ('title', 'description'),
+  'service_access': ('access', 'icon_url'),
+}
+
+def _export_query(table, keys, columns):
+  return f"SELECT {', '.join(keys + columns)} FROM {table} ORDER BY {', '.join(keys)}"
+
+def _upsert_query(table, keys, columns):
+  # records are only updated if they differ, so that unchanged records don't
+  # set off the triggers maintaining the catalogue
+  names = keys + columns
+  return (
+    f"INSERT INTO {table} ({', '.join(names)}) "
+    f"VALUES ({', '.join(['?'] * len(names))}) "
+    f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+    + ', '.join(f"{column} = excluded.{column}" for column in columns)
+    + " WHERE "
+    + ' OR '.join(
+      f"{table}.{column} <> excluded.{column} "
+      f"OR ({table}.{column} IS NULL) <> (excluded.{column} IS NULL)"
+      for column in columns)
+  )
+
+SQL_EXPORT = {
+  table: _export_query(table, keys, columns)
+  for (table, keys, columns) in CATALOGUE_TABLES
+}
+SQL_UPSERT = {
+  table: _upsert_query(table, keys, columns)
+  for (table, keys, columns) in CATALOGUE_TABLES
+}
+SQL_DELETE = {
+  table: f"DELETE FROM {table} WHERE " + ' AND '.join(f"{key} = ?" for key in keys)
+  for (table, keys, columns) in CATALOGUE_TABLES
+}
+
+# defer refreshing the materialized catalogue until the end of an import
+# (Postgres only).  The refresh runs in the importing transaction, so cannot
+# be concurrent.
+SQL_DEFER_REFRESH = "SET LOCAL drax.defer_refresh = 'on'"
+SQL_REFRESH = "REFRESH MATERIALIZED VIEW catalogue"
+
+# ---------------------------------------------------------------------------
+#                                                                   helpers
+# ---------------------------------------------------------------------------
+
+# number of records upserted at a time on import
+IMPORT_BATCH_SIZE = 1000
+
+# maximum number of bad records described when an import is rejected
+IMPORT_MAX_ERRORS = 100
+
+# catalogues loaded, keyed by language
+_catalogues = {}
+
+# when access evaluation was last reordered according to predicate statistics
+_reoptimized = time.monotonic()
+
+class Catalogue:
+  """
+  A language's listing of services, in category order, along with the index
+  used to determine which of them are visible to a given user.
+  """
+
+  def __init__(self, language, version, rows):
+    self._language = language
+    self._version = version
+    self._rows = rows
+    self._index = AccessIndex(rec['access'] for rec in rows)
+    for (pos, e) in self._index.errors:
+      get_log().error("Service '%s' hidden due to bad access string: %s",
+        rows[pos]['service'], e)
+
+  @property
+  def language(self):
+    return self._language
+
+  @property
+  def version(self):
+    return self._version
+
+  def __len__(self):
+    return len(self._rows)
+
+  def unrestricted(self):
+    """
+    Generate services visible to everybody, in catalogue order.
+    """
+    for pos in self._index.unrestricted():
+      yield self._rows[pos]
+
+  def visible(self, rights):
+    """
+    Generate services visible with the given rights, in catalogue order.
+    """
+    for pos in self._index.visible(rights):
+      yield self._rows[pos]
+
+
+def get_catalogue_version():
+  """
+  Retrieve current catalogue version from the database.
+  """
+  db = get_db(readonly=True)
+  return db.execute_statement(STMT_GET_CATALOGUE_VERSION).fetchone()['version']
+
+
+def get_catalogue(language, version=None):
+  """
+  Retrieve catalogue for the given language, (re)loading it if it has changed
+  since it was last loaded.  If the current catalogue version is already
+  known it may be given to avoid querying for it again.
+  """
+  if _reoptimize_due():
+    reoptimize_catalogues()
+  if version is None:
+    version = get_catalogue_version()
+  catalogue = _catalogues.get(language)
+  if catalogue is None or catalogue.version != version:
+    db = get_db(readonly=True)
+    rows = db.execute_statement(STMT_GET_ALL, (language,)).fetchall() or []
+    catalogue = Catalogue(language, version, rows)
+    _catalogues[language] = catalogue
+  return catalogue
+
+
+def _reoptimize_due():
+  interval = current_app.config.get('ACCESS_REOPTIMIZE_INTERVAL')
+  return access_stats_enabled() and interval \
+    and time.monotonic() - _reoptimized >= interval
+
+
+def reoptimize_catalogues():
+  """
+  Recompile access strings, ordering evaluation according to the predicate
+  statistics gathered so far, and drop loaded catalogues so that their access
+  indexes are rebuilt with the reordered strings.  This is done every
+  ACCESS_REOPTIMIZE_INTERVAL seconds while statistics are collected.
+  """
+  # pylint: disable=global-statement
+  global _reoptimized
+  _reoptimized = time.monotonic()
+  reoptimize_access()
+  invalidate_catalogues()
+  get_log().info("Reordered access evaluation by predicate statistics")
+
+
+def get_visible_services(language, rights):
+  """
+  Generate services visible with the given rights, in catalogue order, having
+  the database filter them according to the normalized access rules.
+  """
+  pairs = [f'{key}={value}' for (key, value) in rights.predicates()]
+  for rec in get_db(readonly=True).iterate(SQL_GET_VISIBLE, (language, pairs)):
+    # services whose access strings have not been normalized are included by
+    # the query regardless, so check them; others are cheap to check anyway
+    restriction = rec['access']
+    if restriction:
+      try:
+        if not compile_access(restriction)(rights):
+          continue
+      except AccessSyntaxError as e:
+        get_log().error("Service '%s' hidden due to bad access string: %s",
+          rec['service'], e)
+        continue
+    yield rec
+
+
+def check_catalogue():
+  """
+  Check that every access string in the catalogue can be parsed and compiled,
+  raising InvalidCatalogue describing any which cannot.
+  """
+  errors = []
+  for rec in get_db().iterate(SQL_GET_SERVICE_ACCESS):
+    try:
+      compile_access(rec['access'])
+    except AccessSyntaxError as e:
+      errors.append(f"{rec['service']} ({rec['category']}): {e}")
+  if errors:
+    raise InvalidCatalogue(errors)
+
+
+def warm_access_cache():
+  """
+  Compile all access strings in the catalogue so that requests find them
+  already compiled.  Returns the number of access strings.
+  """
+  strings = 0
+  for rec in get_db(readonly=True).execute(SQL_GET_ACCESS_STRINGS).fetchall() or []:
+    strings += 1
+    try:
+      compile_access(rec['access'])
+    except AccessSyntaxError as e:
+      get_log().error("Bad access string in catalogue: %s", e)
+
+  maxsize = get_access_cache_stats()['maxsize']
+  if strings > maxsize:
+    get_log().warning(
+      "Catalogue has %d distinct access strings but only %d are cached",
+      strings, maxsize)
+  return strings
+
+
+def refresh_access_rules():
+  """
+  Rewrite normalized access rules for all access strings in the catalogue.
+  Access strings whose normal form is too large, or which are not valid, are
+  left out and so are evaluated by the application instead.
+
+  Returns the number of access strings normalized and the number left out.
+  """
+  db = get_db()
+  rules = []
+  normalized = 0
+  skipped = 0
+  for rec in db.execute(SQL_GET_ACCESS_STRINGS).fetchall() or []:
+    restriction = rec['access']
+    try:
+      clauses = Evaluator(restriction).dnf()
+    except AccessSyntaxError as e:
+      get_log().error("Bad access string in catalogue: %s", e)
+      skipped += 1
+      continue
+    if clauses is None:
+      get_log().warning("Access string too complex to normalize: %s", restriction)
+      skipped += 1
+      continue
+    normalized += 1
+    for (i, clause) in enumerate(clauses):
+      if not clause:
+        rules.append((restriction, i, None, None))
+      for (key, value) in sorted(clause):
+        rules.append((restriction, i, key, value))
+
+  db.execute(SQL_DELETE_ACCESS_RULES)
+  if rules:
+    db.executemany(SQL_INSERT_ACCESS_RULE, rules)
+  db.commit()
+  return (normalized, skipped)
+
+
+def _row(names, values):
+  """
+  Return tuple of record's values in a form comparable between databases.
+  """
+  return tuple(
+    bool(value) if name in BOOLEAN_COLUMNS and value is not None else value
+    for (name, value) in zip(names, values)
+  )
+
+
+def _read_records(lines, errors):
+  """
+  Generate table and row (key columns first) of each record in JSON lines.
+  Bad records, including those lacking required columns, are skipped and
+  described in `errors`.
+  """
+  specs = {table: keys + columns for (table, keys, columns) in CATALOGUE_TABLES}
+  for (lineno, line) in enumerate(lines, 1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      record = json.loads(line)
+      table = record['table']
+      names = specs[table]
+      optional = OPTIONAL_COLUMNS.get(table, ())
+      missing = [
+        name for name in names if record.get(name) is None and name not in optional
+      ]
+      if missing:
+        raise ValueError(f"{table} record lacks {', '.join(missing)}")
+      row = _row(names, (record.get(name) for name in names))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      if len(errors) < IMPORT_MAX_ERRORS:
+        errors.append(f"line {lineno}: bad record ({e})")
+      continue
+    yield (table, row)
+
+
+def export_catalogue():
+  """
+  Generate the catalogue as JSON lines: one object per record, giving the
+  table in `table` along with the record's columns.  Tables are given in the
+  order they must be imported.  Rows are streamed from the database.
+  """
+  db = get_db()
+  for (table, keys, columns) in CATALOGUE_TABLES:
+    names = keys + columns
+    for rec in db.iterate(SQL_EXPORT[table]):
+      record = {'table': table}
+      record.update(zip(names, _row(names, rec)))
+      yield json.dumps(record, ensure_ascii=False)
+
+
+def import_catalogue(lines, batch_size=IMPORT_BATCH_SIZE):
+  """
+  Load catalogue records from JSON lines as produced by export_catalogue(),
+  adding records or updating them in place.  Records are not deleted.  Tables
+  referenced by others must come first.
+
+  Records are upserted in batches, all in one transaction, which is rolled
+  back and InvalidCatalogue raised if any records are bad or the resulting
+  catalogue has bad access strings.
+
+  Returns the number of records loaded for each table.
+  """
+  batches = {table: [] for (table, _, _) in CATALOGUE_TABLES}
+  counts = {table: 0 for table in batches}
+  errors = []
+
+  db = get_db()
+
+  def flush():
+    # load pending records of tables referenced by others first
+    for (table, batch) in batches.items():
+      if batch:
+        db.executemany(SQL_UPSERT[table], batch)
+        counts[table] += len(batch)
+        batch.clear()
+
+  try:
+    if db.type == 'postgres':
+      db.execute(SQL_DEFER_REFRESH)
+
+    for (table, row) in _read_records(lines, errors):
+      batch = batches[table]
+      batch.append(row)
+      if len(batch) >= batch_size:
+        flush()
+
+    if errors:
+      raise InvalidCatalogue(errors)
+    flush()
+
+    if db.type == 'postgres':
+      db.execute(SQL_REFRESH)
+
+    # reject catalogue with invalid entries
+    check_catalogue()
+  except Exception:
+    db.rollback()
+    raise
+
+  db.commit()
+  return counts
+
+
+class CatalogueDiff:
+  """
+  Differences between the catalogue in the database and a declared catalogue,
+  by table: records added and changed (as rows, key columns first) and keys
+  of records removed.
+  """
+
+  def __init__(self):
+    self.added = {table: [] for (table, _, _) in CATALOGUE_TABLES}
+    self.changed = {table: [] for (table, _, _) in CATALOGUE_TABLES}
+    self.removed = {table: [] for (table, _, _) in CATALOGUE_TABLES}
+
+  def __len__(self):
+    return sum(
+      len(self.added[table]) + len(self.changed[table]) + len(self.removed[table])
+      for (table, _, _) in CATALOGUE_TABLES
+    )
+
+  def __bool__(self):
+    return len(self) > 0
+
+  def report(self):
+    """
+    Generate description of each change, one per line.
+    """
+    for (table, keys, _) in CATALOGUE_TABLES:
+      for (mark, rows) in (('+', self.added[table]), ('~', self.changed[table])):
+        for row in rows:
+          yield f"{mark} {table} {' '.join(map(str, row[:len(keys)]))}"
+      for key in self.removed[table]:
+        yield f"- {table} {' '.join(map(str, key))}"
+
+  def summary(self):
+    """
+    Describe number of changes by table.
+    """
+    return ', '.join(
+      f"{table} +{len(self.added[table])} ~{len(self.changed[table])} "
+      f"-{len(self.removed[table])}"
+      for (table, _, _) in CATALOGUE_TABLES
+    )
+
+
+def diff_catalogue(lines):
+  """
+  Compare the catalogue declared in JSON lines, in the format produced by
+  export_catalogue(), to the catalogue in the database, and return the
+  CatalogueDiff.  Raises InvalidCatalogue if any records are bad.
+  """
+  db = get_db()
+  diff = CatalogueDiff()
+  errors = []
+
+  # current records' values by key, removed as declared records are matched
+  # so that those left over are the ones to remove
+  current = {}
+  seen = {}
+  for (table, keys, columns) in CATALOGUE_TABLES:
+    names = keys + columns
+    current[table] = {}
+    for rec in db.iterate(SQL_EXPORT[table]):
+      row = _row(names, rec)
+      current[table][row[:len(keys)]] = row[len(keys):]
+    seen[table] = set()
+
+  nkeys = {table: len(keys) for (table, keys, _) in CATALOGUE_TABLES}
+  for (table, row) in _read_records(lines, errors):
+    key = row[:nkeys[table]]
+    if key in seen[table]:
+      errors.append(f"duplicate {table} record {' '.join(map(str, key))}")
+      continue
+    seen[table].add(key)
+    values = current[table].pop(key, None)
+    if values is None:
+      diff.added[table].append(row)
+    elif values != row[nkeys[table]:]:
+      diff.changed[table].append(row)
+
+  if errors:
+    raise InvalidCatalogue(errors[:IMPORT_MAX_ERRORS])
+
+  for (table, records) in current.items():
+    diff.removed[table] = list(records)
+  return diff
+
+
+def sync_catalogue(lines, dry_run=False):
+  """
+  Bring the catalogue in the database in line with the catalogue declared in
+  JSON lines, in the format produced by export_catalogue(), changing only
+  the records which differ, all in one transaction.  Records not declared are
+  removed.  If nothing differs, nothing is written, and so the catalogue
+  version is unchanged and caches of the catalogue remain valid.
+
+  Returns the CatalogueDiff, which with `dry_run` is not applied.  Raises
+  InvalidCatalogue if any records are bad or the resulting catalogue has bad
+  access strings, in which case nothing is changed.
+  """
+  diff = diff_catalogue(lines)
+  if dry_run or not diff:
+    return diff
+
+  db = get_db()
+  try:
+    if db.type == 'postgres':
+      db.execute(SQL_DEFER_REFRESH)
+
+    # add and update records of tables referenced by others first, and remove
+    # them last
+    for (table, _, _) in CATALOGUE_TABLES:
+      rows = diff.added[table] + diff.changed[table]
+      if rows:
+        db.executemany(SQL_UPSERT[table], rows)
+    for (table, _, _) in reversed(CATALOGUE_TABLES):
+      if diff.removed[table]:
+        db.executemany(SQL_DELETE[table], diff.removed[table])
+
+    if db.type == 'postgres':
+      db.execute(SQL_REFRESH)
+
+    # reject catalogue with invalid entries
+    check_catalogue()
+  except Exception:
+    db.rollback()
+    raise
+
+  db.commit()
+  invalidate_catalogues()
+  return diff
+
+
+def invalidate_catalogues():
+  """
+  Drop all loaded catalogues so they are reloaded on next use.
+  """
+  _catalogues.clear()
+
+
+@click.command('export-catalogue')
+@click.argument('output', type=click.File('w', encoding='utf8'), default='-')
+@with_appcontext
+def export_catalogue_command(output):
+  """Export the catalogue as JSON lines to OUTPUT (default stdout)."""
+  count = 0
+  for line in export_catalogue():
+    output.write(line)
+    output.write('\n')
+    count += 1
+  click.echo(f'Exported {count} records.', err=True)
+
+
+@click.command('import-catalogue')
+@click.argument('source', type=click.File('r', encoding='utf8'), default='-')
+@with_appcontext
+def import_catalogue_command(source):
+  """
+  Add or update catalogue records from JSON lines in SOURCE (default stdin),
+  as produced by export-catalogue.
+  """
+  try:
+    counts = import_catalogue(source)
+  except InvalidCatalogue as e:
+    raise click.ClickException(str(e))
+  refresh_access_rules()
+  invalidate_catalogues()
+  click.echo('Imported ' + ', '.join(
+    f'{count} {table}' for (table, count) in counts.items()) + '.')
+
+
+@click.command('sync-catalogue')
+@click.argument('source', type=click.File('r', encoding='utf8'), default='-')
+@click.option('--dry-run', is_flag=True, help='report differences only')
+@with_appcontext
+def sync_catalogue_command(source, dry_run):
+  """
+  Make the catalogue match the one declared in JSON lines in SOURCE (default
+  stdin), as produced by export-catalogue, changing only what differs.
+  """
+  try:
+    diff = sync_catalogue(source, dry_run)
+  except InvalidCatalogue as e:
+    raise click.ClickException(str(e))
+  for line in diff.report():
+    click.echo(line)
+  if diff and not dry_run:
+    if diff.added['service_access'] or diff.changed['service_access'] \
+        or diff.removed['service_access']:
+      refresh_access_rules()
+    click.echo(f'Synchronized catalogue: {diff.summary()}.')
+  elif diff:
+    click.echo(f'Catalogue differs: {diff.summary()}.')
+  else:
+    click.echo('Catalogue is up to date.')
+
+
+@click.command('refresh-access-rules')
+@with_appcontext
+def refresh_access_rules_command():
+  """Normalize catalogue access strings for filtering in the database."""
+  (normalized, skipped) = refresh_access_rules()
+  click.echo(f'Normalized {normalized} access strings, skipped {skipped}.')
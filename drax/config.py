@@ -19,9 +19,44 @@ def init_config(codename, path):
   def_db_uri = f'file:///{path}/{codename}.sqlite'
   conf.add('DATABASE_URI', value=def_db_uri)
 
+  # database connection pooling (Postgres only); pool size of 0 disables.
+  # Times are in seconds: how long to wait for a connection, how long before
+  # a connection is replaced, and how long idle before it is checked on reuse
+  conf.add('DATABASE_POOL_SIZE', value=0, type=int)
+  conf.add('DATABASE_POOL_TIMEOUT', value=10, type=int)
+  conf.add('DATABASE_POOL_MAX_LIFETIME', value=3600, type=int)
+  conf.add('DATABASE_POOL_CHECK_IDLE', value=30, type=int)
+
+  # read replicas: URIs separated by commas or spaces.  Read-only queries go to
+  # each in turn, falling back to DATABASE_URI; a replica which cannot be
+  # connected to is skipped for DATABASE_REPLICA_RETRY seconds
+  conf.add('DATABASE_REPLICA_URIS', value='')
+  conf.add('DATABASE_REPLICA_RETRY', value=30, type=int)
+
+  # collect per-query timing statistics, and log queries taking longer than
+  # the given number of milliseconds (0 to not log slow queries); off by
+  # default since every query then updates shared statistics under a lock
+  conf.add('DATABASE_QUERY_STATS', value=False, type=bool)
+  conf.add('DATABASE_SLOW_QUERY_MS', value=250, type=int)
+
+  # SQLite connection profile: 'default' or 'production' (write-ahead logging,
+  # tuned pragmas and per-thread read-only connections)
+  conf.add('SQLITE_PROFILE', value='default')
+
   # configuration for authorization
   conf.add('ENTITLEMENT_ADMIN', value='drax.example.org/admin')
 
+  # collect statistics on access predicates to optimize evaluation order
+  conf.add('ACCESS_STATS', value=False, type=bool)
+
+  # while collecting them, seconds between reorderings of access evaluation
+  # by the statistics gathered (0 to only reorder on request)
+  conf.add('ACCESS_REOPTIMIZE_INTERVAL', value=3600, type=int)
+
+  # where access decisions for the dashboard are made: 'index' to use the
+  # in-process access index, 'sql' to have the database filter services
+  conf.add('ACCESS_FILTER', value='index')
+
   # default location of static, external resources
   conf.add('RESOURCE_URI', value='static')
 
@@ -36,6 +71,45 @@ def init_config(codename, path):
   conf.add('LDAP_SKIP_TLS', value=False, type=bool)
   conf.add('LDAP_TLS_REQCERT', value='demand')
 
+  # timeouts in seconds for each directory operation and for establishing
+  # connections (0 for none)
+  conf.add('LDAP_TIMEOUT', value=10, type=int)
+  conf.add('LDAP_NETWORK_TIMEOUT', value=5, type=int)
+
+  # time budget in seconds for each directory lookup, including getting a
+  # connection (0 for none), and circuit breaker: number of failures in a row
+  # after which lookups fail at once, and seconds until one is tried again
+  conf.add('LDAP_CALL_TIMEOUT', value=10, type=int)
+  conf.add('LDAP_BREAKER_THRESHOLD', value=5, type=int)
+  conf.add('LDAP_BREAKER_RESET', value=30, type=int)
+
+  # pool of bound connections shared across requests: maximum number, how
+  # long in seconds to wait for one, how long before one is replaced, and how
+  # long one may be idle before it is replaced (0 for no limit), which should
+  # be less than the server's idle timeout
+  conf.add('LDAP_POOL_SIZE', value=10, type=int)
+  conf.add('LDAP_POOL_TIMEOUT', value=10, type=int)
+  conf.add('LDAP_POOL_MAX_LIFETIME', value=3600, type=int)
+  conf.add('LDAP_POOL_MAX_IDLE', value=300, type=int)
+
+  # sync of people's attributes from the directory: base DN under which to
+  # search for people, seconds between syncs by the serving processes, once
+  # they serve requests (0 to only sync with the sync-people command), days
+  # since last login for people to be kept synced, page size for searches,
+  # and seconds for which synced details are used for logins (0 to always
+  # look people up in the directory)
+  conf.add('LDAP_PEOPLE_BASE')
+  conf.add('LDAP_SYNC_INTERVAL', value=0, type=int)
+  conf.add('LDAP_SYNC_ACTIVE_DAYS', value=30, type=int)
+  conf.add('LDAP_SYNC_PAGE_SIZE', value=500, type=int)
+  conf.add('LDAP_SYNC_MAX_AGE', value=0, type=int)
+
+  # cache of person lookups: maximum number of entries, and seconds to keep
+  # people found and UIDs not found (0 to not cache them)
+  conf.add('LDAP_CACHE_SIZE', value=1000, type=int)
+  conf.add('LDAP_CACHE_TTL', value=300, type=int)
+  conf.add('LDAP_CACHE_NEGATIVE_TTL', value=60, type=int)
+
   # determine configuration file
   def_conf_file = os.path.join(path, f'{codename}.conf')
   if not os.path.exists(def_conf_file):
@@ -1,10 +1,16 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
-from flask import Blueprint, render_template, url_for, session, redirect
+from flask import (
+  Blueprint, current_app, render_template, url_for, session, redirect
+)
 from .db import get_db
-from .auth import login_optional
-from .access import evaluate_access
+from .auth import login_optional, get_rights
+from .catalogue import (
+  get_catalogue, get_catalogue_version, get_visible_services
+)
+from .cache import LruCache
+from .statements import register_statement
 
 bp = Blueprint('dashboard', __name__)
 
@@ -13,70 +19,90 @@ bp = Blueprint('dashboard', __name__)
 # ---------------------------------------------------------------------------
 
 SQL_GET_ALL_UNAUTHENTICATED = '''
-  SELECT    category, service, title, description, url, icon_url, sso
+  SELECT    category, service, title, description, url,
+            NULLIF(icon_url, '') AS icon_url, sso
   FROM      all_services
   WHERE     language = ? AND access IS NULL
 '''
 
-SQL_GET_ALL = '''
-  SELECT    category, service, title, description, access, url, icon_url, sso
-  FROM      all_services
-  WHERE     language = ?
-'''
+STMT_GET_ALL_UNAUTHENTICATED = register_statement(
+  'get_public_services', SQL_GET_ALL_UNAUTHENTICATED, ('en',))
 
 # ---------------------------------------------------------------------------
 #                                                                   helpers
 # ---------------------------------------------------------------------------
 
-def _get_services_itor_auth(language):
-
-  res = get_db().execute(SQL_GET_ALL, (language,)).fetchall()
-
-  # if user is defined in session, we need to make the access decisions
-  # be nice if there was a library to do this officially
-  for rec in res:
-    restriction = rec['access']
-    if restriction:
-      # TODO: if access not match entitlements, affiliations, etc.
-      # if access not match:
-      #   next or continue or whatever
-      if not evaluate_access(restriction, session['access']):
-        continue
-    yield rec
+# Most users share one of relatively few combinations of access rights, so the
+# final, categorized listing of services is shared between users with the
+# same rights.  Entries are keyed on the catalogue version they were built
+# from, the fingerprint of the rights and the language, and are all discarded
+# when the catalogue version changes.  The version is part of the key so that
+# a listing built while the catalogue changed is never taken for one of the
+# new version.
+SERVICES_CACHE_SIZE = 256
+_services_cache = LruCache(SERVICES_CACHE_SIZE)
+
+# cache key used for sessions without a logged-in user
+ANONYMOUS = 'anonymous'
+
+# marker for listings not in the cache, since None is a valid listing
+_uncached = object()
+
+def _get_services_itor_auth(language, version=None):
+
+  # if user is defined in session, we need to make the access decisions,
+  # either in the database or with the catalogue's access index, which only
+  # evaluates services the user could possibly have access to
+  if current_app.config.get('ACCESS_FILTER') == 'sql':
+    yield from get_visible_services(language, get_rights())
+  else:
+    yield from get_catalogue(language, version).visible(get_rights())
 
 def _get_services_itor_anon(language):
 
-  res = get_db().execute(SQL_GET_ALL_UNAUTHENTICATED, (language,)).fetchall()
-  for rec in res:
-    yield rec
-
-def _get_services():
+  yield from get_db(readonly=True).execute_statement(
+    STMT_GET_ALL_UNAUTHENTICATED, (language,))
 
-  # TODO: get language from browser, user record, preferences
-  # TODO: log and/or flash if LDAP record doesn't match browser
-  language = 'en'
+# TODO: get language from browser, user record, preferences
+# TODO: log and/or flash if LDAP record doesn't match browser
+def _get_services(language='en'):
 
-  # get iterator appropriate for type of access
+  # check for listing already computed for users with the same rights
+  version = get_catalogue_version()
+  _services_cache.validate(version)
   if 'uid' in session:
-    services = _get_services_itor_auth(language)
+    key = (version, get_rights().fingerprint(), language)
   else:
-    services = _get_services_itor_anon(language)
+    key = (version, ANONYMOUS, language)
+  categories = _services_cache.get(key, _uncached)
+  if categories is _uncached:
+
+    # get iterator appropriate for type of access
+    if 'uid' in session:
+      services = _get_services_itor_auth(language, version)
+    else:
+      services = _get_services_itor_anon(language)
+
+    categories = _categorize(services)
+    _services_cache.put(key, categories)
+  return categories
+
+def _categorize(services):
 
-  # we assume that the all_services view orders by category
+  # we assume that the all_services view orders by category; rows are used
+  # as is, being read-only and subscriptable by name with either database
   # pylint: disable=unsubscriptable-object
   categories = None
   for rec in services:
     if categories is None:
       categories = []
       categories.append((rec['category'], []))
-      categories[0][1].append(dict(rec))
+      categories[0][1].append(rec)
     elif categories[-1][0] == rec['category']:
-      categories[-1][1].append(dict(rec))
+      categories[-1][1].append(rec)
     else:
       categories.append((rec['category'], []))
-      categories[-1][1].append(dict(rec))
-    if not categories[-1][1][-1].get('icon_url'):
-      categories[-1][1][-1]['icon_url'] = None
+      categories[-1][1].append(rec)
   return categories
 
 # ---------------------------------------------------------------------------
@@ -3,13 +3,19 @@
 # NOTE: "assigning-non-slot" test is broken in Pylint; can remove when
 #       https://github.com/PyCQA/pylint/issues/3793 resolved
 #
+import contextlib
+import functools
 import os
 from enum import Enum
 import re
+import threading
 import click
-from flask import current_app, g
+from flask import current_app, g, has_app_context
 from flask.cli import with_appcontext
 from drax.log import get_log
+from drax.pool import Pool
+from drax.replicas import Replicas
+from drax.statements import register_statement, get_statements
 from drax import exceptions
 
 # Current database schema version
@@ -19,7 +25,7 @@ from drax import exceptions
 # or an upgrade should be performed.
 #
 # See README in SQL scripts dir for guidance on updating the schema.
-SCHEMA_VERSION = '20211005'
+SCHEMA_VERSION = '20261021'
 
 # query to fetch latest schema version
 SQL_GET_SCHEMA_VERSION = """
@@ -28,6 +34,8 @@ SQL_GET_SCHEMA_VERSION = """
   ORDER BY  version DESC
   LIMIT     1
 """
+STMT_GET_SCHEMA_VERSION = register_statement(
+  'get_schema_version', SQL_GET_SCHEMA_VERSION)
 
 # scripts path
 SQL_SCRIPTS_DIR = 'sql'
@@ -39,27 +47,223 @@ _register_adapters_for = []
 def queue_adapter_registration(cls):
   _register_adapters_for.append(cls)
 
-def get_db():
+# Connection pools, by URI.  Pooling is used for Postgres when configured with
+# a nonzero DATABASE_POOL_SIZE; SQLite connections are cheap to open and are
+# not to be shared between threads.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(uri):
+  """
+  Retrieve connection pool for the given database URI, creating it if
+  necessary, or None if connections to this database are not pooled.
+  """
+  config = current_app.config
+  if not config.get('DATABASE_POOL_SIZE') or not uri.startswith('postgresql:'):
+    return None
+
+  with _pools_lock:
+    pool = _pools.get(uri)
+    if pool is None:
+      from .db_postgres import check_connection, reset_connection
+      pool = Pool(
+        lambda: open_db(uri),
+        config['DATABASE_POOL_SIZE'],
+        timeout=config.get('DATABASE_POOL_TIMEOUT'),
+        max_lifetime=config.get('DATABASE_POOL_MAX_LIFETIME'),
+        check=check_connection,
+        check_idle=config.get('DATABASE_POOL_CHECK_IDLE') or 0,
+        reset=reset_connection
+      )
+      _pools[uri] = pool
+  return pool
+
+def _redact(uri):
+  """
+  Remove credentials from URI, for reporting.
+  """
+  return re.sub(r'//[^@/]*@', '//', uri)
+
+def get_pool_stats():
+  """
+  Report statistics for each connection pool, by URI (without credentials).
+  """
+  return {_redact(uri): pool.stats() for (uri, pool) in _pools.items()}
+
+# Long-lived read-only SQLite connections, one per thread and URI, used when
+# the SQLite profile calls for shared readers.  Readers opened before the
+# database was last initialized or upgraded are closed and replaced when
+# next used.
+_readers = threading.local()
+_readers_generation = 0
+
+def invalidate_readers():
+  """
+  Have each thread replace its read-only connections when next used, such as
+  after the schema has been recreated.
+  """
+  # pylint: disable=global-statement
+  global _readers_generation
+  with _pools_lock:
+    _readers_generation += 1
+
+def _get_reader(uri):
+  """
+  Retrieve this thread's read-only connection to the given database URI,
+  opening it if necessary, or None if read-only connections are not kept for
+  this database.
+  """
+  if not uri.startswith('file:') or ':memory:' in uri or 'mode=memory' in uri:
+    return None
+
+  from .db_sqlite import get_profile
+  if not get_profile(current_app.config.get('SQLITE_PROFILE'))['shared_readers']:
+    return None
+
+  readers = getattr(_readers, 'connections', None)
+  if readers is None or _readers.generation != _readers_generation:
+    for reader in (readers or {}).values():
+      reader.close()
+    readers = _readers.connections = {}
+    _readers.generation = _readers_generation
+  reader = readers.get(uri)
+  if reader is None:
+    reader = open_db(uri, readonly=True)
+    readers[uri] = reader
+  return reader
+
+# Read replicas, by list of URIs.  Read-only callers are directed to the
+# replicas given by DATABASE_REPLICA_URIS in turn, skipping any which could
+# not be connected to recently, and to the primary if none is available.
+_replicas = {}
+
+def _get_replicas():
+  """
+  Retrieve replica selector for the configured replicas, creating it if
+  necessary, or None if there are no replicas.
+  """
+  config = current_app.config
+  uris = config.get('DATABASE_REPLICA_URIS')
+  if not uris:
+    return None
+  if isinstance(uris, str):
+    uris = re.split(r'[,\s]+', uris.strip())
+  key = tuple(uris)
+
+  with _pools_lock:
+    replicas = _replicas.get(key)
+    if replicas is None:
+      replicas = Replicas(key, retry_after=config.get('DATABASE_REPLICA_RETRY', 30))
+      _replicas[key] = replicas
+  return replicas
+
+def get_replica_stats():
+  """
+  Report statistics for the configured replicas (without credentials).
   """
-  Retrieve application's database object, initializing if necessary.
+  replicas = _get_replicas()
+  if replicas is None:
+    return {}
+  stats = replicas.stats()
+  stats['replicas'] = {
+    _redact(uri): replica for (uri, replica) in stats['replicas'].items()
+  }
+  return stats
+
+def _close(conn):
+  conn.close()
+
+def _connect(uri, readonly=False):
   """
+  Get connection to the given database for use in the application context.
+  Returns the connection and the function to call with it once done: if
+  connections are pooled, one is borrowed from the pool, and for read-only
+  use a shared connection may be returned, in which case the function is
+  None.
+  """
+  if readonly:
+    reader = _get_reader(uri)
+    if reader:
+      return (reader, None)
+
+  pool = _get_pool(uri)
+  if pool:
+    try:
+      return (pool.acquire(), pool.release)
+    except exceptions.PoolTimeout as e:
+      get_log().error("Could not get database connection: %s", e)
+      raise exceptions.DatabaseException(str(e)) from e
+
+  return (open_db(uri, readonly=readonly), _close)
+
+def _get_replica_db():
+  """
+  Retrieve connection to a replica for the application context, or None if
+  there are no replicas or none are available.
+  """
+  if 'db_replica' in g:
+    return g.db_replica
+
+  replicas = _get_replicas()
+  if replicas is None:
+    return None
+
+  for uri in replicas.candidates():
+    try:
+      (g.db_replica, g.db_replica_release) = _connect(uri, readonly=True)
+    # pylint: disable=broad-except
+    except Exception as e:
+      get_log().warning("Database replica %s unavailable: %s", _redact(uri), e)
+      replicas.failed(uri)
+      continue
+    replicas.succeeded(uri)
+    return g.db_replica
+
+  get_log().debug("No database replica available; reading from primary")
+  replicas.fell_back()
+  return None
+
+def get_db(readonly=False):
+  """
+  Retrieve application's database object, initializing if necessary.  If
+  connections are pooled, one is borrowed from the pool for the duration of
+  the application context.
+
+  Callers which only read may set `readonly`, in which case a connection to
+  a read replica, or one reserved for reading, may be returned if the
+  database is so configured.  If the application context already has a
+  connection to the primary, that is returned so that reads are consistent
+  with writes made in the same context.  Writes, schema upgrades and anything
+  needing up-to-date data must use the primary.
+  """
+
+  uri = current_app.config['DATABASE_URI']
+  if readonly and 'db' not in g:
+    replica = _get_replica_db()
+    if replica:
+      return replica
+    reader = _get_reader(uri)
+    if reader:
+      return reader
 
   if 'db' not in g:
-    g.db = open_db(current_app.config['DATABASE_URI'])
+    (g.db, g.db_release) = _connect(uri)
 
   return g.db
 
 
-def open_db(uri):
+def open_db(uri, readonly=False):
   """
   Open database connection for appropriate database type based on URI and
-  return the connection handle.
+  return the connection handle.  For SQLite, the connection is configured
+  according to the application's SQLITE_PROFILE, and may be opened read-only.
   """
   scheme = uri.split(':', 1)[0]
 
   if scheme == 'file':
     from .db_sqlite import open_db_sqlite, register_adapter
-    db = open_db_sqlite(uri)
+    profile = current_app.config.get('SQLITE_PROFILE') if has_app_context() else None
+    db = open_db_sqlite(uri, profile, readonly)
 
   elif scheme == 'postgresql':
     from .db_postgres import open_db_postgres, register_adapter
@@ -77,12 +281,17 @@ def open_db(uri):
 
 def close_db(e=None):
   db = g.pop('db', None)
+  release = g.pop('db_release', None)
+  replica = g.pop('db_replica', None)
+  replica_release = g.pop('db_replica_release', None)
 
   if e:
     get_log().info("Closing database in presence of error condition: '%s'", e)
 
-  if db is not None:
-    db.close()
+  if db is not None and release:
+    release(db)
+  if replica is not None and replica_release:
+    replica_release(replica)
 
 
 def init_db(schema=None):
@@ -100,15 +309,36 @@ def init_db(schema=None):
     db.executescript(f.read().decode('utf8'))
 
   db.commit()
+  invalidate_readers()
 
 
 def seed_db(seedfile):
+  from .catalogue import check_catalogue, SQL_DEFER_REFRESH, SQL_REFRESH
+
   db = get_db()
 
   get_log().info("Seeding database with %s", seedfile)
 
   with current_app.open_resource(seedfile) as f:
-    db.executescript(f.read().decode('utf8'))
+    script = f.read().decode('utf8')
+
+  # SQLite commits before running a script, so explicitly start transaction
+  # in order to be able to roll back.  On Postgres, refresh the catalogue
+  # once when done rather than after each statement
+  if db.type == 'sqlite':
+    script = f"BEGIN;\n{script}"
+  else:
+    script = f"{SQL_DEFER_REFRESH};\n{script}"
+  db.executescript(script)
+  if db.type == 'postgres':
+    db.execute(SQL_REFRESH)
+
+  # reject catalogue with invalid entries
+  try:
+    check_catalogue()
+  except exceptions.InvalidCatalogue:
+    db.rollback()
+    raise
 
   db.commit()
 
@@ -116,7 +346,7 @@ def seed_db(seedfile):
 def get_schema_version():
   db = get_db()
   try:
-    vers = db.execute(SQL_GET_SCHEMA_VERSION).fetchone()['version']
+    vers = db.execute_statement(STMT_GET_SCHEMA_VERSION).fetchone()['version']
   except Exception as e:
     get_log().error("Error in retrieving schema version: %s", e)
     raise exceptions.DatabaseException("Could not retrieve schema version") from e
@@ -126,33 +356,25 @@ def get_schema_version():
   return (vers, SCHEMA_VERSION)
 
 
-def upgrade_schema(data_updates=None):
-  (actual, expected) = get_schema_version()
-  if actual == expected:
-    # trivial: actual matches expected, no action needed
-    return (actual, expected, None)
-
-  get_log().info("DB schema is at version %s; app expects %s", actual, expected)
-
-  ## Find upgrade path.  Scripts are "${from}_to_${to}.[sql|psql]".  Might need
-  ## to run several, such as if there is ${from}_to_int1.sql, int1_to_${to}.sql
-  ## for example.
+# Lock taken while upgrading the schema so that processes starting at the
+# same time don't run the same upgrades.  On Postgres this is an advisory lock
+# with this key; on SQLite the upgrade runs in an exclusive transaction.
+SCHEMA_LOCK_ID = 0x64726178
 
-  ## Build dictionary of upgrade scripts keyed on their starting versions.
-  ## Values are the ending version and the filename.
+@functools.lru_cache(maxsize=None)
+def _find_upgrade_scripts(path, ext):
+  """
+  Build dictionary of upgrade scripts in the given directory keyed on their
+  starting versions.  Values are the ending version and the filename.
+  Scripts are "${from}_to_${to}.[sql|psql]".  The scripts don't change while
+  the application runs so the directory is only read once.
+  """
   scriptdict = {}
-
-  # build regular expression for matching upgrade scripts
-  db = get_db()
-  if db.type == 'sqlite':
-    ext = 'sql'
-  elif db.type == 'postgres':
-    ext = 'psql'
   regex = re.compile(rf'^([^_]+)_to_([^_]+)\.{ext}$')
 
   # iterate through each file and if it's an update script add it to dict
   # pylint: disable=unused-variable
-  for root, dirs, files in os.walk(current_app.root_path + '/' + SQL_SCRIPTS_DIR):
+  for root, dirs, files in os.walk(path):
     for file in files:
       m = regex.match(file)
       if m:
@@ -160,12 +382,21 @@ def upgrade_schema(data_updates=None):
           # this should not happen
           description = 'Multiple upgrade scripts have the same starting ' \
             'version.  This is not supported and leaves no clear upgrade ' \
-            f'path.  In conflict: {scriptdict[m[1]][1]} and {file}.  Trying ' \
-            f'to upgrade schema from {actual} to {expected}'
+            f'path.  In conflict: {scriptdict[m[1]][1]} and {file}.'
           raise exceptions.ImpossibleSchemaUpgrade(description)
         scriptdict[m[1]] = (m[2], f"{root}/{file}")
+  return scriptdict
+
+@functools.lru_cache(maxsize=None)
+def plan_upgrade(path, ext, actual, expected):
+  """
+  Find path through upgrade scripts from the actual schema version to the
+  expected one.  Might need to run several, such as if there is
+  ${from}_to_int1.sql, int1_to_${to}.sql for example.  Returns dictionary of
+  scripts keyed on the version they upgrade to.  Plans are cached.
+  """
+  scriptdict = _find_upgrade_scripts(path, ext)
 
-  # find path through upgrades from actual to expected
   have_upgrade_path = False
   upgrades = {}
   current = str(actual)
@@ -180,26 +411,106 @@ def upgrade_schema(data_updates=None):
     # this is a pretty serious application error
     description = \
       f'There is no upgrade path available from schema version {actual} (in ' \
-      'the database) to {expected} (expected by the application). ' \
-      'Available upgrades: {upgrades}'
+      f'the database) to {expected} (expected by the application). ' \
+      f'Available upgrades: {upgrades}'
     raise exceptions.ImpossibleSchemaUpgrade(description)
 
-  # add in the data upgrade scripts, if any
-  if data_updates:
-    for (version, path) in data_updates.items():
-      upgrades[version] = path
+  return upgrades
+
+@contextlib.contextmanager
+def _schema_lock(db):
+  """
+  Hold lock on schema upgrades for the duration of the context, which runs in
+  a single transaction, committed when the context exits or rolled back if it
+  raises.  On SQLite the transaction is an exclusive one, so any transaction
+  already open on the connection is committed first; on Postgres the advisory
+  lock is released once the transaction is over.
+  """
+  if db.type == 'sqlite':
+    if db.in_transaction:
+      db.commit()
+    db.execute("BEGIN EXCLUSIVE")
+    try:
+      yield
+    except BaseException:
+      db.rollback()
+      raise
+    db.commit()
+
+  else:
+    db.execute("SELECT pg_advisory_lock(?)", (SCHEMA_LOCK_ID,))
+    try:
+      yield
+    except BaseException:
+      db.rollback()
+      raise
+    else:
+      db.commit()
+    finally:
+      db.execute("SELECT pg_advisory_unlock(?)", (SCHEMA_LOCK_ID,))
+      db.commit()
+
+def _run_script(db, script):
+  """
+  Run upgrade script within the transaction holding the schema lock.  On
+  SQLite, statements are run one by one since executescript() would commit
+  the transaction.
+  """
+  if db.type == 'sqlite':
+    from .db_sqlite import split_script
+    for statement in split_script(script):
+      db.execute(statement)
+  else:
+    db.executescript(script)
+
+def upgrade_schema(data_updates=None):
+  (actual, expected) = get_schema_version()
+  if actual == expected:
+    # trivial: actual matches expected, no action needed
+    return (actual, expected, None)
+
+  db = get_db()
+  if db.type == 'sqlite':
+    ext = 'sql'
+  elif db.type == 'postgres':
+    ext = 'psql'
+  path = current_app.root_path + '/' + SQL_SCRIPTS_DIR
 
-  # iterate through upgrade scripts
   actions = []
-  for version in sorted(upgrades):
-    upgrade = upgrades[version]
-    with current_app.open_resource(upgrade) as f:
-      get_log().info("Upgrading DB: %s (version %s)", upgrade, version)
-      db.executescript(f.read().decode('utf8'))
-    actions.append(f"Executed {upgrade}")
+  with _schema_lock(db):
+
+    # another process may have upgraded the schema while we waited for the lock
+    (actual, expected) = get_schema_version()
+    if actual == expected:
+      get_log().info("DB schema was upgraded to %s by another process", actual)
+      return (actual, expected, None)
+
+    get_log().info("DB schema is at version %s; app expects %s", actual, expected)
+    upgrades = dict(plan_upgrade(path, ext, actual, expected))
+
+    # add in the data upgrade scripts, if any
+    if data_updates:
+      for (version, script) in data_updates.items():
+        upgrades[version] = script
+
+    # iterate through upgrade scripts
+    for version in sorted(upgrades):
+      upgrade = upgrades[version]
+      with current_app.open_resource(upgrade) as f:
+        get_log().info("Upgrading DB: %s (version %s)", upgrade, version)
+        _run_script(db, f.read().decode('utf8'))
+      actions.append(f"Executed {upgrade}")
 
-    db.commit()
   get_log().info("Upgraded DB.")
+  invalidate_readers()
+
+  # statements prepared before the upgrade may no longer match the schema, on
+  # this connection or any other in the pool
+  if db.type == 'postgres':
+    db.deallocate_statements()
+    pool = _get_pool(current_app.config['DATABASE_URI'])
+    if pool:
+      pool.invalidate()
 
   return (actual, expected, actions)
 
@@ -223,11 +534,42 @@ def seed_db_command(seedfile):
     directory.
   """
 
+  from .catalogue import refresh_access_rules
+
   init_db()
-  seed_db(os.path.join(os.getcwd(), seedfile))
+  try:
+    seed_db(os.path.join(os.getcwd(), seedfile))
+  except exceptions.InvalidCatalogue as e:
+    raise click.ClickException(str(e))
+  refresh_access_rules()
   click.echo('Initialized and seeded the database.')
 
 
+@click.command('explain-statements')
+@with_appcontext
+def explain_statements_command():
+  """
+  Report planning and execution times of registered statements, ad hoc and
+  prepared (Postgres only).
+  """
+  db = get_db()
+  if db.type != 'postgres':
+    raise click.ClickException(
+      "Only supported for Postgres; SQLite does not report planning time")
+
+  for statement in sorted(get_statements(), key=lambda s: s.name):
+    timings = db.explain_statement(statement.name)
+    line = [f"{statement.name}:"]
+    for (mode, timing) in timings.items():
+      total = timing['planning'] + timing['execution']
+      share = timing['planning'] / total if total else 0.0
+      line.append(
+        f"{mode} planning {timing['planning']:.3f}ms "
+        f"execution {timing['execution']:.3f}ms ({share:.0%} planning)")
+    click.echo(' '.join(line))
+  db.rollback()
+
+
 @click.command('upgrade-db')
 @with_appcontext
 def upgrade_db_command():
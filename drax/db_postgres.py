@@ -1,67 +1,289 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+import functools
+import itertools
+import time
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
+from .db_sqlite import REWRITE_CACHE_SIZE, split_query
+from .querystats import record_query
+from .statements import get_statement
+
+# for naming server-side cursors uniquely
+_cursor_ids = itertools.count()
 
 
 def register_adapter(target):
   psycopg2.extensions.register_adapter(target, target)
 
 
+class Row:
+  """
+  Lightweight result row, similar to sqlite3.Row: fields may be subscripted
+  by name or by position, iteration gives the values, and keys() gives the
+  column names.  The mapping of column names to positions is shared by all
+  rows of a result set, so each row holds only its values.
+  """
+
+  __slots__ = ('_values', '_index')
+
+  def __init__(self, values, index):
+    self._values = values
+    self._index = index
+
+  def __getitem__(self, key):
+    try:
+      return self._values[self._index[key]]
+    except KeyError:
+      if isinstance(key, str):
+        raise IndexError(f"No item with key '{key}'") from None
+      return self._values[key]
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __eq__(self, other):
+    if isinstance(other, Row):
+      return self._values == other._values and self.keys() == other.keys()
+    return NotImplemented
+
+  def __hash__(self):
+    return hash(self._values)
+
+  def __repr__(self):
+    return f"Row({dict(zip(self.keys(), self._values))!r})"
+
+  def keys(self):
+    return list(self._index)
+
+
 class DictCursor(psycopg2.extensions.cursor):
   """
   Custom cursor factory to provide name-subscriptable fields, similar to that
-  provided by SQLite3 by default.  It may be slightly more efficient to use
-  numerical subscripts, but this is self-documenting in the code.
+  provided by SQLite3 by default.  Rows are returned as Row objects, with the
+  column names resolved once per result set.
   """
 
+  # description of the result set the column index was built for, and index
+  _indexed = None
+  _column_index = None
+
+  def execute(self, query, vars=None):
+    # pylint: disable=redefined-builtin
+    self._indexed = None
+    return super().execute(query, vars)
+
+  def _index(self):
+    description = self.description
+    if description is not self._indexed:
+      self._column_index = {column.name: i for (i, column) in enumerate(description)}
+      self._indexed = description
+    return self._column_index
+
   def fetchone(self):
     tup = super().fetchone()
     if tup:
-      return {self.description[x].name: tup[x] for x in range(0, len(tup))}
+      return Row(tup, self._index())
     return None
 
+  def fetchmany(self, size=None):
+    tups = super().fetchmany(self.arraysize if size is None else size)
+    if not tups:
+      return []
+    index = self._index()
+    return [Row(tup, index) for tup in tups]
+
   def fetchall(self):
-    tup = super().fetchall()
-    if tup:
-      numcols = len(tup[0])
-      numrows = len(tup)
-      return [
-        {
-          self.description[y].name: tup[x][y] for y in range(0, numcols)
-        } for x in range(0, numrows)
-      ]
-    return None
+    tups = super().fetchall()
+    if not tups:
+      return []
+    index = self._index()
+    return [Row(tup, index) for tup in tups]
+
+  def __iter__(self):
+    # the base class iterates without going through the fetch methods; fetch
+    # in batches of itersize rows (as named cursors do) rather than the
+    # default arraysize of one
+    while True:
+      rows = self.fetchmany(self.itersize)
+      if not rows:
+        return
+      yield from rows
+
+@functools.lru_cache(maxsize=REWRITE_CACHE_SIZE)
+def _split_query(sql):
+  return tuple(split_query(sql))
+
+def convert_query(sql, parameters):
+  """
+  Convert query placeholders from SQLite style ("?") to Postgres style and,
+  as with the SQLite connection class, expand the placeholder for each list or
+  tuple parameter into one placeholder per element.  An empty list becomes
+  NULL, so for example "IN (?)" is never true rather than a syntax error.
+  Question marks in quoted strings are left alone.
+  """
+  parts = _split_query(sql)
+  if not parameters or not any(isinstance(p, (list, tuple)) for p in parameters):
+    return ('%s'.join(parts), parameters)
+
+  newsql = parts[0]
+  converted = []
+  for (p, part) in zip(parameters, parts[1:]):
+    if isinstance(p, (list, tuple)):
+      newsql += ','.join(['%s'] * len(p)) if p else 'NULL'
+      converted.extend(p)
+    else:
+      newsql += '%s'
+      converted.append(p)
+    newsql += part
+  return (newsql, converted)
 
 class ExtConnection(psycopg2.extensions.connection):
   """
   Custom connection class which reports its type and provides shortcuts to
   query execution methods provided in the cursor object, in order to normalize
-  to what is provided by SQLite3.
+  to what is provided by SQLite3, including the expansion of list and tuple
+  query parameters.
   """
 
   type = 'postgres'
 
+  # default number of rows fetched at a time when iterating over results
+  batch_size = 500
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+
+    # names of statements prepared in this session
+    self._prepared = set()
+
   def execute(self, sql, parameters=None):
+    start = time.perf_counter()
+    cursor = self.cursor()
+    cursor.execute(*convert_query(sql, parameters))
+    record_query(sql, time.perf_counter() - start, cursor.rowcount)
+    return cursor
+
+  def iterate(self, sql, parameters=None, batch_size=None):
+    """
+    Execute query and generate result rows, fetched in batches from a named
+    (server-side) cursor, so that large results are not held in memory.
+    Server-side cursors only exist within a transaction, so results must be
+    consumed before the transaction is committed or rolled back.
+    """
+    batch_size = batch_size or self.batch_size
+    cursor = self.cursor(name=f'drax_iter_{next(_cursor_ids)}')
+    cursor.itersize = batch_size
+
+    # the query runs as rows are fetched, so time spent fetching is counted
+    elapsed = 0.0
+    count = 0
+    try:
+      start = time.perf_counter()
+      cursor.execute(*convert_query(sql, parameters))
+      elapsed += time.perf_counter() - start
+      while True:
+        start = time.perf_counter()
+        rows = cursor.fetchmany(batch_size)
+        elapsed += time.perf_counter() - start
+        if not rows:
+          break
+        count += len(rows)
+        yield from rows
+    finally:
+      cursor.close()
+      record_query(sql, elapsed, count)
+
+  def execute_statement(self, name, parameters=None):
+    """
+    Execute registered statement, preparing it first if it has not yet been
+    prepared on this connection.  Prepared statements last for the session
+    and are unaffected by transactions being rolled back.
+    """
+    statement = get_statement(name)
+    statement.check_parameters(parameters)
     cursor = self.cursor()
-    cursor.execute(sql.replace('?', '%s'), parameters)
+    if name not in self._prepared:
+      start = time.perf_counter()
+      cursor.execute(f"PREPARE {name} AS {statement.psql}")
+      statement.record_prepare(time.perf_counter() - start)
+      self._prepared.add(name)
+
+    start = time.perf_counter()
+    if parameters:
+      placeholders = ','.join(['%s'] * len(parameters))
+      cursor.execute(f"EXECUTE {name} ({placeholders})", parameters)
+    else:
+      cursor.execute(f"EXECUTE {name}")
+    elapsed = time.perf_counter() - start
+    statement.record_execute(elapsed)
+    record_query(statement.sql, elapsed, cursor.rowcount)
     return cursor
 
+  def deallocate_statements(self):
+    """
+    Discard statements prepared on this connection, such as when the schema
+    has changed from under them.
+    """
+    self.cursor().execute("DEALLOCATE ALL")
+    self._prepared.clear()
+
+  def explain_statement(self, name, parameters=None):
+    """
+    Report planning and execution times, in milliseconds, of the registered
+    statement when run as an ad hoc query and when run as a prepared
+    statement, as reported by EXPLAIN ANALYZE.  This runs the query.
+    """
+    statement = get_statement(name)
+    if parameters is None:
+      parameters = statement.example
+    statement.check_parameters(parameters)
+
+    def explain(sql, parameters):
+      cursor = self.cursor()
+      cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", parameters)
+      plan = cursor.fetchone()[0][0]
+      return {
+        'planning': plan['Planning Time'],
+        'execution': plan['Execution Time'],
+      }
+
+    # run prepared statement twice so that planning on first use by this
+    # connection isn't counted
+    timings = {'adhoc': explain(*convert_query(statement.sql, parameters))}
+    self.execute_statement(name, parameters)
+    args = f" ({','.join(['%s'] * len(parameters))})" if parameters else ''
+    timings['prepared'] = explain(f"EXECUTE {name}{args}", parameters or None)
+    return timings
+
   def executemany(self, sql, seq):
+    start = time.perf_counter()
     cursor = self.cursor()
-    cursor.executemany(sql.replace('?', '%s'), seq)
+
+    # send statements in pages rather than one round trip each
+    psycopg2.extras.execute_batch(cursor, '%s'.join(_split_query(sql)), seq,
+                                  page_size=self.batch_size)
+    record_query(sql, time.perf_counter() - start, cursor.rowcount)
     return cursor
 
   def executescript(self, sql):
+    start = time.perf_counter()
     cursor = self.cursor()
     cursor.execute(sql)
+    record_query(sql, time.perf_counter() - start)
     return cursor
 
   def insert_returning_id(self, sql, parameters):
+    start = time.perf_counter()
     cursor = self.cursor()
-    updated_sql = sql.replace('?', '%s') + ' RETURNING id'
+    updated_sql = '%s'.join(_split_query(sql)) + ' RETURNING id'
     cursor.execute(updated_sql, parameters)
+    record_query(sql, time.perf_counter() - start, cursor.rowcount)
     return cursor.fetchone()['id']
 
 
@@ -70,3 +292,27 @@ def open_db_postgres(uri):
                         connection_factory=ExtConnection,
                         cursor_factory=DictCursor)
   return db
+
+
+def check_connection(db):
+  """
+  Check that pooled connection is still usable.
+  """
+  if db.closed:
+    return False
+  try:
+    db.cursor().execute('SELECT 1')
+    db.rollback()
+  except psycopg2.Error:
+    return False
+  return True
+
+
+def reset_connection(db):
+  """
+  Reset pooled connection for reuse, abandoning any transaction in progress.
+  Raises an exception if the connection is no longer usable.
+  """
+  if db.closed:
+    raise psycopg2.InterfaceError("connection already closed")
+  db.rollback()
@@ -2,64 +2,112 @@
 # pylint:
 #
 from enum import Enum
+import functools
 import re
 import sqlite3
+import time
 from .exceptions import DatabaseException
+from .querystats import record_query
+from .statements import get_statement
 
 
 def register_adapter(target):
   sqlite3.register_adapter(target, target.__str__)
 
 
-def iter_flatten(iterable):
+# RE for finding query parameter placeholders, skipping over quoted strings
+qparm_re = re.compile("'[^']*'|\\?")
+
+# maximum number of rewritten queries to keep
+REWRITE_CACHE_SIZE = 512
+
+# Connection profiles.  The default profile leaves SQLite's own settings,
+# which suit development.  The production profile uses write-ahead logging so
+# that readers and a writer don't block each other, only syncs to disk at
+# checkpoints, and gives each connection a larger page cache and memory-mapped
+# I/O.  With `shared_readers`, each thread keeps a long-lived read-only
+# connection which is reused across requests.  The busy timeout, in
+# milliseconds, is how long to wait for a lock before giving up.
+PROFILES = {
+  'default': {
+    'pragmas': {},
+    'busy_timeout': 5000,
+    'shared_readers': False,
+  },
+  'production': {
+    'pragmas': {
+      'journal_mode': 'wal',
+      'synchronous': 'normal',
+      'cache_size': -16384,
+      'mmap_size': 268435456,
+    },
+    'busy_timeout': 5000,
+    'shared_readers': True,
+  },
+}
+
+# pragmas which cannot be set on read-only connections
+WRITER_PRAGMAS = ('journal_mode',)
+
+def get_profile(name):
   """
-  Iterator for flattening a list or tuple.  Can be nested.
-
-  From http://rightfootin.blogspot.com/2006/09/more-on-python-flatten.html
+  Retrieve settings of connection profile by name, or the default profile if
+  none given.
   """
-  it = iter(iterable)
-  for e in it:
-    if isinstance(e, (list, tuple)):
-      for f in iter_flatten(e):
-        yield f
-    else:
-      yield e
+  try:
+    return PROFILES[name or 'default']
+  except KeyError:
+    raise DatabaseException(f"SQLite: No such connection profile: '{name}'") from None
 
-def flatten(t):
+def split_query(sql):
   """
-  Flatten a list or tuple and return a flat list.
+  Split an SQL query string into static tokens--essentially anything not a
+  query parameter placeholder ("?").  There is always one more token than
+  there are placeholders.
   """
-  return list(iter_flatten(t))
-
-def nextqparm(sql):
+  tokens = []
+  start = 0
+  for m in qparm_re.finditer(sql):
+    if m.group() == '?':
+      tokens.append(sql[start:m.start()])
+      start = m.end()
+  tokens.append(sql[start:])
+  return tokens
+
+@functools.lru_cache(maxsize=REWRITE_CACHE_SIZE)
+def rewrite_query(sql, shape):
   """
-  This generator tokenizes an SQL query string into static tokens--essentially
-  anything not a query parameter placeholder ("?").  This generator yields the
-  current non-placeholder token when either a placeholder occurs, or at the end
-  of the query string.  It is left to the caller to know (based on its
-  parameter list) when iteration is done.
+  Rewrite query for the given shape of parameters: a tuple with, for each
+  parameter, None for a scalar or the length of a list or tuple, which is
+  given as many placeholders.  Results are cached as the same queries are
+  used over and over with the same shapes of parameters.
   """
-
-  # RE for tokenizing query strings into everything not '?' token
-  regex = re.compile("((?:[^?']*(?:'[^']*')?)*)")
-
-  # iterate through regular expression matches
-  everythingelse = ''
-  for m in regex.finditer(sql):
-
-    # hit a query parameter placeholder?
-    if m.groups()[0] == '':
-
-      # give up the other stuff gathered so far and then clear it on return
-      yield everythingelse
-      everythingelse = ''
-
-    else:
-      everythingelse += m.groups()[0]
-
-  # nothing left to iterate, give up anything leftover before returning
-  if everythingelse != '':
-    yield everythingelse
+  tokens = split_query(sql)
+  if len(tokens) != len(shape) + 1:
+    raise DatabaseException(
+      f"SQLite: Query has {len(tokens) - 1} placeholders but {len(shape)} "
+      "parameters given")
+
+  newsql = [tokens[0]]
+  for (length, tok) in zip(shape, tokens[1:]):
+    newsql.append('?' if length is None else ','.join(['?'] * length))
+    newsql.append(tok)
+  return ''.join(newsql)
+
+def split_script(script):
+  """
+  Split SQL script into individual statements, for running one by one rather
+  than with executescript(), which commits any transaction in progress.
+  """
+  statements = []
+  current = ''
+  for piece in script.split(';'):
+    current += piece + ';'
+    if sqlite3.complete_statement(current):
+      if current.strip('; \t\n'):
+        statements.append(current)
+      current = ''
+  return statements
 
 class ExtConnection(sqlite3.Connection):
   """
@@ -72,54 +120,87 @@ class ExtConnection(sqlite3.Connection):
   # convenience for enabling other code to make decisions based on DB type
   type = 'sqlite'
 
+  # default number of rows fetched at a time when iterating over results
+  batch_size = 500
+
   def execute(self, sql, parameters=None):
     """
     Extend sqlite3.Connection.execute() in order to handle lists and tuples
     as query parameters.
     """
 
+    start = time.perf_counter()
     if parameters:
-      newsql = ''
 
-      # iterator breaks query string down into static tokens: points of
-      # separation indicate query parameters
-      qparms = nextqparm(sql)
-
-      # consume static tokens between query parameters
+      # convert parameters in one pass, noting which are sequences to be
+      # expanded into multiple placeholders
+      shape = []
       converted = []
+      expand = False
       for p in parameters:
-        newsql += next(qparms)
         if isinstance(p, (list, tuple)):
-          newsql += ','.join(['?'] * len(p))
+          shape.append(len(p))
+          converted.extend(p)
+          expand = True
         else:
-          newsql += '?'
+          shape.append(None)
 
-        # also check if this is a Enum
-        if issubclass(type(p), Enum):
-          converted.append(p.value)
-        else:
-          converted.append(p)
+          # also check if this is a Enum
+          converted.append(p.value if isinstance(p, Enum) else p)
+
+      newsql = rewrite_query(sql, tuple(shape)) if expand else sql
+      cursor = sqlite3.Connection.execute(self, newsql, converted)
+    else:
+      cursor = sqlite3.Connection.execute(self, sql)
 
-      # use up remaining string tokens
-      if __debug__:
-        # there should only be one; check this in test runs
-        gotone = False
-      for tok in qparms:
-        if __debug__:
-          if gotone:
-            raise DatabaseException("SQLite: Should not have any more qparms in token parsing")
-          gotone = True
-        newsql += tok
+    record_query(sql, time.perf_counter() - start, cursor.rowcount)
+    return cursor
 
-      return sqlite3.Connection.execute(self, newsql, flatten(converted))
+  def executemany(self, sql, seq):
+    start = time.perf_counter()
+    cursor = sqlite3.Connection.executemany(self, sql, seq)
+    record_query(sql, time.perf_counter() - start, cursor.rowcount)
+    return cursor
 
-    return sqlite3.Connection.execute(self, sql)
+  def executescript(self, sql):
+    start = time.perf_counter()
+    cursor = sqlite3.Connection.executescript(self, sql)
+    record_query(sql, time.perf_counter() - start)
+    return cursor
+
+  def iterate(self, sql, parameters=None, batch_size=None):
+    """
+    Execute query and generate result rows, fetched in batches as SQLite steps
+    through the query, so that large results are not held in memory.
+    """
+    batch_size = batch_size or self.batch_size
+    cursor = self.execute(sql, parameters)
+    try:
+      while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+          break
+        yield from rows
+    finally:
+      cursor.close()
+
+  def execute_statement(self, name, parameters=None):
+    """
+    Execute registered statement.  SQLite compiles the statement the first
+    time it is used on this connection and keeps it in its statement cache.
+    """
+    statement = get_statement(name)
+    statement.check_parameters(parameters)
+    start = time.perf_counter()
+    cursor = self.execute(statement.sql, parameters)
+    statement.record_execute(time.perf_counter() - start)
+    return cursor
 
   def insert_returning_id(self, sql, parameters):
     cursor = self.execute(sql, parameters)
     return cursor.lastrowid
 
-def open_db_sqlite(uri):
+def open_db_sqlite(uri, profile=None, readonly=False):
   """
   Open SQLite database connection.  Uses internal subclass of SQLite3's
   Connection class with a few extras.
@@ -131,9 +212,21 @@ def open_db_sqlite(uri):
   DB-API v2.
 
   For SQLite: support the use of lists or tuples in query parameters.
+
+  The connection is configured according to the named profile (see PROFILES)
+  and if `readonly` is set, is opened in read-only mode.
   """
 
-  db = ExtConnection(uri, uri=True)
+  settings = get_profile(profile)
+  if readonly:
+    uri += ('&' if '?' in uri else '?') + 'mode=ro'
+
+  db = ExtConnection(uri, uri=True, timeout=settings['busy_timeout'] / 1000)
   db.row_factory = sqlite3.Row
 
+  for (pragma, value) in settings['pragmas'].items():
+    if readonly and pragma in WRITER_PRAGMAS:
+      continue
+    db.execute(f"PRAGMA {pragma} = {value}")
+
   return db
@@ -52,6 +52,23 @@ class UnsupportedDatabase(AppException):
   def scheme(self):
     return self._scheme
 
+class PoolTimeout(AppException):
+  """
+  Exception raised when no pooled connection becomes available in time.
+  """
+
+class CircuitOpen(AppException):
+  """
+  Exception raised when a call is not made because the circuit breaker
+  guarding it is open.
+  """
+
+class CallTimeout(AppException):
+  """
+  Exception raised when a call guarded by a circuit breaker takes longer
+  than allowed.
+  """
+
 class DatabaseException(AppException):
   """
   Exception raised when some database exception occurs.
@@ -69,6 +86,46 @@ class LdapException(AppException):
   Exception raised when some LDAP issue occurs.
   """
 
+class LdapUnavailable(LdapException):
+  """
+  Exception raised when the directory cannot be reached or does not answer
+  in time.
+  """
+
+class AccessSyntaxError(AppException):
+  """
+  Exception raised when an access string cannot be parsed.
+
+  Attributes:
+    position: offset into the access string at which the error was found
+  """
+
+  def __init__(self, description, position=None):
+    self._position = position
+    super().__init__(description)
+
+  @property
+  def position(self):
+    return self._position
+
+class InvalidCatalogue(AppException):
+  """
+  Exception raised when the service catalogue contains invalid entries, such
+  as access strings which cannot be parsed.
+
+  Attributes:
+    errors: list of descriptions of individual problems
+  """
+
+  def __init__(self, errors):
+    self._errors = errors
+    description = "Invalid catalogue:\n" + "\n".join(errors)
+    super().__init__(description)
+
+  @property
+  def errors(self):
+    return self._errors
+
 class ImpossibleException(AppException):
   """
   Exception raised when something that should be impossible has occurred.
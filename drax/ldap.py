@@ -3,13 +3,26 @@
 # NOTE: "assigning-non-slot" test is broken in Pylint; can remove when
 #       https://github.com/PyCQA/pylint/issues/3793 resolved
 #
+import threading
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from flask import current_app, g
 from orgldap import orgldap
+from drax import people
+from drax.breaker import CircuitBreaker
+from drax.cache import TtlCache
+from drax.pool import Pool
 from drax.log import get_log
-from drax.exceptions import LdapException
+from drax.exceptions import (
+  CallTimeout, CircuitOpen, LdapException, LdapUnavailable, PoolTimeout)
 
-# LDAP options translation table
+def _timeout(seconds):
+  # python-ldap takes -1 for no timeout
+  return float(seconds) if seconds else -1.0
+
+# LDAP options translation table: option and either a table of values or a
+# function to convert the value
 _ldap_opts = {
   'LDAP_TLS_REQCERT': (
     ldap.OPT_X_TLS_REQUIRE_CERT,
@@ -19,9 +32,16 @@ _ldap_opts = {
       'try':    ldap.OPT_X_TLS_TRY,
       'demand': ldap.OPT_X_TLS_DEMAND
     }
-  )
+  ),
+  'LDAP_TIMEOUT': (ldap.OPT_TIMEOUT, _timeout),
+  'LDAP_NETWORK_TIMEOUT': (ldap.OPT_NETWORK_TIMEOUT, _timeout),
 }
 
+# configuration items for the app rather than the client library
+_app_opts = ('LDAP_BINDDN', 'LDAP_PASSWORD', 'LDAP_URI', 'LDAP_SKIP_TLS',
+             'LDAP_STUB', 'LDAP_PEOPLE_BASE', 'LDAP_CALL_TIMEOUT')
+_app_opt_prefixes = ('LDAP_CACHE_', 'LDAP_POOL_', 'LDAP_SYNC_', 'LDAP_BREAKER_')
+
 
 def _translate_options(config):
   """
@@ -37,14 +57,15 @@ def _translate_options(config):
 
   f = lambda x: (
     x.startswith('LDAP_')
-    and x not in ('LDAP_BINDDN', 'LDAP_PASSWORD', 'LDAP_URI', 'LDAP_SKIP_TLS',
-                  'LDAP_STUB')
+    and x not in _app_opts
+    and not x.startswith(_app_opt_prefixes)
   )
 
   options = {}
   try:
     for key in filter(f, config):
-      options[_ldap_opts[key][0]] = _ldap_opts[key][1][config[key]]
+      (option, values) = _ldap_opts[key]
+      options[option] = values(config[key]) if callable(values) else values[config[key]]
   except KeyError as e:
     # pylint: disable=raise-missing-from
     # ...because I don't want to have the traceback of this expected exception
@@ -53,42 +74,323 @@ def _translate_options(config):
   return options
 
 
-def get_ldap():
-  if 'ldap' not in g:
+class _Connection:
+  """
+  Bound connection to the directory, as kept in the pool.
+  """
+
+  def __init__(self, conn):
+    self.conn = conn
+
+  def close(self):
+    # On deletion of LDAPObject the connection is automatically unbound and
+    # closed, so no explicit close() message needs to be sent.
+    self.conn = None
+
+def _connect(config):
+  """
+  Open and bind a new connection to the directory.
+  """
+  options = _translate_options(config)
+  try:
+    binddn = config['LDAP_BINDDN']
+    bindpw = config['LDAP_PASSWORD']
+    uri = config['LDAP_URI']
+    skip_tls = config['LDAP_SKIP_TLS']
+    get_log().debug(
+      "Opening LDAP connection with binddn=%s, uri=%s, skip_tls=%s, options=%s",
+      binddn, uri, skip_tls, options)
+    ldapconn = orgldap.OrgLdap(
+      binddn, bindpw, uri, insecure_skip_tls=skip_tls, options=options)
+  except ldap.INVALID_CREDENTIALS as e:
+    get_log().critical('Could not connect to LDAP: invalid credentials')
+    get_log().debug(e)
+    raise LdapException("Invalid credentials") from e
+  except Exception as e:
+    get_log().critical('Could not connect to LDAP')
+    get_log().debug(e)
+    raise LdapUnavailable("Could not connect to LDAP server") from e
+
+  get_log().info("Opened connection to %s with bind DN %s", uri, binddn)
+  return _Connection(ldapconn)
+
+class _LdapPool(Pool):
+  """
+  Pool of bound connections, also counting the number of times a dropped
+  connection was replaced.
+  """
+
+  reconnects = 0
 
-    options = _translate_options(current_app.config)
+  def reconnected(self):
+    with self._lock:
+      self.reconnects += 1
 
+  def stats(self):
+    stats = super().stats()
+    stats['reconnects'] = self.reconnects
+    return stats
+
+_pool_lock = threading.Lock()
+
+def _get_pool():
+  """
+  Retrieve the application's pool of bound connections, created on first use
+  from its configuration and kept in its extensions.  Connections idle for
+  longer than LDAP_POOL_MAX_IDLE seconds are not reused, as the server may
+  have dropped them.
+  """
+  app = current_app._get_current_object()
+  with _pool_lock:
+    pool = app.extensions.get('ldap_pool')
+    if pool is None:
+      config = app.config
+      pool = _LdapPool(
+        lambda: _connect(config),
+        config.get('LDAP_POOL_SIZE', 10),
+        timeout=config.get('LDAP_POOL_TIMEOUT', 10),
+        max_lifetime=config.get('LDAP_POOL_MAX_LIFETIME', 3600),
+        max_idle=config.get('LDAP_POOL_MAX_IDLE', 300) or None
+      )
+      app.extensions['ldap_pool'] = pool
+    return pool
+
+class PooledLdap:
+  """
+  Directory connection for an application context, taken from the pool when
+  first used and given back when the context ends.  Calls are passed through
+  to the orgldap connection.  If the server has dropped the connection, it is
+  discarded and the call is retried once on a new one; connections whose
+  operation timed out are discarded as well.
+  """
+
+  def __init__(self, pool):
+    self._pool = pool
+    self._conn = None
+
+  def _acquire(self):
+    if self._conn is None:
+      try:
+        self._conn = self._pool.acquire()
+      except PoolTimeout as e:
+        get_log().error("Could not get LDAP connection: %s", e)
+        raise LdapUnavailable(str(e)) from e
+    return self._conn.conn
+
+  def _discard(self):
+    self._pool.release(self._conn, discard=True)
+    self._conn = None
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    def call(*args, **kwargs):
+      for retry in (False, True):
+        conn = self._acquire()
+        try:
+          return getattr(conn, name)(*args, **kwargs)
+        except ldap.SERVER_DOWN as e:
+          self._discard()
+          if retry:
+            raise LdapUnavailable("LDAP server unavailable") from e
+          get_log().warning("LDAP connection lost, reconnecting: %s", e)
+          self._pool.reconnected()
+        except ldap.TIMEOUT as e:
+          self._discard()
+          raise LdapUnavailable(f"LDAP operation timed out: {name}") from e
+      return None
+    return call
+
+  def release(self):
+    """
+    Give connection back to the pool.
+    """
+    if self._conn is not None:
+      self._pool.release(self._conn)
+      self._conn = None
+
+def get_ldap():
+  if 'ldap' not in g:
     if current_app.config.get('LDAP_STUB'):
       g.ldap = current_app.config['LDAP_STUB']
     else:
-      try:
-        binddn = current_app.config['LDAP_BINDDN']
-        bindpw = current_app.config['LDAP_PASSWORD']
-        uri = current_app.config['LDAP_URI']
-        skip_tls = current_app.config['LDAP_SKIP_TLS']
-        get_log().debug(
-          "Opening LDAP connection with binddn=%s, uri=%s, skip_tls=%s, options=%s",
-          binddn, uri, skip_tls, options)
-        ldapconn = orgldap.OrgLdap(
-          binddn, bindpw, uri, insecure_skip_tls=skip_tls, options=options)
-      except ldap.INVALID_CREDENTIALS as e:
-        get_log().critical('Could not connect to LDAP: invalid credentials')
-        get_log().debug(e)
-        raise LdapException("Invalid credentials") from e
-      except Exception as e:
-        get_log().critical('Could not connect to LDAP')
-        get_log().debug(e)
-        raise LdapException("Could not connect to LDAP server") from e
-
-      get_log().info("Opened connection to %s with bind DN %s", uri, binddn)
-      g.ldap = ldapconn
+      g.ldap = PooledLdap(_get_pool())
   return g.ldap
 
 def close_ldap(e=None):
-  if e:
-    get_log().info("Closing LDAP connection in presence of error.")
-  else:
-    get_log().info("Closing LDAP connection.")
+  """
+  Give the application context's LDAP connection, if any, back to the pool.
+  """
+  conn = g.pop('ldap', None)
+  if isinstance(conn, PooledLdap):
+    if e:
+      get_log().debug("Releasing LDAP connection in presence of error.")
+    conn.release()
+
+def get_ldap_pool_stats():
+  """
+  Report LDAP connection pool statistics, including the number of times a
+  dropped connection was replaced.
+  """
+  return _get_pool().stats()
+
+# cache of person lookups, created on first use from app configuration
+_person_cache = None
+_person_cache_lock = threading.Lock()
+
+def _get_person_cache():
+  # pylint: disable=global-statement
+  global _person_cache
+  with _person_cache_lock:
+    if _person_cache is None:
+      config = current_app.config
+      _person_cache = TtlCache(
+        config.get('LDAP_CACHE_SIZE', 1000),
+        config.get('LDAP_CACHE_TTL', 300),
+        config.get('LDAP_CACHE_NEGATIVE_TTL', 60))
+    return _person_cache
+
+# circuit breaker around directory lookups, created on first use.  Only
+# errors showing the directory to be unreachable or slow count as failures,
+# not those from lookups it answered.
+_breaker = None
+_unavailable = (LdapUnavailable, ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+def _get_breaker():
+  # pylint: disable=global-statement
+  global _breaker
+  with _person_cache_lock:
+    if _breaker is None:
+      config = current_app.config
+      _breaker = CircuitBreaker(
+        config.get('LDAP_BREAKER_THRESHOLD', 5),
+        config.get('LDAP_BREAKER_RESET', 30),
+        call_timeout=config.get('LDAP_CALL_TIMEOUT') or None,
+        workers=config.get('LDAP_POOL_SIZE', 10),
+        failures=_unavailable)
+    return _breaker
+
+def _lookup(uid, attrs):
+  """
+  Look person up in the directory, subject to the circuit breaker.  The
+  lookup takes a connection of its own from the pool, rather than the
+  application context's, as it may carry on after the caller stops waiting.
+  """
+  args = (uid, list(attrs)) if attrs else (uid,)
+  stub = current_app.config.get('LDAP_STUB')
+  if stub:
+    return _get_breaker().call(stub.get_person, *args)
+
+  pool = _get_pool()
+  def lookup():
+    conn = PooledLdap(pool)
+    try:
+      return conn.get_person(*args)
+    finally:
+      conn.release()
+  return _get_breaker().call(lookup)
+
+def _get_synced(uid, attrs, stale=False):
+  try:
+    return people.get_synced_person(uid, attrs, stale)
+  # pylint: disable=broad-except
+  except Exception as e:
+    get_log().warning("Could not get synced details of %s: %s", uid, e)
+    return None
+
+def get_person(uid, attrs=None):
+  """
+  Look up person by UID, retrieving the given extra attributes along with
+  the defaults, through the person cache.  Lookups of the same person for
+  different sets of attributes are cached separately.  Details synced from
+  the directory are used if recent enough.  Returns a copy of the
+  person's details, or None if there is no such person.
+
+  If the directory is down or slow, synced details are used however old they
+  are; if there are none, LdapException is raised.
+  """
+  key = (uid, frozenset(attrs or ()))
+  def load():
+    return _get_synced(uid, attrs) or _lookup(uid, attrs)
+  try:
+    details = _get_person_cache().get_or_load(key, load)
+  except (CircuitOpen, CallTimeout) + _unavailable as e:
+    details = _get_synced(uid, attrs, stale=True)
+    if not details:
+      raise LdapException(f"Directory unavailable: {e}") from e
+    get_log().warning("Directory unavailable, using synced details of %s: %s",
+      uid, e)
+  return dict(details) if details else None
+
+def probe_person(uid):
+  """
+  Look person up in the directory itself, through the circuit breaker but not
+  the person cache or synced details, so as to check that the directory is
+  answering.  Returns the person's details, or None if there is no such
+  person.
+  """
+  return _lookup(uid, None)
+
+def get_breaker_stats():
+  """
+  Report state and statistics of the circuit breaker around the directory.
+  """
+  return _get_breaker().stats()
+
+def get_person_cache_stats():
+  """
+  Report person cache statistics.
+  """
+  return _get_person_cache().stats()
+
+def _decode(attr, values):
+  values = [value.decode('utf8') for value in values]
+  if attr in people.PERSON_ATTRIBUTES:
+    return values[0]
+  return values
+
+def search_people(uids, attrs, page_size=None):
+  """
+  Search directory for the people with the given UIDs, retrieving the given
+  extra attributes along with the person attributes, using paged results.
+  Generates (uid, details) pairs for the people found.  This uses its own
+  connection rather than one from the pool so as not to hold one for long.
+  """
+  config = current_app.config
+  page_size = page_size or 500
+  attrlist = ['uid', *people.PERSON_ATTRIBUTES, *attrs]
+  filterstr = '(|' + ''.join(
+    f'(uid={escape_filter_chars(uid)})' for uid in uids) + ')'
+
+  conn = ldap.initialize(config['LDAP_URI'])
+  try:
+    conn.protocol_version = ldap.VERSION3
+    for (option, value) in _translate_options(config).items():
+      conn.set_option(option, value)
+    if not config['LDAP_SKIP_TLS']:
+      conn.start_tls_s()
+    conn.simple_bind_s(config['LDAP_BINDDN'], config['LDAP_PASSWORD'])
 
-  # On deletion of LDAPObject the connection is automatically unbound and
-  # closed, so no explicit close() message needs to be sent.
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+      msgid = conn.search_ext(
+        config['LDAP_PEOPLE_BASE'], ldap.SCOPE_SUBTREE, filterstr, attrlist,
+        serverctrls=[control])
+      (_, entries, _, controls) = conn.result3(msgid)
+      for (dn, entry) in entries:
+        # skip referrals
+        if dn is None or 'uid' not in entry:
+          continue
+        details = {attr: _decode(attr, values) for (attr, values) in entry.items()
+                   if attr != 'uid'}
+        yield (entry['uid'][0].decode('utf8'), details)
+      cookie = next((c.cookie for c in controls
+                     if c.controlType == SimplePagedResultsControl.controlType), None)
+      if not cookie:
+        break
+      control.cookie = cookie
+  except ldap.LDAPError as e:
+    get_log().error("Could not search directory for people: %s", e)
+    raise LdapException("Could not search directory for people") from e
+  finally:
+    conn.unbind_s()
@@ -0,0 +1,270 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint: disable=import-outside-toplevel
+#
+"""
+Local copy of the directory attributes of people who use the application.
+
+People are recorded as they log in.  A sync job, run with the `sync-people`
+command or periodically by the serving processes, fetches the attributes of those who have
+logged in recently from the directory in bulk and stores them in the people
+table, and drops those who have not.  Logins then take the person's details
+and rights from there when they have been synced recently enough, only going
+to the directory for people not yet synced.
+
+The directory search is given to `sync_people()` so that this module does not
+depend on the LDAP client library.
+"""
+
+import atexit
+import json
+import threading
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from .db import get_db
+from .log import get_log
+from .statements import register_statement
+
+# attributes making up a person's details
+PERSON_ATTRIBUTES = ('cn', 'givenName', 'preferredLanguage')
+
+# attributes from which access rights are derived
+ACCESS_ATTRIBUTES = ('eduPersonAffiliation', 'eduPersonEntitlement')
+
+# number of people to look up in each directory search
+SYNC_BATCH_SIZE = 100
+
+# logins are only recorded if the last one recorded is older than this, in
+# seconds
+LOGIN_RECORD_INTERVAL = 86400
+
+# key of the Postgres advisory lock held while syncing, so that only one of
+# the processes serving the application syncs at a time
+SYNC_LOCK_ID = 0x64726179
+
+# ---------------------------------------------------------------------------
+#                                                                       sql
+# ---------------------------------------------------------------------------
+
+SQL_GET_SYNCED = '''
+  SELECT    details
+  FROM      people
+  WHERE     uid = ?
+    AND     synced >= ?
+    AND     details IS NOT NULL
+'''
+
+STMT_GET_SYNCED = register_statement(
+  'get_synced_person', SQL_GET_SYNCED, example=('someone', 0))
+
+SQL_GET_LAST_LOGIN = '''
+  SELECT    last_login
+  FROM      people
+  WHERE     uid = ?
+'''
+
+SQL_GET_LAST_SYNCED = '''
+  SELECT    MAX(synced) AS synced
+  FROM      people
+'''
+
+SQL_RECORD_LOGIN = '''
+  INSERT INTO people (uid, last_login) VALUES (?, ?)
+  ON CONFLICT (uid) DO UPDATE SET last_login = excluded.last_login
+'''
+
+SQL_STORE = '''
+  INSERT INTO people (uid, details, synced, last_login) VALUES (?, ?, ?, ?)
+  ON CONFLICT (uid) DO UPDATE SET
+    details = excluded.details,
+    synced = excluded.synced
+'''
+
+SQL_GET_ACTIVE = '''
+  SELECT    uid
+  FROM      people
+  WHERE     last_login >= ?
+  ORDER BY  uid
+'''
+
+SQL_DELETE = '''
+  DELETE FROM people WHERE uid = ?
+'''
+
+SQL_DELETE_INACTIVE = '''
+  DELETE FROM people WHERE last_login < ?
+'''
+
+# ---------------------------------------------------------------------------
+#                                                                 functions
+# ---------------------------------------------------------------------------
+
+def sync_enabled():
+  """
+  Whether logins use synced details, and so should be recorded.
+  """
+  return bool(current_app.config.get('LDAP_SYNC_MAX_AGE'))
+
+def get_synced_person(uid, attrs=None, stale=False):
+  """
+  Retrieve person's details, limited to the person attributes and the given
+  access attributes, if synced within LDAP_SYNC_MAX_AGE seconds or, if
+  `stale` is set, whenever synced.  Returns None if not synced recently
+  enough, or if the access attributes asked for are not ones which are
+  synced.
+  """
+  max_age = current_app.config.get('LDAP_SYNC_MAX_AGE')
+  if not (max_age or stale) or not set(attrs or ()) <= set(ACCESS_ATTRIBUTES):
+    return None
+  since = 0 if stale else int(time.time()) - max_age
+  rec = get_db(readonly=True).execute_statement(
+    STMT_GET_SYNCED, (uid, since)).fetchone()
+  if rec is None:
+    return None
+  details = json.loads(rec['details'])
+  wanted = PERSON_ATTRIBUTES + tuple(attrs or ())
+  return {key: value for (key, value) in details.items() if key in wanted}
+
+def store_people(people, commit=True):
+  """
+  Store details of people, given as (uid, details) pairs, as synced now.
+  """
+  now = int(time.time())
+  db = get_db()
+  db.executemany(SQL_STORE, [
+    (uid, json.dumps(details), now, now) for (uid, details) in people
+  ])
+  if commit:
+    db.commit()
+
+def record_login(uid):
+  """
+  Record that person logged in, so they are kept synced.  Logins are only
+  written if none was recorded in the last LOGIN_RECORD_INTERVAL seconds.
+  Returns whether the login was written.
+  """
+  now = int(time.time())
+  rec = get_db(readonly=True).execute(SQL_GET_LAST_LOGIN, (uid,)).fetchone()
+  if rec and rec['last_login'] and rec['last_login'] > now - LOGIN_RECORD_INTERVAL:
+    return False
+  db = get_db()
+  db.execute(SQL_RECORD_LOGIN, (uid, now))
+  db.commit()
+  return True
+
+def sync_people(search, active_days, page_size=None):
+  """
+  Fetch details of people who logged in within `active_days` days from the
+  directory and store them, and drop people who have not logged in since or
+  are no longer in the directory.  `search` is called with a list of UIDs,
+  the access attributes and the page size, and yields (uid, details) pairs
+  for those found.
+
+  Returns counts of people 'synced', 'removed' from the directory and
+  'expired' for inactivity.
+  """
+  db = get_db()
+  since = int(time.time()) - active_days * 86400
+  uids = [rec['uid'] for rec in db.execute(SQL_GET_ACTIVE, (since,)).fetchall()]
+
+  counts = {'synced': 0, 'removed': 0, 'expired': 0}
+  for i in range(0, len(uids), SYNC_BATCH_SIZE):
+    batch = uids[i:i + SYNC_BATCH_SIZE]
+    found = dict(search(batch, ACCESS_ATTRIBUTES, page_size))
+    store_people(found.items(), commit=False)
+    missing = [uid for uid in batch if uid not in found]
+    if missing:
+      db.executemany(SQL_DELETE, [(uid,) for uid in missing])
+    db.commit()
+    counts['synced'] += len(found)
+    counts['removed'] += len(missing)
+
+  counts['expired'] = db.execute(SQL_DELETE_INACTIVE, (since,)).rowcount
+  db.commit()
+  get_log().info("Synced people from directory: %s", counts)
+  return counts
+
+def _sync_from_directory():
+  from .ldap import search_people
+  config = current_app.config
+  return sync_people(
+    search_people, config.get('LDAP_SYNC_ACTIVE_DAYS', 30),
+    config.get('LDAP_SYNC_PAGE_SIZE'))
+
+def _scheduled_sync(interval):
+  """
+  Sync people from the directory unless another process is doing so, or
+  did within the last half interval.  On Postgres this is coordinated with an
+  advisory lock; on SQLite only by the time of the last sync.  Returns the
+  counts, or None if skipped.
+  """
+  db = get_db()
+  if db.type == 'postgres':
+    if not db.execute("SELECT pg_try_advisory_lock(?) AS locked",
+                      (SYNC_LOCK_ID,)).fetchone()['locked']:
+      db.rollback()
+      get_log().debug("People are being synced by another process")
+      return None
+  try:
+    synced = db.execute(SQL_GET_LAST_SYNCED).fetchone()['synced']
+    if synced and synced > int(time.time()) - interval / 2:
+      get_log().debug("People were synced recently by another process")
+      db.rollback()
+      return None
+    return _sync_from_directory()
+  finally:
+    if db.type == 'postgres':
+      db.rollback()
+      db.execute("SELECT pg_advisory_unlock(?)", (SYNC_LOCK_ID,))
+      db.commit()
+
+def start_sync_scheduler(app, interval):
+  """
+  Sync people from the directory every `interval` seconds in a background
+  thread, starting after the first interval.  Returns an event which stops
+  the thread when set; it is also set when the process exits.
+  """
+  stop = threading.Event()
+  def run():
+    while not stop.wait(interval):
+      with app.app_context():
+        try:
+          _scheduled_sync(interval)
+        # pylint: disable=broad-except
+        except Exception as e:
+          get_log().error("Could not sync people from directory: %s", e)
+  threading.Thread(target=run, name='sync-people', daemon=True).start()
+  atexit.register(stop.set)
+  return stop
+
+def init_sync_scheduler(app):
+  """
+  Start syncing people in the background, if LDAP_SYNC_INTERVAL is set, once
+  the application serves its first request, so that commands run with the
+  application don't also sync.  The stop event is kept in the application's
+  extensions as 'people_sync'.
+  """
+  interval = app.config.get('LDAP_SYNC_INTERVAL')
+  if not interval:
+    return
+  lock = threading.Lock()
+  def start():
+    if 'people_sync' in app.extensions:
+      return
+    with lock:
+      if 'people_sync' not in app.extensions:
+        app.extensions['people_sync'] = start_sync_scheduler(app, interval)
+  app.before_request(start)
+
+# ---------------------------------------------------------------------------
+#                                                                  commands
+# ---------------------------------------------------------------------------
+
+@click.command('sync-people')
+@with_appcontext
+def sync_people_command():
+  """Sync directory attributes of recently active people."""
+  counts = _sync_from_directory()
+  click.echo(f"Synced {counts['synced']} people, removed {counts['removed']} "
+             f"no longer in directory and {counts['expired']} inactive.")
@@ -0,0 +1,221 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Generic pool of reusable connections, such as to a database.
+"""
+import collections
+import threading
+import time
+from .exceptions import PoolTimeout
+
+class Pool:
+  """
+  Thread-safe, bounded pool of connections created on demand by a factory.
+
+  Connections are handed out by `acquire()` and given back by `release()`.
+  When all connections are in use, `acquire()` waits up to `timeout` seconds
+  for one to be released.  Connections are discarded rather than reused once
+  they are older than `max_lifetime` seconds, have been idle for more than
+  `max_idle` seconds, or when they fail the `check` function, which is only
+  called for connections idle for at least `check_idle` seconds.  The `reset` function, if given, is called on each
+  connection as it is released; if it raises, the connection is discarded.
+  Connections made before the last call to `invalidate()` are discarded too.
+  Connections are closed by calling their close() method.
+
+  Wait times, utilisation and other statistics are available from
+  `stats()`.
+  """
+
+  # pylint: disable=too-many-arguments,too-many-instance-attributes
+  def __init__(self, factory, maxsize, timeout=None, max_lifetime=None,
+               check=None, check_idle=0, reset=None, max_idle=None):
+    self._factory = factory
+    self._maxsize = maxsize
+    self._timeout = timeout
+    self._max_lifetime = max_lifetime
+    self._max_idle = max_idle
+    self._check = check
+    self._check_idle = check_idle
+    self._reset = reset
+
+    self._lock = threading.Condition()
+
+    # idle connections as (connection, time created, generation, time
+    # released), most recently released last
+    self._idle = collections.deque()
+
+    # time of creation and generation of connections currently in use, by id
+    self._in_use = {}
+
+    # incremented by invalidate(); older connections are not reused
+    self._generation = 0
+
+    # number of connections being created, which count towards size
+    self._pending = 0
+
+    self._acquired = 0
+    self._created = 0
+    self._discarded = 0
+    self._timeouts = 0
+    self._waits = 0
+    self._wait_total = 0.0
+    self._wait_max = 0.0
+
+  @property
+  def size(self):
+    """
+    Total number of connections, idle and in use.
+    """
+    return len(self._idle) + len(self._in_use) + self._pending
+
+  def _expired(self, created, generation, now):
+    if generation != self._generation:
+      return True
+    return self._max_lifetime is not None and now - created > self._max_lifetime
+
+  def _discard(self, conn):
+    self._discarded += 1
+    try:
+      conn.close()
+    # pylint: disable=broad-except
+    except Exception:
+      pass
+
+  def acquire(self):
+    """
+    Return a connection from the pool, creating one if none is idle and the
+    pool is not full, otherwise waiting for one to be released.  Raises
+    PoolTimeout if none becomes available in time.
+    """
+    start = time.monotonic()
+    deadline = None if self._timeout is None else start + self._timeout
+    waited = False
+
+    with self._lock:
+      while True:
+        now = time.monotonic()
+
+        # reuse idle connection if there's a good one
+        while self._idle:
+          (conn, created, generation, released) = self._idle.pop()
+          if self._expired(created, generation, now):
+            self._discard(conn)
+            continue
+          if self._max_idle is not None and now - released > self._max_idle:
+            self._discard(conn)
+            continue
+          if self._check and now - released >= self._check_idle:
+            if not self._check(conn):
+              self._discard(conn)
+              continue
+          self._in_use[id(conn)] = (created, generation)
+          self._record_acquire(start, waited)
+          return conn
+
+        # create new connection if there's room
+        if self.size < self._maxsize:
+          self._pending += 1
+          break
+
+        # otherwise wait for one to be released
+        remaining = None if deadline is None else deadline - now
+        if remaining is not None and remaining <= 0:
+          self._timeouts += 1
+          raise PoolTimeout(
+            f"Timed out after {self._timeout}s waiting for connection; "
+            f"all {self._maxsize} in use")
+        waited = True
+        self._lock.wait(remaining)
+
+    # create connection outside of lock as this may be slow; it belongs to
+    # the generation current when it was asked for
+    generation = self._generation
+    try:
+      conn = self._factory()
+    except Exception:
+      with self._lock:
+        self._pending -= 1
+        self._lock.notify()
+      raise
+
+    with self._lock:
+      self._pending -= 1
+      self._created += 1
+      self._in_use[id(conn)] = (time.monotonic(), generation)
+      self._record_acquire(start, waited)
+    return conn
+
+  def _record_acquire(self, start, waited):
+    self._acquired += 1
+    if waited:
+      wait = time.monotonic() - start
+      self._waits += 1
+      self._wait_total += wait
+      self._wait_max = max(self._wait_max, wait)
+
+  def release(self, conn, discard=False):
+    """
+    Return connection to the pool.  If `discard` is set, the connection is
+    known to be bad and is closed instead.
+    """
+    if not discard and self._reset:
+      try:
+        self._reset(conn)
+      # pylint: disable=broad-except
+      except Exception:
+        discard = True
+
+    with self._lock:
+      (created, generation) = self._in_use.pop(id(conn))
+      now = time.monotonic()
+      if discard or self._expired(created, generation, now):
+        self._discard(conn)
+      else:
+        self._idle.append((conn, created, generation, now))
+      self._lock.notify()
+
+  def invalidate(self):
+    """
+    Stop reusing the connections made so far, such as when state they hold
+    has become stale.  Idle connections are closed now and those in use as
+    they are released.
+    """
+    with self._lock:
+      self._generation += 1
+      while self._idle:
+        (conn, _, _, _) = self._idle.pop()
+        self._discard(conn)
+
+  def close(self):
+    """
+    Close all idle connections.  Connections in use are closed as they are
+    released.
+    """
+    with self._lock:
+      while self._idle:
+        (conn, _, _, _) = self._idle.pop()
+        self._discard(conn)
+      self._max_lifetime = -1
+
+  def stats(self):
+    """
+    Report pool statistics.
+    """
+    with self._lock:
+      in_use = len(self._in_use)
+      return {
+        'maxsize': self._maxsize,
+        'size': self.size,
+        'in_use': in_use,
+        'idle': len(self._idle),
+        'utilisation': in_use / self._maxsize if self._maxsize else 0,
+        'acquired': self._acquired,
+        'created': self._created,
+        'discarded': self._discarded,
+        'timeouts': self._timeouts,
+        'waits': self._waits,
+        'wait_total': self._wait_total,
+        'wait_max': self._wait_max,
+        'wait_mean': self._wait_total / self._waits if self._waits else 0.0,
+      }
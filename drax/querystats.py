@@ -0,0 +1,147 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint: disable=global-statement
+#
+"""
+Instrumentation of database queries.
+
+The database connection classes report the time taken by each query, and the
+number of rows returned or affected where the driver knows it, by calling
+`record_query()`.  When enabled, these are aggregated per query, with
+queries keyed on their normalized text so that those differing only in
+literal values or the length of lists are counted together.  Queries slower
+than the configured threshold are logged.
+
+SQLite does not report the number of rows returned by a query until they are
+all fetched, so row counts for SQLite queries only count rows affected.
+"""
+import bisect
+import functools
+import re
+import threading
+from .log import get_log
+
+# upper bounds of latency histogram buckets, in milliseconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# maximum number of distinct queries to track; others are counted together
+MAX_QUERIES = 500
+
+# normalized query text is truncated to this length
+MAX_QUERY_LENGTH = 1000
+
+# number of normalized queries to remember
+NORMALIZE_CACHE_SIZE = 1024
+
+# key for queries beyond MAX_QUERIES
+OTHER = '(other)'
+
+literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+list_re = re.compile(r'\?(?:\s*,\s*\?)+')
+space_re = re.compile(r'\s+')
+
+_enabled = False
+_slow_threshold = None
+_queries = {}
+_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_query(sql):
+  """
+  Normalize query text: literals become placeholders, lists of placeholders
+  are collapsed and whitespace is squeezed.
+  """
+  sql = literal_re.sub('?', sql.replace('%s', '?'))
+  sql = list_re.sub('?, ...', sql)
+  return space_re.sub(' ', sql).strip()[:MAX_QUERY_LENGTH]
+
+class QueryStats:
+  """
+  Aggregate timings and row counts for a query.
+  """
+
+  __slots__ = ('count', 'total', 'max', 'rows', 'histogram')
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.rows = 0
+    self.histogram = [0] * (len(BUCKETS) + 1)
+
+  def add(self, elapsed, rows):
+    self.count += 1
+    self.total += elapsed
+    self.max = max(self.max, elapsed)
+    if rows is not None and rows > 0:
+      self.rows += rows
+    self.histogram[bisect.bisect_left(BUCKETS, elapsed * 1000)] += 1
+
+  def report(self):
+    """
+    Report statistics; times are in milliseconds.
+    """
+    labels = [f'le_{bound}' for bound in BUCKETS] + ['inf']
+    return {
+      'count': self.count,
+      'total_ms': self.total * 1000,
+      'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+      'max_ms': self.max * 1000,
+      'rows': self.rows,
+      'histogram': dict(zip(labels, self.histogram)),
+    }
+
+def enable_query_stats(enable=True, slow_threshold=None):
+  """
+  Turn collection of query statistics on or off.  Queries taking longer than
+  `slow_threshold` seconds, if given, are logged.
+  """
+  global _enabled, _slow_threshold
+  _enabled = enable
+  _slow_threshold = slow_threshold
+
+def record_query(sql, elapsed, rows=None):
+  """
+  Record execution of a query taking `elapsed` seconds and returning or
+  affecting `rows` rows, if known.
+  """
+  if not _enabled:
+    return
+
+  key = normalize_query(sql)
+  with _lock:
+    stats = _queries.get(key)
+    if stats is None:
+      if len(_queries) >= MAX_QUERIES:
+        key = OTHER
+        stats = _queries.get(key)
+      if stats is None:
+        stats = QueryStats()
+        _queries[key] = stats
+    stats.add(elapsed, rows)
+
+  if _slow_threshold is not None and elapsed >= _slow_threshold:
+    get_log().warning("Slow query (%.1f ms, %s rows): %s",
+      elapsed * 1000, rows if rows is not None and rows >= 0 else 'unknown', key)
+
+def get_query_stats():
+  """
+  Report statistics of each query, by normalized query text, along with
+  totals over all queries.  Queries are listed by total time, most first.
+  """
+  with _lock:
+    queries = sorted(_queries.items(), key=lambda item: item[1].total, reverse=True)
+    reports = {key: stats.report() for (key, stats) in queries}
+  return {
+    'enabled': _enabled,
+    'slow_threshold_ms': _slow_threshold * 1000 if _slow_threshold is not None else None,
+    'count': sum(report['count'] for report in reports.values()),
+    'total_ms': sum(report['total_ms'] for report in reports.values()),
+    'queries': reports,
+  }
+
+def reset_query_stats():
+  """
+  Discard collected statistics.
+  """
+  with _lock:
+    _queries.clear()
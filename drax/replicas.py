@@ -0,0 +1,92 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Selection of read replicas of a database.
+"""
+import threading
+import time
+
+class Replicas:
+  """
+  Thread-safe, round-robin selection among replicas, identified by URI.
+
+  Callers try the replicas given by `candidates()` in order, reporting each
+  one's success or failure.  A replica which fails is skipped for
+  `retry_after` seconds, after which it is tried again.  When no replica is
+  available callers fall back to the primary and report it with
+  `fell_back()`.
+  """
+
+  def __init__(self, uris, retry_after=30):
+    self._uris = list(uris)
+    self._retry_after = retry_after
+    self._lock = threading.Lock()
+    self._next = 0
+
+    # time of last failure of replicas considered down, by URI
+    self._down = {}
+
+    self._selected = {uri: 0 for uri in self._uris}
+    self._failures = {uri: 0 for uri in self._uris}
+    self._fallbacks = 0
+
+  def __len__(self):
+    return len(self._uris)
+
+  def candidates(self):
+    """
+    Return list of replicas to try, in order.  Each call starts with the next
+    replica from the last, and replicas which recently failed are left out.
+    """
+    with self._lock:
+      count = len(self._uris)
+      if not count:
+        return []
+      start = self._next
+      self._next = (start + 1) % count
+      now = time.monotonic()
+      order = [self._uris[(start + i) % count] for i in range(count)]
+      return [
+        uri for uri in order
+        if uri not in self._down or now - self._down[uri] >= self._retry_after
+      ]
+
+  def succeeded(self, uri):
+    """
+    Report replica was selected and is usable.
+    """
+    with self._lock:
+      self._down.pop(uri, None)
+      self._selected[uri] += 1
+
+  def failed(self, uri):
+    """
+    Report replica could not be used.
+    """
+    with self._lock:
+      self._down[uri] = time.monotonic()
+      self._failures[uri] += 1
+
+  def fell_back(self):
+    """
+    Report no replica was available so the primary was used.
+    """
+    with self._lock:
+      self._fallbacks += 1
+
+  def stats(self):
+    """
+    Report replica statistics, by URI.
+    """
+    with self._lock:
+      return {
+        'replicas': {
+          uri: {
+            'healthy': uri not in self._down,
+            'selected': self._selected[uri],
+            'failures': self._failures[uri],
+          } for uri in self._uris
+        },
+        'fallbacks': self._fallbacks,
+      }
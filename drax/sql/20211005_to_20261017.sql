@@ -0,0 +1,42 @@
+-- Catalogue version is bumped on any change to the catalogue tables so that
+-- in-process caches of the catalogue know when to refresh.  It starts from the
+-- time of creation (in milliseconds) so that a recreated catalogue does not
+-- reuse versions of the one it replaced.
+CREATE TABLE catalogue_version (
+  version INTEGER NOT NULL
+);
+INSERT INTO catalogue_version (version) VALUES (
+  CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)
+);
+CREATE TRIGGER services_ins AFTER INSERT ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER services_upd AFTER UPDATE ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER services_del AFTER DELETE ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_ins AFTER INSERT ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_upd AFTER UPDATE ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_del AFTER DELETE ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_ins AFTER INSERT ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_upd AFTER UPDATE ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_del AFTER DELETE ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_ins AFTER INSERT ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_upd AFTER UPDATE ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_del AFTER DELETE ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_ins AFTER INSERT ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_upd AFTER UPDATE ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_del AFTER DELETE ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+
+INSERT INTO schemalog (version) VALUES ('20261017');
@@ -0,0 +1,13 @@
+-- Access strings normalized into disjunctive normal form, so access can be
+-- decided in the database: each clause of an access string is a set of
+-- attribute-value predicates which must all be held.  An empty clause (no
+-- attribute) is always satisfied.
+CREATE TABLE access_rules (
+  access VARCHAR(128) NOT NULL,
+  clause INTEGER NOT NULL,
+  attribute VARCHAR(64),
+  value VARCHAR(128)
+);
+CREATE INDEX access_rules_access ON access_rules (access);
+
+INSERT INTO schemalog (version) VALUES ('20261018');
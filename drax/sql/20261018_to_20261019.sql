@@ -0,0 +1,129 @@
+DROP VIEW all_services;
+
+-- Indexes supporting the joins of the catalogue
+CREATE INDEX service_definitions_service ON service_definitions (service, language);
+CREATE INDEX service_definitions_language ON service_definitions (language);
+CREATE INDEX service_access_service ON service_access (service);
+CREATE INDEX service_access_category ON service_access (category);
+
+-- The catalogue is the join of the catalogue tables.  Rather than being
+-- computed for every query it is kept in the catalogue table, maintained from
+-- the catalogue_source view as the catalogue tables change, and read through
+-- the all_services view.
+CREATE VIEW catalogue_source (
+  category_name, category, service, title, description, access, url, icon_url,
+  sso, language, sortkey
+) AS
+SELECT      c.name, t.title, s.name, sd.title, sd.description, sa.access,
+            sa.url, sa.icon_url, s.sso, sd.language, c.ordr
+  FROM      services s
+  JOIN      service_definitions sd ON s.name = sd.service
+  JOIN      service_access sa ON sd.service = sa.service
+  JOIN      categories c ON sa.category = c.name
+  JOIN      titles t ON c.name = t.name
+  WHERE     sd.language = t.language
+;
+CREATE TABLE catalogue (
+  category_name VARCHAR(16) NOT NULL,
+  category TEXT NOT NULL,
+  service VARCHAR(32) NOT NULL,
+  title VARCHAR(128),
+  description TEXT,
+  access VARCHAR(128),
+  url VARCHAR(128) NOT NULL,
+  icon_url VARCHAR(128),
+  sso BOOLEAN NOT NULL,
+  language CHAR(2) NOT NULL,
+  sortkey INTEGER
+);
+INSERT INTO catalogue SELECT * FROM catalogue_source;
+CREATE INDEX catalogue_language ON catalogue (language, sortkey, service);
+
+CREATE VIEW all_services (
+  category_name, category, service, title, description, access, url, icon_url,
+  sso, language, sortkey
+) AS
+SELECT      *
+  FROM      catalogue
+  ORDER BY  sortkey, service
+;
+
+-- Keep the catalogue table up to date: rows are replaced for each service or
+-- category affected by a change
+CREATE TRIGGER services_ins_catalogue AFTER INSERT ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.name);
+  END;
+CREATE TRIGGER services_upd_catalogue AFTER UPDATE ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER services_del_catalogue AFTER DELETE ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.name);
+  END;
+CREATE TRIGGER service_definitions_ins_catalogue AFTER INSERT ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.service);
+  END;
+CREATE TRIGGER service_definitions_upd_catalogue AFTER UPDATE ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service, NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service, NEW.service);
+  END;
+CREATE TRIGGER service_definitions_del_catalogue AFTER DELETE ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service);
+  END;
+CREATE TRIGGER service_access_ins_catalogue AFTER INSERT ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.service);
+  END;
+CREATE TRIGGER service_access_upd_catalogue AFTER UPDATE ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service, NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service, NEW.service);
+  END;
+CREATE TRIGGER service_access_del_catalogue AFTER DELETE ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service);
+  END;
+CREATE TRIGGER categories_ins_catalogue AFTER INSERT ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (NEW.name);
+  END;
+CREATE TRIGGER categories_upd_catalogue AFTER UPDATE ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER categories_del_catalogue AFTER DELETE ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name);
+  END;
+CREATE TRIGGER titles_ins_catalogue AFTER INSERT ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (NEW.name);
+  END;
+CREATE TRIGGER titles_upd_catalogue AFTER UPDATE ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER titles_del_catalogue AFTER DELETE ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name);
+  END;
+
+INSERT INTO schemalog (version) VALUES ('20261019');
@@ -0,0 +1,20 @@
+-- Each service has one definition per language and one entry per category,
+-- so that catalogue imports can update them in place.  Duplicates are dropped,
+-- keeping the first.
+DELETE FROM service_definitions WHERE rowid NOT IN (
+  SELECT MIN(rowid) FROM service_definitions GROUP BY service, language
+);
+DROP INDEX service_definitions_service;
+CREATE UNIQUE INDEX service_definitions_service ON service_definitions (service, language);
+
+DELETE FROM service_access WHERE rowid NOT IN (
+  SELECT MIN(rowid) FROM service_access GROUP BY service, category
+);
+DROP INDEX service_access_service;
+CREATE UNIQUE INDEX service_access_service ON service_access (service, category);
+
+-- Indexes for maintaining the catalogue table
+CREATE INDEX catalogue_service ON catalogue (service);
+CREATE INDEX catalogue_category ON catalogue (category_name);
+
+INSERT INTO schemalog (version) VALUES ('20261020');
@@ -0,0 +1,12 @@
+-- People who have logged in, with the directory attributes they were last
+-- synced with (as JSON, or NULL if never synced) so that logins need not wait
+-- on the directory.  Times are in seconds since the epoch.
+CREATE TABLE people (
+  uid VARCHAR(64) PRIMARY KEY,
+  details TEXT,
+  synced BIGINT,
+  last_login BIGINT NOT NULL
+);
+CREATE INDEX people_last_login ON people (last_login);
+
+INSERT INTO schemalog (version) VALUES ('20261021');
@@ -1,9 +1,21 @@
+DROP VIEW IF EXISTS all_services;
+DROP TABLE IF EXISTS catalogue;
+DROP VIEW IF EXISTS catalogue_source;
+DROP TABLE IF EXISTS schemalog;
+DROP TABLE IF EXISTS catalogue_version;
+DROP TABLE IF EXISTS access_rules;
+DROP TABLE IF EXISTS people;
 DROP TABLE IF EXISTS services;
 DROP TABLE IF EXISTS service_definitions;
 DROP TABLE IF EXISTS service_access;
 DROP TABLE IF EXISTS categories;
 DROP TABLE IF EXISTS titles;
-DROP VIEW IF EXISTS all_services;
+
+CREATE TABLE schemalog (
+  version VARCHAR(10) PRIMARY KEY,
+  applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO schemalog (version) VALUES ('20261021');
 
 CREATE TABLE services (
   name VARCHAR(32) PRIMARY KEY,
@@ -40,17 +52,196 @@ CREATE TABLE titles (
   CONSTRAINT name_lang UNIQUE (name, language)
 );
 
-CREATE VIEW all_services (
+-- Indexes supporting the joins of the catalogue.  Each service has one
+-- definition per language and one entry per category, so that catalogue
+-- imports can update them in place.
+CREATE UNIQUE INDEX service_definitions_service ON service_definitions (service, language);
+CREATE INDEX service_definitions_language ON service_definitions (language);
+CREATE UNIQUE INDEX service_access_service ON service_access (service, category);
+CREATE INDEX service_access_category ON service_access (category);
+
+-- The catalogue is the join of the catalogue tables.  Rather than being
+-- computed for every query it is kept in the catalogue table, maintained from
+-- the catalogue_source view as the catalogue tables change, and read through
+-- the all_services view.
+CREATE VIEW catalogue_source (
   category_name, category, service, title, description, access, url, icon_url,
-  sso, language
+  sso, language, sortkey
 ) AS
 SELECT      c.name, t.title, s.name, sd.title, sd.description, sa.access,
-            sa.url, sa.icon_url, s.sso, sd.language
+            sa.url, sa.icon_url, s.sso, sd.language, c.ordr
   FROM      services s
   JOIN      service_definitions sd ON s.name = sd.service
   JOIN      service_access sa ON sd.service = sa.service
   JOIN      categories c ON sa.category = c.name
   JOIN      titles t ON c.name = t.name
   WHERE     sd.language = t.language
-  ORDER BY  c.ordr
 ;
+CREATE TABLE catalogue (
+  category_name VARCHAR(16) NOT NULL,
+  category TEXT NOT NULL,
+  service VARCHAR(32) NOT NULL,
+  title VARCHAR(128),
+  description TEXT,
+  access VARCHAR(128),
+  url VARCHAR(128) NOT NULL,
+  icon_url VARCHAR(128),
+  sso BOOLEAN NOT NULL,
+  language CHAR(2) NOT NULL,
+  sortkey INTEGER
+);
+INSERT INTO catalogue SELECT * FROM catalogue_source;
+CREATE INDEX catalogue_language ON catalogue (language, sortkey, service);
+CREATE INDEX catalogue_service ON catalogue (service);
+CREATE INDEX catalogue_category ON catalogue (category_name);
+
+CREATE VIEW all_services (
+  category_name, category, service, title, description, access, url, icon_url,
+  sso, language, sortkey
+) AS
+SELECT      *
+  FROM      catalogue
+  ORDER BY  sortkey, service
+;
+
+-- Keep the catalogue table up to date: rows are replaced for each service or
+-- category affected by a change
+CREATE TRIGGER services_ins_catalogue AFTER INSERT ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.name);
+  END;
+CREATE TRIGGER services_upd_catalogue AFTER UPDATE ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER services_del_catalogue AFTER DELETE ON services
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.name);
+  END;
+CREATE TRIGGER service_definitions_ins_catalogue AFTER INSERT ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.service);
+  END;
+CREATE TRIGGER service_definitions_upd_catalogue AFTER UPDATE ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service, NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service, NEW.service);
+  END;
+CREATE TRIGGER service_definitions_del_catalogue AFTER DELETE ON service_definitions
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service);
+  END;
+CREATE TRIGGER service_access_ins_catalogue AFTER INSERT ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (NEW.service);
+  END;
+CREATE TRIGGER service_access_upd_catalogue AFTER UPDATE ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service, NEW.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service, NEW.service);
+  END;
+CREATE TRIGGER service_access_del_catalogue AFTER DELETE ON service_access
+  BEGIN
+    DELETE FROM catalogue WHERE service IN (OLD.service);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE service IN (OLD.service);
+  END;
+CREATE TRIGGER categories_ins_catalogue AFTER INSERT ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (NEW.name);
+  END;
+CREATE TRIGGER categories_upd_catalogue AFTER UPDATE ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER categories_del_catalogue AFTER DELETE ON categories
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name);
+  END;
+CREATE TRIGGER titles_ins_catalogue AFTER INSERT ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (NEW.name);
+  END;
+CREATE TRIGGER titles_upd_catalogue AFTER UPDATE ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name, NEW.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name, NEW.name);
+  END;
+CREATE TRIGGER titles_del_catalogue AFTER DELETE ON titles
+  BEGIN
+    DELETE FROM catalogue WHERE category_name IN (OLD.name);
+    INSERT INTO catalogue SELECT * FROM catalogue_source WHERE category_name IN (OLD.name);
+  END;
+
+-- Catalogue version is bumped on any change to the catalogue tables so that
+-- in-process caches of the catalogue know when to refresh.  It starts from the
+-- time of creation (in milliseconds) so that a recreated catalogue does not
+-- reuse versions of the one it replaced.
+CREATE TABLE catalogue_version (
+  version INTEGER NOT NULL
+);
+INSERT INTO catalogue_version (version) VALUES (
+  CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)
+);
+CREATE TRIGGER services_ins AFTER INSERT ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER services_upd AFTER UPDATE ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER services_del AFTER DELETE ON services
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_ins AFTER INSERT ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_upd AFTER UPDATE ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_definitions_del AFTER DELETE ON service_definitions
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_ins AFTER INSERT ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_upd AFTER UPDATE ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER categories_del AFTER DELETE ON categories
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_ins AFTER INSERT ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_upd AFTER UPDATE ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER service_access_del AFTER DELETE ON service_access
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_ins AFTER INSERT ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_upd AFTER UPDATE ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+CREATE TRIGGER titles_del AFTER DELETE ON titles
+  BEGIN UPDATE catalogue_version SET version = version + 1; END;
+
+-- Access strings normalized into disjunctive normal form, so access can be
+-- decided in the database: each clause of an access string is a set of
+-- attribute-value predicates which must all be held.  An empty clause (no
+-- attribute) is always satisfied.
+CREATE TABLE access_rules (
+  access VARCHAR(128) NOT NULL,
+  clause INTEGER NOT NULL,
+  attribute VARCHAR(64),
+  value VARCHAR(128)
+);
+CREATE INDEX access_rules_access ON access_rules (access);
+
+-- People who have logged in, with the directory attributes they were last
+-- synced with (as JSON, or NULL if never synced) so that logins need not wait
+-- on the directory.  Times are in seconds since the epoch.
+CREATE TABLE people (
+  uid VARCHAR(64) PRIMARY KEY,
+  details TEXT,
+  synced BIGINT,
+  last_login BIGINT NOT NULL
+);
+CREATE INDEX people_last_login ON people (last_login);
@@ -0,0 +1,141 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Registry of named SQL statements for frequently run queries.
+
+Modules declare their hot queries once with `register_statement()` and run
+them by name with the database connection's `execute_statement()`.  On
+Postgres, a statement is prepared on the server (PREPARE) the first time it is
+used on a connection and is then executed (EXECUTE) without being parsed and
+analyzed again; since pooled connections are kept across requests, so are
+their prepared statements.  SQLite keeps its own cache of compiled statements
+keyed on the query text, so there the registry only provides naming and
+statistics.
+
+Statements use "?" placeholders like other queries, but may not take list or
+tuple parameters since a prepared statement has a fixed number of them.
+"""
+import re
+import threading
+from .exceptions import DatabaseException
+
+# statement names must be usable as Postgres identifiers
+name_re = re.compile('^[a-z_][a-z0-9_]*$')
+
+# RE for finding query parameter placeholders, skipping over quoted strings
+qparm_re = re.compile("'[^']*'|\\?")
+
+class Statement:
+  """
+  Named statement along with its execution statistics.  `psql` is the query
+  with Postgres-style numbered placeholders, for use with PREPARE.  An
+  `example` set of parameters may be given for use when explaining the query.
+  """
+
+  # pylint: disable=too-many-instance-attributes
+  def __init__(self, name, sql, example=None):
+    self.name = name
+    self.sql = sql
+    self.example = example
+
+    # number the placeholders for Postgres
+    count = 0
+    def number(m):
+      nonlocal count
+      if m.group() != '?':
+        return m.group()
+      count += 1
+      return f'${count}'
+    self.psql = qparm_re.sub(number, sql)
+    self.parameters = count
+
+    self._lock = threading.Lock()
+    self._prepares = 0
+    self._prepare_time = 0.0
+    self._executions = 0
+    self._execute_time = 0.0
+    self._execute_max = 0.0
+
+  def check_parameters(self, parameters):
+    """
+    Raise DatabaseException if the parameters don't suit the statement.
+    """
+    given = len(parameters) if parameters else 0
+    if given != self.parameters:
+      raise DatabaseException(
+        f"Statement '{self.name}' takes {self.parameters} parameters but "
+        f"{given} given")
+    if any(isinstance(p, (list, tuple)) for p in parameters or ()):
+      raise DatabaseException(
+        f"Statement '{self.name}' cannot take list or tuple parameters")
+
+  def record_prepare(self, elapsed):
+    with self._lock:
+      self._prepares += 1
+      self._prepare_time += elapsed
+
+  def record_execute(self, elapsed):
+    with self._lock:
+      self._executions += 1
+      self._execute_time += elapsed
+      self._execute_max = max(self._execute_max, elapsed)
+
+  def stats(self):
+    """
+    Report statistics for the statement.  Times are in seconds.  On Postgres,
+    `prepare_share` is the fraction of time spent preparing the statement
+    rather than executing it.
+    """
+    with self._lock:
+      total = self._prepare_time + self._execute_time
+      return {
+        'prepares': self._prepares,
+        'prepare_time': self._prepare_time,
+        'executions': self._executions,
+        'execute_time': self._execute_time,
+        'execute_max': self._execute_max,
+        'execute_mean':
+          self._execute_time / self._executions if self._executions else 0.0,
+        'prepare_share': self._prepare_time / total if total else 0.0,
+      }
+
+_statements = {}
+_statements_lock = threading.Lock()
+
+def register_statement(name, sql, example=None):
+  """
+  Register named statement and return its name, for use with
+  `execute_statement()`.  Registering the same statement again has no effect,
+  but registering a different query under the same name is an error.
+  """
+  if not name_re.match(name):
+    raise ValueError(f"Invalid statement name: {name!r}")
+  with _statements_lock:
+    statement = _statements.get(name)
+    if statement is None:
+      _statements[name] = Statement(name, sql, example)
+    elif statement.sql != sql:
+      raise ValueError(f"Statement '{name}' already registered with other query")
+  return name
+
+def get_statement(name):
+  """
+  Retrieve registered statement by name.
+  """
+  try:
+    return _statements[name]
+  except KeyError:
+    raise DatabaseException(f"No such statement: '{name}'") from None
+
+def get_statements():
+  """
+  Return list of all registered statements.
+  """
+  return list(_statements.values())
+
+def get_statement_stats():
+  """
+  Report statistics for each registered statement, by name.
+  """
+  return {name: statement.stats() for (name, statement) in _statements.items()}
@@ -5,10 +5,17 @@
 Routes for checking status of application and dependencies
 """
 
-from flask import Blueprint
-from .db import get_schema_version, upgrade_schema
-from .ldap import get_ldap
-from .exceptions import ImpossibleSchemaUpgrade
+from flask import Blueprint, jsonify
+from .access import get_access_cache_stats, get_access_stats
+from .auth import admin_required
+from .catalogue import reoptimize_catalogues
+from .db import get_schema_version, get_pool_stats, get_replica_stats
+from .ldap import (
+  get_breaker_stats, get_person_cache_stats, get_ldap_pool_stats, probe_person
+)
+from .querystats import get_query_stats
+from .statements import get_statement_stats
+from .exceptions import DatabaseException
 
 
 # establish blueprint
@@ -47,11 +54,11 @@ def _check_status_ldap(statuses):
 
   status = 200
 
-  # try to get an LDAP record
+  # try to get an LDAP record from the directory itself, not the cache
   try:
     # TODO: make configurable
     # if config.ldap_canary:
-    canary = get_ldap().get_person('canary')
+    canary = probe_person('canary')
   except Exception as e:
     statuses.append(f"LDAP: {e}")
     status = 500
@@ -62,6 +69,16 @@ def _check_status_ldap(statuses):
     else:
       statuses.append("LDAP: Okay")
 
+  breaker = get_breaker_stats()
+  statuses.append(
+    f"LDAP: Circuit breaker {breaker['state']} ({breaker['failures']} "
+    f"consecutive failures, {breaker['opens']} opens, {breaker['rejected']} "
+    f"calls rejected)")
+  if breaker['state'] != 'closed':
+    if breaker['last_error']:
+      statuses.append(f"LDAP: Last error: {breaker['last_error']}")
+    status = 500
+
   return status
 
 # ---------------------------------------------------------------------------
@@ -97,6 +114,22 @@ def get_services_status_ldap():
   status_all = "\n".join(statuses)
   return status_all, status, {'Content-type': 'text/plain; charset=utf-8'}
 
+@bp.route('/services/ldap/cache', methods=['GET'])
+@admin_required
+def get_services_status_ldap_cache():
+  """
+  Reports person cache hit rates and directory lookup latency.
+  """
+  return jsonify(get_person_cache_stats())
+
+@bp.route('/services/ldap/pool', methods=['GET'])
+@admin_required
+def get_services_status_ldap_pool():
+  """
+  Reports LDAP connection pool statistics.
+  """
+  return jsonify(get_ldap_pool_stats())
+
 @bp.route('/services/db', methods=['GET'])
 def get_services_status_db():
 
@@ -120,19 +153,74 @@ def get_services_status():
   status_all = "\n".join(statuses)
   return status_all, status, {'Content-type': 'text/plain; charset=utf-8'}
 
-# Use as a startup probe.  Will check DB schema version and update if necessary.
+@bp.route('/services/db/pool', methods=['GET'])
+@admin_required
+def get_services_status_db_pool():
+  """
+  Reports database connection pool statistics.
+  """
+  return jsonify(get_pool_stats())
+
+@bp.route('/services/db/replicas', methods=['GET'])
+@admin_required
+def get_services_status_db_replicas():
+  """
+  Reports read replica health and selection counts.
+  """
+  return jsonify(get_replica_stats())
+
+@bp.route('/services/db/statements', methods=['GET'])
+@admin_required
+def get_services_status_db_statements():
+  """
+  Reports execution statistics of registered statements.
+  """
+  return jsonify(get_statement_stats())
+
+@bp.route('/services/db/queries', methods=['GET'])
+@admin_required
+def get_services_status_db_queries():
+  """
+  Reports timings of database queries, by normalized query text.
+  """
+  return jsonify(get_query_stats())
+
+@bp.route('/access', methods=['GET'])
+@admin_required
+def get_access_status():
+  """
+  Reports compiled access string cache statistics and, if enabled, predicate
+  evaluation counts.
+  """
+  return jsonify(cache=get_access_cache_stats(), predicates=get_access_stats())
+
+@bp.route('/access/reoptimize', methods=['POST'])
+@admin_required
+def reoptimize_access():
+  """
+  Reorders access evaluation according to the predicate statistics gathered
+  so far.
+  """
+  if get_access_stats() is None:
+    return jsonify(error='Access statistics are not enabled'), 409
+  reoptimize_catalogues()
+  return jsonify(predicates=get_access_stats())
+
+# Use as a startup probe.  Reports whether the DB schema is at the version the
+# code expects; upgrades are run with the `upgrade-db` command rather than on a
+# request anyone can make.
 @bp.route('/db', methods=['GET'])
-def update_db():
+def check_db():
   try:
-    (actual, expected, actions) = upgrade_schema()
-    if actions:
-      path = "\n".join(actions)
-      status_text = f"DB required upgrade from {actual} to {expected}\n{path}"
-    else:
-      status_text = f"DB schema at {actual}, code schema at {expected}, no action taken"
+    (actual, expected) = get_schema_version()
+  except DatabaseException as e:
+    return str(e), 500, {'Content-type': 'text/plain; charset=utf-8'}
+
+  if actual == expected:
+    status_text = f"DB schema at {actual}, code schema at {expected}"
     status_code = 200
-  except ImpossibleSchemaUpgrade as e:
-    status_text = str(e)
-    status_code = 500
+  else:
+    status_text = f"DB schema at {actual}, code schema at {expected}; upgrade required"
+    status_code = 503
 
   return status_text, status_code, {'Content-type': 'text/plain; charset=utf-8'}
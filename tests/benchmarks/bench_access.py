@@ -0,0 +1,191 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Benchmark suite for drax.access.
+
+Generates synthetic catalogues of access strings with controlled depth, width
+and predicate vocabulary, along with synthetic user rights, and times parsing,
+compilation and evaluation separately, as well as building and querying the
+access index over the whole catalogue.  Results are written as JSON so that
+runs can be compared to catch performance regressions.
+
+Usage:
+  PYTHONPATH=. python tests/benchmarks/bench_access.py [-o results.json]
+  PYTHONPATH=. python tests/benchmarks/bench_access.py -o new.json \\
+    --compare old.json [--tolerance 0.25]
+
+When comparing, any timing more than `tolerance` (as a fraction) slower than
+in the baseline is reported and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from drax import access
+
+# Scenarios: number of access strings, maximum nesting depth, maximum
+# children per AND/OR node, number of distinct values per attribute, number of
+# synthetic users and number of values held by each per attribute
+SCENARIOS = {
+  'flat': dict(strings=500, depth=0, width=1, vocabulary=50, users=100, held=5),
+  'shallow': dict(strings=500, depth=1, width=4, vocabulary=50, users=100, held=5),
+  'deep': dict(strings=500, depth=4, width=3, vocabulary=50, users=100, held=5),
+  'wide': dict(strings=200, depth=1, width=50, vocabulary=200, users=100, held=20),
+  'large-catalogue': dict(strings=10000, depth=2, width=3, vocabulary=1000, users=50, held=10),
+  'many-entitlements': dict(strings=1000, depth=2, width=3, vocabulary=5000, users=20, held=2000),
+}
+
+KEYS = ['eduPersonAffiliation', 'eduPersonEntitlement']
+
+# ---------------------------------------------------------------------------
+#                                                               generation
+# ---------------------------------------------------------------------------
+
+def generate_restriction(rng, depth, width, vocabulary):
+  """
+  Generate access string nested up to `depth` levels with up to `width`
+  children per node.
+  """
+  if depth == 0 or rng.random() < 0.2:
+    return f'({rng.choice(KEYS)}=value{rng.randrange(vocabulary)})'
+  children = ''.join(
+    generate_restriction(rng, depth - 1, width, vocabulary)
+    for i in range(rng.randint(1, width))
+  )
+  return f"({rng.choice('&|')}{children})"
+
+def generate_corpus(rng, strings, depth, width, vocabulary, **_):
+  return [
+    generate_restriction(rng, depth, width, vocabulary) for i in range(strings)
+  ]
+
+def generate_users(rng, users, vocabulary, held, **_):
+  values = [f'value{i}' for i in range(vocabulary)]
+  return [
+    access.Rights({key: rng.sample(values, min(held, vocabulary)) for key in KEYS})
+    for i in range(users)
+  ]
+
+# ---------------------------------------------------------------------------
+#                                                                   timing
+# ---------------------------------------------------------------------------
+
+def best_of(fn, repeat=3):
+  """
+  Return the shortest of `repeat` timings of `fn()`, in seconds.
+  """
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def run_scenario(name, params, seed):
+  rng = random.Random(seed)
+  corpus = generate_corpus(rng, **params)
+  users = generate_users(rng, **params)
+  evaluators = [access.Evaluator(s) for s in corpus]
+  programs = [e.compile() for e in evaluators]
+  index = access.AccessIndex(corpus)
+
+  def parse():
+    for s in corpus:
+      access.Evaluator.buildtree(s)
+
+  def compile_():
+    for e in evaluators:
+      e.compile()
+
+  def evaluate():
+    for rights in users:
+      for program in programs:
+        program(rights)
+
+  def build_index():
+    access.AccessIndex(corpus)
+
+  def query_index():
+    for rights in users:
+      index.visible(rights)
+
+  evaluations = len(corpus) * len(users)
+  visible = sum(len(index.visible(rights)) for rights in users) / len(users)
+  result = {
+    'parse_us': best_of(parse) / len(corpus) * 1e6,
+    'compile_us': best_of(compile_) / len(corpus) * 1e6,
+    'evaluate_ns': best_of(evaluate) / evaluations * 1e9,
+    'index_build_ms': best_of(build_index) * 1e3,
+    'index_query_us': best_of(query_index) / len(users) * 1e6,
+  }
+  info = {
+    'strings': len(corpus),
+    'mean_length': sum(map(len, corpus)) / len(corpus),
+    'mean_visible': visible,
+  }
+  return (result, info)
+
+# ---------------------------------------------------------------------------
+#                                                               reporting
+# ---------------------------------------------------------------------------
+
+def compare(results, baseline, tolerance):
+  """
+  Return list of descriptions of timings which regressed beyond tolerance.
+  """
+  regressions = []
+  for (scenario, timings) in results.items():
+    base = baseline.get(scenario, {}).get('timings', {})
+    for (metric, value) in timings['timings'].items():
+      if metric in base and base[metric] > 0:
+        ratio = value / base[metric]
+        if ratio > 1 + tolerance:
+          regressions.append(
+            f"{scenario}.{metric}: {base[metric]:.3f} -> {value:.3f} ({ratio:.2f}x)")
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark drax.access')
+  parser.add_argument('-o', '--output', help='write JSON results to file')
+  parser.add_argument('--compare', help='baseline JSON results to compare to')
+  parser.add_argument('--tolerance', type=float, default=0.25,
+    help='fraction slower than baseline considered a regression')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+    help='scenario to run (default: all); may be repeated')
+  args = parser.parse_args(argv)
+
+  results = {}
+  for name in args.scenario or SCENARIOS:
+    (timings, info) = run_scenario(name, SCENARIOS[name], args.seed)
+    results[name] = {'params': SCENARIOS[name], 'info': info, 'timings': timings}
+    print(f"{name:>18}: " + ', '.join(f"{k}={v:.3f}" for (k, v) in timings.items()))
+
+  document = {
+    'benchmark': 'drax.access',
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'seed': args.seed,
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w', encoding='utf8') as f:
+      json.dump(document, f, indent=2)
+
+  if args.compare:
+    with open(args.compare, encoding='utf8') as f:
+      baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
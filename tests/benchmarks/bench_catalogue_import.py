@@ -0,0 +1,97 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Benchmark of catalogue import and export with a large synthetic catalogue.
+
+Generates a catalogue of the given number of service definitions (services
+times languages) as JSON lines, imports it into a new SQLite database, then
+imports it again (with every record unchanged) and exports it.  Reports
+elapsed time for each step and, with --memory, the peak memory allocated by
+Python, which should not grow with the size of the catalogue.  Tracing
+memory slows everything down considerably.
+
+Usage:
+  PYTHONPATH=. python tests/benchmarks/bench_catalogue_import.py \\
+    [--definitions 100000] [--languages 2] [--memory]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from flask import Flask
+from drax import catalogue, db
+
+def generate(path, definitions, languages):
+  langs = ['en', 'fr', 'de', 'es'][:languages]
+  services = definitions // len(langs)
+  with open(path, 'w', encoding='utf8') as f:
+    def write(**record):
+      f.write(json.dumps(record))
+      f.write('\n')
+    for i in range(20):
+      write(table='categories', name=f'cat{i}', ordr=i)
+      for lang in langs:
+        write(table='titles', name=f'cat{i}', language=lang, title=f'Category {i}')
+    for i in range(services):
+      write(table='services', name=f'service{i}', sso=bool(i % 2))
+    for i in range(services):
+      for lang in langs:
+        write(table='service_definitions', service=f'service{i}', language=lang,
+              title=f'Service {i}', description='A service ' * 10)
+    for i in range(services):
+      write(table='service_access', service=f'service{i}', category=f'cat{i % 20}',
+            url=f'https://example.org/{i}', access=f'eduPersonEntitlement=e{i % 50}',
+            icon_url=None)
+  return services * len(langs)
+
+def measure(fn, memory):
+  if memory:
+    tracemalloc.start()
+  start = time.perf_counter()
+  fn()
+  elapsed = time.perf_counter() - start
+  if not memory:
+    return f"{elapsed:.2f}s"
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return f"{elapsed:.2f}s, peak {peak / 1e6:.1f} MB"
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark catalogue import/export')
+  parser.add_argument('--definitions', type=int, default=100000)
+  parser.add_argument('--languages', type=int, default=2)
+  parser.add_argument('--memory', action='store_true', help='trace peak memory')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    source = os.path.join(tmpdir, 'catalogue.jsonl')
+    definitions = generate(source, args.definitions, args.languages)
+    print(f"{definitions} service definitions, "
+          f"{os.path.getsize(source) / 1e6:.1f} MB of JSON lines")
+
+    app = Flask('drax')
+    app.config['DATABASE_URI'] = f'file://{tmpdir}/drax.sqlite'
+    with app.app_context():
+      db.init_db()
+
+      def load():
+        with open(source, encoding='utf8') as f:
+          return catalogue.import_catalogue(f)
+
+      def dump():
+        with open(os.devnull, 'w', encoding='utf8') as f:
+          count = 0
+          for line in catalogue.export_catalogue():
+            f.write(line)
+            count += 1
+          return count
+
+      for (name, fn) in (('import', load), ('reimport', load), ('export', dump)):
+        print(f"{name:>10}: {measure(fn, args.memory)}")
+      db.close_db()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,43 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Benchmark parsing of access strings of increasing length.  Parsing should be
+linear in the length of the access string, so the time per predicate should
+stay roughly constant as the number of predicates grows.
+
+Usage: PYTHONPATH=. python tests/benchmarks/bench_parse.py
+"""
+import timeit
+from drax.access import Evaluator
+
+SIZES = [10, 100, 1000, 10000]
+
+def make_access_string(predicates):
+  """
+  Build an AND of the given number of entitlement predicates.
+  """
+  preds = ''.join(
+    f'(eduPersonEntitlement=drax.example.org/service{i})'
+    for i in range(predicates)
+  )
+  return f'&{preds}'
+
+def main():
+  print(f"{'predicates':>10} {'length':>8} {'total (ms)':>12} {'per pred (us)':>14}")
+  per_pred = []
+  for size in SIZES:
+    string = make_access_string(size)
+    number = max(1, 10000 // size)
+    elapsed = min(timeit.repeat(
+      lambda s=string: Evaluator.buildtree(s), number=number, repeat=3
+    )) / number
+    per_pred.append(elapsed / size)
+    print(f"{size:>10} {len(string):>8} {elapsed * 1e3:>12.3f} "
+          f"{elapsed / size * 1e6:>14.3f}")
+
+  # ratio of per-predicate cost at largest size to smallest; ~1 when linear
+  print(f"scaling ratio ({SIZES[-1]} vs {SIZES[0]}): {per_pred[-1] / per_pred[0]:.2f}")
+
+if __name__ == '__main__':
+  main()
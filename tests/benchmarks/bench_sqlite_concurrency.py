@@ -0,0 +1,127 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Benchmark of concurrent reads and writes against an SQLite database under
+each connection profile.  Reader threads repeatedly load the catalogue
+listing, as the dashboard does, while a writer thread repeatedly updates the
+catalogue.  Under the default profile each read opens its own connection, as
+each request did; under profiles with shared readers, each reader thread
+keeps a read-only connection.
+
+Reports read and write throughput, read latency, and the number of operations
+which failed waiting for a lock.
+
+Usage:
+  PYTHONPATH=. python tests/benchmarks/bench_sqlite_concurrency.py \\
+    [--readers 8] [--duration 5] [--services 500]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from drax.catalogue import SQL_GET_ALL
+from drax.db_sqlite import PROFILES, open_db_sqlite
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', '..', 'drax', 'sql', 'schema.sql')
+
+def create_db(path, services):
+  conn = open_db_sqlite(f'file://{path}')
+  with open(SCHEMA, encoding='utf8') as f:
+    conn.executescript(f.read())
+  conn.execute("INSERT INTO categories (name, ordr) VALUES ('cat', 1)")
+  conn.execute("INSERT INTO titles (name, language, title) VALUES ('cat', 'en', 'Cat')")
+  for i in range(services):
+    conn.execute("INSERT INTO services (name) VALUES (?)", (f'service{i}',))
+    conn.execute(
+      "INSERT INTO service_definitions (service, language, title, description) "
+      "VALUES (?, 'en', ?, 'A service')", (f'service{i}', f'Service {i}'))
+    conn.execute(
+      "INSERT INTO service_access (service, category, url) VALUES (?, 'cat', ?)",
+      (f'service{i}', f'https://example.org/{i}'))
+  conn.commit()
+  conn.close()
+
+def run(path, profile, readers, duration):
+  uri = f'file://{path}'
+  shared = PROFILES[profile]['shared_readers']
+  stop = threading.Event()
+  latencies = []
+  counts = {'reads': 0, 'writes': 0, 'busy': 0}
+  lock = threading.Lock()
+
+  def reader():
+    mine = []
+    busy = 0
+    conn = open_db_sqlite(uri, profile, readonly=True) if shared else None
+    while not stop.is_set():
+      start = time.perf_counter()
+      try:
+        c = conn or open_db_sqlite(uri, profile)
+        c.execute(SQL_GET_ALL, ('en',)).fetchall()
+        if not conn:
+          c.close()
+      except sqlite3.OperationalError:
+        busy += 1
+        continue
+      mine.append(time.perf_counter() - start)
+    with lock:
+      latencies.extend(mine)
+      counts['reads'] += len(mine)
+      counts['busy'] += busy
+
+  def writer():
+    conn = open_db_sqlite(uri, profile)
+    i = 0
+    while not stop.is_set():
+      try:
+        conn.execute(
+          "UPDATE service_definitions SET description = ? WHERE service = ?",
+          (f'Updated {i}', f'service{i % 10}'))
+        conn.commit()
+        counts['writes'] += 1
+      except sqlite3.OperationalError:
+        conn.rollback()
+        counts['busy'] += 1
+      i += 1
+    conn.close()
+
+  threads = [threading.Thread(target=reader) for i in range(readers)]
+  threads.append(threading.Thread(target=writer))
+  for thread in threads:
+    thread.start()
+  time.sleep(duration)
+  stop.set()
+  for thread in threads:
+    thread.join()
+
+  latencies.sort()
+  def percentile(p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e3 \
+      if latencies else 0.0
+  return {
+    'reads_per_s': counts['reads'] / duration,
+    'writes_per_s': counts['writes'] / duration,
+    'read_p50_ms': percentile(0.5),
+    'read_p99_ms': percentile(0.99),
+    'busy': counts['busy'],
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark SQLite profiles')
+  parser.add_argument('--readers', type=int, default=8)
+  parser.add_argument('--duration', type=float, default=5)
+  parser.add_argument('--services', type=int, default=500)
+  args = parser.parse_args()
+
+  for profile in PROFILES:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'drax.sqlite')
+      create_db(path, args.services)
+      result = run(path, profile, args.readers, args.duration)
+    print(f"{profile:>12}: " + ', '.join(f"{k}={v:.2f}" for (k, v) in result.items()))
+
+if __name__ == '__main__':
+  main()
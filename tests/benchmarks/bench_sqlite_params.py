@@ -0,0 +1,112 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Micro-benchmark of query rewriting and parameter conversion in the SQLite
+connection class, comparing the cached rewrite against the previous approach
+of tokenizing every query on every call.  Only the rewriting is timed, not
+query execution.
+
+Usage: PYTHONPATH=. python tests/benchmarks/bench_sqlite_params.py
+"""
+from enum import Enum
+import re
+import timeit
+from drax.db_sqlite import rewrite_query
+
+# ---------------------------------------------------------------------------
+#                                                        previous approach
+# ---------------------------------------------------------------------------
+
+def iter_flatten(iterable):
+  it = iter(iterable)
+  for e in it:
+    if isinstance(e, (list, tuple)):
+      for f in iter_flatten(e):
+        yield f
+    else:
+      yield e
+
+def nextqparm(sql):
+  regex = re.compile("((?:[^?']*(?:'[^']*')?)*)")
+  everythingelse = ''
+  for m in regex.finditer(sql):
+    if m.groups()[0] == '':
+      yield everythingelse
+      everythingelse = ''
+    else:
+      everythingelse += m.groups()[0]
+  if everythingelse != '':
+    yield everythingelse
+
+def legacy(sql, parameters):
+  newsql = ''
+  qparms = nextqparm(sql)
+  converted = []
+  for p in parameters:
+    newsql += next(qparms)
+    if isinstance(p, (list, tuple)):
+      newsql += ','.join(['?'] * len(p))
+    else:
+      newsql += '?'
+    if issubclass(type(p), Enum):
+      converted.append(p.value)
+    else:
+      converted.append(p)
+  for tok in qparms:
+    newsql += tok
+  return (newsql, list(iter_flatten(converted)))
+
+# ---------------------------------------------------------------------------
+#                                                            current approach
+# ---------------------------------------------------------------------------
+
+def current(sql, parameters):
+  # mirrors ExtConnection.execute() up to the point of execution
+  shape = []
+  converted = []
+  expand = False
+  for p in parameters:
+    if isinstance(p, (list, tuple)):
+      shape.append(len(p))
+      converted.extend(p)
+      expand = True
+    else:
+      shape.append(None)
+      converted.append(p.value if isinstance(p, Enum) else p)
+  if expand:
+    sql = rewrite_query(sql, tuple(shape))
+  return (sql, converted)
+
+CASES = {
+  'scalar': (
+    "SELECT * FROM all_services WHERE language = ? AND service = ?",
+    ('en', 'service1')
+  ),
+  'list-10': (
+    "SELECT * FROM all_services WHERE language = ? AND service IN (?)",
+    ('en', [f'service{i}' for i in range(10)])
+  ),
+  'list-1000': (
+    "SELECT * FROM all_services WHERE language = ? AND service IN (?)",
+    ('en', [f'service{i}' for i in range(1000)])
+  ),
+  'long-query': (
+    "SELECT * FROM all_services WHERE language = ? AND title != 'what?' "
+    + " AND description IS NOT NULL" * 50 + " AND service IN (?)",
+    ('en', ['a', 'b', 'c'])
+  ),
+}
+
+def main():
+  print(f"{'case':>12} {'legacy (us)':>12} {'current (us)':>13} {'speedup':>8}")
+  for (name, (sql, parameters)) in CASES.items():
+    assert legacy(sql, parameters) == current(sql, parameters)
+    number = 2000
+    old = min(timeit.repeat(lambda: legacy(sql, parameters), number=number, repeat=3))
+    new = min(timeit.repeat(lambda: current(sql, parameters), number=number, repeat=3))
+    print(f"{name:>12} {old / number * 1e6:>12.2f} {new / number * 1e6:>13.2f} "
+          f"{old / new:>7.1f}x")
+
+if __name__ == '__main__':
+  main()
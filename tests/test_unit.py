@@ -1,7 +1,75 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+import importlib
+import random
+import sqlite3
+import sys
+import threading
+import time
+import types
+import pytest
+from flask import Flask, g, session
 from drax import access
+from drax import breaker
+from drax import cache
+from drax import catalogue
+from drax import db
+from drax import db_postgres
+from drax import db_sqlite
+from drax import people
+from drax import pool
+from drax import querystats
+from drax import replicas
+from drax import statements
+from drax.exceptions import (
+  AccessSyntaxError, CallTimeout, CircuitOpen, DatabaseException,
+  InvalidCatalogue, LdapException, PoolTimeout
+)
+
+@pytest.fixture
+def app(tmp_path):
+  """
+  Bare application with an initialized SQLite database.
+  """
+  app = Flask('drax')
+  app.config['DATABASE_URI'] = f'file://{tmp_path}/drax.sqlite'
+  with app.app_context():
+    db.init_db()
+    db.close_db()
+  catalogue.invalidate_catalogues()
+  yield app
+
+@pytest.fixture
+def drax_ldap(monkeypatch):
+  """
+  The drax.ldap module, imported afresh with stand-ins for python-ldap and
+  orgldap, which are only needed here for their exceptions and constants.
+  """
+  ldap = types.ModuleType('ldap')
+  ldap.LDAPError = type('LDAPError', (Exception,), {})
+  for name in ('SERVER_DOWN', 'TIMEOUT', 'INVALID_CREDENTIALS'):
+    setattr(ldap, name, type(name, (ldap.LDAPError,), {}))
+  for (i, name) in enumerate((
+      'OPT_X_TLS_REQUIRE_CERT', 'OPT_X_TLS_NEVER', 'OPT_X_TLS_ALLOW',
+      'OPT_X_TLS_TRY', 'OPT_X_TLS_DEMAND', 'OPT_TIMEOUT', 'OPT_NETWORK_TIMEOUT',
+      'VERSION3', 'SCOPE_SUBTREE')):
+    setattr(ldap, name, i)
+  ldap.controls = types.ModuleType('ldap.controls')
+  ldap.controls.SimplePagedResultsControl = None
+  ldap.filter = types.ModuleType('ldap.filter')
+  ldap.filter.escape_filter_chars = lambda s: s
+  orgldap = types.ModuleType('orgldap')
+  orgldap.orgldap = types.ModuleType('orgldap.orgldap')
+
+  for module in (ldap, ldap.controls, ldap.filter, orgldap, orgldap.orgldap):
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+  for name in ('drax.ldap', 'drax.auth', 'drax.dashboard', 'drax.status'):
+    monkeypatch.delitem(sys.modules, name, raising=False)
+  module = importlib.import_module('drax.ldap')
+  yield module
+  for name in ('drax.ldap', 'drax.auth', 'drax.dashboard', 'drax.status'):
+    sys.modules.pop(name, None)
 
 def test_access_evaluation():
 
@@ -113,3 +181,1440 @@ def test_access_evaluation():
 
   assert access.Evaluator(s9t1).evaluate(kv)
   assert not access.Evaluator(s9f1).evaluate(kv)
+
+def test_access_compiled():
+
+  kv = {
+    'key1': 'value1',
+    'key2': 'value2',
+    'key3': 'value3'
+  }
+
+  cases = {
+    'key1=value1': True,
+    '(key1=snarf)': False,
+    '&(key1=value1)(key2=value2)': True,
+    '&(key1=value1)(key2=snarf)': False,
+    '|(key1=snarf)(key2=value2)': True,
+    '|(key1=snarf)(key2=snarf)': False,
+    '|(key1=snarf)(&(key2=value2)(key3=value3))': True,
+    '&(key1=value1)(|(key2=snarf)(key3=snarf))': False,
+    '(&(|(key1=value1)(key2=value2))(key3=value3))': True,
+  }
+
+  access.compile_access.cache_clear()
+
+  # compiled form evaluates the same as the parse tree
+  for (restriction, expected) in cases.items():
+    assert access.Evaluator(restriction).evaluate(kv) == expected
+    assert access.compile_access(restriction)(kv) == expected
+
+  stats = access.get_access_cache_stats()
+  assert stats['misses'] == len(cases)
+  assert stats['hits'] == 0
+  assert stats['size'] == len(cases)
+
+  # second time around everything comes out of the cache
+  for (restriction, expected) in cases.items():
+    assert access.evaluate_access(restriction, kv) == expected
+
+  stats = access.get_access_cache_stats()
+  assert stats['misses'] == len(cases)
+  assert stats['hits'] == len(cases)
+
+def test_access_syntax_errors():
+
+  # each bad access string and the position at which it should be rejected
+  cases = {
+    '': 0,
+    ')': 0,
+    '()': 1,
+    '(key1=value1': 12,
+    '&(key1=value1))': 14,
+    '(key1=value1)(key2=value2)': 25,
+    '&(key1 value1)': 2,
+    '&&(key1=value1)': 15,
+  }
+
+  for (restriction, position) in cases.items():
+    with pytest.raises(AccessSyntaxError) as excinfo:
+      access.Evaluator(restriction)
+    assert excinfo.value.position == position
+
+def test_access_rights():
+
+  entitlements = [f'drax.example.org/service{i}' for i in range(5000)]
+  rights = access.Rights({
+    'eduPersonAffiliation': 'staff',
+    'eduPersonEntitlement': entitlements + entitlements[:10]
+  })
+
+  assert rights.has('eduPersonAffiliation', 'staff')
+  assert rights.has('eduPersonEntitlement', 'drax.example.org/service4999')
+  assert not rights.has('eduPersonEntitlement', 'drax.example.org/service5000')
+  assert not rights.has('uid', 'staff')
+  assert len(rights.to_dict()['eduPersonEntitlement']) == 5000
+
+  # exact matching, not substring matching of plain string values
+  kv = {'eduPersonAffiliation': 'staff'}
+  assert access.evaluate_access('eduPersonAffiliation=staff', kv)
+  assert not access.evaluate_access('eduPersonAffiliation=staf', kv)
+  assert not access.Evaluator('eduPersonAffiliation=taf').evaluate(kv)
+
+  # all evaluators accept Rights objects as well as dicts
+  restriction = '&(eduPersonAffiliation=staff)(eduPersonEntitlement=drax.example.org/service42)'
+  assert access.Evaluator(restriction).evaluate(rights)
+  assert access.compile_access(restriction)(rights)
+  assert access.evaluate_access(restriction, rights)
+  assert access.evaluate_access(restriction, rights.to_dict())
+
+KEYS = ['eduPersonAffiliation', 'eduPersonEntitlement']
+VALUES = [f'value{i}' for i in range(20)]
+
+def random_restriction(rng, depth=0):
+  """
+  Generate random access string.
+  """
+  if depth > 1 or rng.random() < 0.3:
+    return f'({rng.choice(KEYS)}={rng.choice(VALUES)})'
+  children = ''.join(
+    random_restriction(rng, depth + 1) for i in range(rng.randint(1, 3))
+  )
+  return f"({rng.choice('&|')}{children})"
+
+def random_rights(rng):
+  """
+  Generate random access rights.
+  """
+  return access.Rights({
+    key: rng.sample(VALUES, rng.randint(0, 5)) for key in KEYS
+  })
+
+def populate_catalogue(conn, restrictions):
+  """
+  Load catalogue with one service per access string, all in one category.
+  """
+  conn.executescript("""
+    INSERT INTO categories (name, ordr) VALUES ('general', 1);
+    INSERT INTO titles (name, language, title) VALUES ('general', 'en', 'General');
+  """)
+  services = [f'service{i:05}' for i in range(len(restrictions))]
+  conn.executemany("INSERT INTO services (name) VALUES (?)",
+    [(service,) for service in services])
+  conn.executemany(
+    "INSERT INTO service_definitions (service, language, title) VALUES (?, 'en', ?)",
+    [(service, service) for service in services])
+  conn.executemany(
+    "INSERT INTO service_access (service, category, url, access) VALUES (?, 'general', ?, ?)",
+    [(service, f'https://{service}', restriction)
+     for (service, restriction) in zip(services, restrictions)])
+  conn.commit()
+  return services
+
+def test_access_dnf():
+
+  assert access.Evaluator('key1=value1').dnf() == [
+    frozenset([('key1', 'value1')])
+  ]
+  assert access.Evaluator('&(key1=value1)(|(key2=value2)(key3=value3))').dnf() == [
+    frozenset([('key1', 'value1'), ('key2', 'value2')]),
+    frozenset([('key1', 'value1'), ('key3', 'value3')])
+  ]
+
+  # redundant clauses are absorbed
+  assert access.Evaluator('|(key1=value1)(&(key1=value1)(key2=value2))').dnf() == [
+    frozenset([('key1', 'value1')])
+  ]
+
+  # degenerate cases
+  assert access.Evaluator('&').dnf() == [frozenset()]
+  assert access.Evaluator('|').dnf() == []
+
+  # too large
+  restriction = '&' + ''.join(f'(|(key1=value{i})(key2=value{i}))' for i in range(7))
+  assert access.Evaluator(restriction).dnf() is None
+  assert len(access.Evaluator(restriction).dnf(limit=128)) == 128
+
+def test_access_index():
+
+  rng = random.Random(42)
+  restrictions = [
+    None if rng.random() < 0.2 else random_restriction(rng) for i in range(500)
+  ]
+  restrictions += ['&', None, '&']
+  index = access.AccessIndex(restrictions)
+  assert len(index) == len(restrictions)
+
+  # index gives same answers as evaluating every access string
+  for i in range(50):
+    rights = random_rights(rng)
+    expected = [
+      pos for (pos, restriction) in enumerate(restrictions)
+      if not restriction or access.evaluate_access(restriction, rights)
+    ]
+    assert index.visible(rights) == expected
+
+  assert index.unrestricted() == [
+    pos for (pos, restriction) in enumerate(restrictions)
+    if restriction in (None, '&')
+  ]
+
+def test_catalogue(app):
+
+  with app.app_context():
+    conn = db.get_db()
+    conn.executescript("""
+      INSERT INTO services (name) VALUES ('open'), ('staff'), ('admin');
+      INSERT INTO categories (name, ordr) VALUES ('general', 1), ('admin', 2);
+      INSERT INTO titles (name, language, title)
+        VALUES ('general', 'en', 'General'), ('admin', 'en', 'Admin');
+      INSERT INTO service_definitions (service, language, title)
+        VALUES ('open', 'en', 'Open'), ('staff', 'en', 'Staff'),
+               ('admin', 'en', 'Admin');
+      INSERT INTO service_access (service, category, url, access)
+        VALUES ('open', 'general', 'https://open', NULL),
+               ('staff', 'general', 'https://staff', 'eduPersonAffiliation=staff'),
+               ('admin', 'admin', 'https://admin', '&(eduPersonAffiliation=staff)(eduPersonEntitlement=admin)');
+    """)
+    conn.commit()
+
+    staff = {'eduPersonAffiliation': ['staff']}
+    cat = catalogue.get_catalogue('en')
+    assert len(cat) == 3
+    assert [rec['service'] for rec in cat.unrestricted()] == ['open']
+    assert [rec['service'] for rec in cat.visible(staff)] == ['open', 'staff']
+
+    # unchanged catalogue is not reloaded
+    assert catalogue.get_catalogue('en') is cat
+
+    # changes to the catalogue are picked up
+    conn.execute("UPDATE service_access SET access = NULL WHERE service = 'admin'")
+    conn.commit()
+    assert catalogue.get_catalogue_version() > cat.version
+    cat = catalogue.get_catalogue('en')
+    assert [rec['service'] for rec in cat.visible(staff)] == ['open', 'staff', 'admin']
+
+def test_lru_cache():
+
+  lru = cache.LruCache(2)
+  lru.validate(1)
+  lru.put('a', 1)
+  lru.put('b', 2)
+  assert lru.get('a') == 1
+
+  # 'b' is least recently used and so evicted
+  lru.put('c', 3)
+  assert lru.get('b') is None
+  assert lru.get('c') == 3
+  assert len(lru) == 2
+
+  # same version keeps entries; new version discards them
+  lru.validate(1)
+  assert lru.get('a') == 1
+  lru.validate(2)
+  assert lru.get('a', 'gone') == 'gone'
+
+  stats = lru.stats()
+  assert stats['hits'] == 3
+  assert stats['misses'] == 2
+  assert stats['evictions'] == 1
+  assert stats['version'] == 2
+
+  # fingerprints are independent of order and duplication
+  r1 = access.Rights({'a': ['x', 'y'], 'b': 'z'})
+  r2 = access.Rights({'b': ['z', 'z'], 'a': ['y', 'x'], 'c': []})
+  r3 = access.Rights({'a': ['x'], 'b': ['y', 'z']})
+  assert r1.fingerprint() == r2.fingerprint()
+  assert r1.fingerprint() != r3.fingerprint()
+
+def test_access_optimization():
+
+  rights = {'key1': ['common'], 'key3': ['value3']}
+
+  # statically, predicates come before subtrees
+  tree = access.Evaluator('|(&(key1=common)(key2=value2))(key3=value3)')
+  tree.optimize()
+  assert [type(node) for node in tree._root._children] == [
+    access.Evaluator.Predicate, access.Evaluator.AndNode
+  ]
+
+  access.enable_access_stats()
+  try:
+    restriction = '&(key1=common)(key2=rare)'
+
+    # in source order, both predicates are evaluated each time
+    for i in range(100):
+      assert not access.evaluate_access(restriction, rights)
+    stats = access.get_access_stats()
+    assert stats['evaluations'] == 200
+    assert stats['predicates']['key1=common'] == {'evaluations': 100, 'passes': 100}
+    assert stats['predicates']['key2=rare'] == {'evaluations': 100, 'passes': 0}
+
+    # once reordered, the predicate which always fails is evaluated first
+    access.reoptimize_access()
+    for i in range(100):
+      assert not access.evaluate_access(restriction, rights)
+    assert access.get_access_stats()['evaluations'] == 300
+  finally:
+    access.enable_access_stats(False)
+  assert access.get_access_stats() is None
+
+def test_catalogue_sql_filter(app):
+
+  rng = random.Random(7)
+  restrictions = [
+    None if rng.random() < 0.2 else random_restriction(rng) for i in range(300)
+  ]
+  restrictions += ['&', '&' + ''.join(
+    f'(|(eduPersonAffiliation=value{i})(eduPersonEntitlement=value{i}))'
+    for i in range(7)
+  )]
+
+  with app.app_context():
+    conn = db.get_db()
+    services = populate_catalogue(conn, restrictions)
+    (normalized, skipped) = catalogue.refresh_access_rules()
+    assert skipped == 1
+    assert normalized == len(set(filter(None, restrictions))) - 1
+
+    # bad access strings are left out rather than stopping the refresh
+    conn.execute("UPDATE service_access SET access = ? WHERE service = ?",
+      ('(eduPersonAffiliation=value1', services[1]))
+    conn.commit()
+    assert catalogue.refresh_access_rules()[1] == 2
+    conn.execute("UPDATE service_access SET access = ? WHERE service = ?",
+      (restrictions[1], services[1]))
+    conn.commit()
+    assert catalogue.refresh_access_rules() == (normalized, skipped)
+
+    # access string changed after normalization is still handled correctly
+    restrictions[0] = 'eduPersonAffiliation=value0'
+    conn.execute("UPDATE service_access SET access = ? WHERE service = ?",
+      (restrictions[0], services[0]))
+    conn.commit()
+
+    cat = catalogue.get_catalogue('en')
+    for i in range(30):
+      rights = random_rights(rng)
+      expected = [
+        service for (service, restriction) in zip(services, restrictions)
+        if not restriction or access.evaluate_access(restriction, rights)
+      ]
+      assert [rec['service'] for rec in cat.visible(rights)] == expected
+      assert [
+        rec['service'] for rec in catalogue.get_visible_services('en', rights)
+      ] == expected
+
+def test_dashboard_services(app, drax_ldap):
+
+  from drax import dashboard
+  app.secret_key = 'test'
+  rng = random.Random(11)
+  restrictions = [
+    None if rng.random() < 0.2 else random_restriction(rng) for i in range(100)
+  ]
+  with app.app_context():
+    services = populate_catalogue(db.get_db(), restrictions)
+    catalogue.refresh_access_rules()
+    db.close_db()
+
+  def listing(uid=None, rights=None, language='en'):
+    with app.test_request_context('/'):
+      if uid:
+        session['uid'] = uid
+        session['access'] = rights
+      categories = dashboard._get_services(language)
+      db.close_db()
+    if categories is None:
+      return None
+    return [(category, [rec['service'] for rec in recs])
+            for (category, recs) in categories]
+
+  def counts():
+    stats = dashboard._services_cache.stats()
+    return (stats['hits'], stats['misses'])
+
+  # filtering by access index and in the database give the same listings
+  all_rights = [
+    {key: rng.sample(VALUES, rng.randint(0, 5)) for key in KEYS}
+    for i in range(20)
+  ]
+  for rights in all_rights:
+    dashboard._services_cache.clear()
+    app.config['ACCESS_FILTER'] = 'index'
+    by_index = listing('alice', rights)
+    dashboard._services_cache.clear()
+    app.config['ACCESS_FILTER'] = 'sql'
+    assert listing('alice', rights) == by_index
+    expected = [
+      service for (service, restriction) in zip(services, restrictions)
+      if not restriction or access.evaluate_access(restriction, access.Rights(rights))
+    ]
+    assert by_index == ([('General', expected)] if expected else None)
+  app.config['ACCESS_FILTER'] = 'index'
+
+  # listings are shared between users with the same rights, but kept apart
+  # for different rights, languages and anonymous users
+  dashboard._services_cache.clear()
+  (hits, misses) = counts()
+  alice = listing('alice', all_rights[0])
+  assert listing('bob', dict(all_rights[0])) == alice
+  assert counts() == (hits + 1, misses + 1)
+  listing('carol', all_rights[1])
+  assert listing('alice', all_rights[0], 'fr') is None
+  anonymous = listing()
+  assert anonymous == [('General', [
+    service for (service, restriction) in zip(services, restrictions)
+    if not restriction
+  ])]
+  assert listing() == anonymous
+  assert counts() == (hits + 2, misses + 4)
+
+  # listings are rebuilt once the catalogue changes
+  hidden = next(service for (service, restriction) in zip(services, restrictions)
+                if service not in alice[0][1])
+  with app.app_context():
+    conn = db.get_db()
+    conn.execute("UPDATE service_access SET access = NULL WHERE service = ?",
+      (hidden,))
+    conn.commit()
+    db.close_db()
+  assert hidden in listing('bob', all_rights[0])[0][1]
+  assert counts() == (hits + 2, misses + 5)
+
+def test_catalogue_validation(app, tmp_path):
+
+  seedfile = tmp_path / 'seed.sql'
+  seed = """
+    INSERT INTO services (name) VALUES ('good'), ('bad');
+    INSERT INTO categories (name, ordr) VALUES ('general', 1);
+    INSERT INTO titles (name, language, title) VALUES ('general', 'en', 'General');
+    INSERT INTO service_definitions (service, language, title)
+      VALUES ('good', 'en', 'Good'), ('bad', 'en', 'Bad');
+    INSERT INTO service_access (service, category, url, access)
+      VALUES ('good', 'general', 'https://good', 'eduPersonAffiliation=staff'),
+             ('bad', 'general', 'https://bad', '(eduPersonAffiliation=staff');
+  """
+
+  # bad access string is rejected and nothing is loaded
+  seedfile.write_text(seed)
+  with app.app_context():
+    with pytest.raises(InvalidCatalogue) as excinfo:
+      db.seed_db(str(seedfile))
+    assert len(excinfo.value.errors) == 1
+    assert excinfo.value.errors[0].startswith('bad (general)')
+    assert db.get_db().execute('SELECT COUNT(*) AS n FROM services').fetchone()['n'] == 0
+
+  # once fixed, catalogue loads and its access strings are compiled up front
+  seedfile.write_text(seed.replace("'(eduPersonAffiliation=staff'", 'NULL'))
+  with app.app_context():
+    db.seed_db(str(seedfile))
+    access.compile_access.cache_clear()
+    assert catalogue.warm_access_cache() == 1
+    assert access.get_access_cache_stats()['size'] == 1
+
+    # a bad access string which gets in anyway only hides its service
+    conn = db.get_db()
+    conn.execute("UPDATE service_access SET access = '&(' WHERE service = 'good'")
+    conn.commit()
+    rights = access.Rights({'eduPersonAffiliation': ['staff']})
+    assert [
+      rec['service'] for rec in catalogue.get_catalogue('en').visible(rights)
+    ] == ['bad']
+    assert [
+      rec['service'] for rec in catalogue.get_visible_services('en', rights)
+    ] == ['bad']
+
+class FakeConnection:
+  """
+  Stand-in for a connection, for testing pools.
+  """
+
+  def __init__(self):
+    self.closed = False
+    self.healthy = True
+
+  def close(self):
+    self.closed = True
+
+def test_pool():
+
+  conns = []
+  def factory():
+    conns.append(FakeConnection())
+    return conns[-1]
+
+  p = pool.Pool(factory, 2, timeout=0.05, check=lambda c: c.healthy)
+
+  # connections are reused
+  c1 = p.acquire()
+  p.release(c1)
+  assert p.acquire() is c1
+  c2 = p.acquire()
+  assert c2 is not c1
+  stats = p.stats()
+  assert stats['created'] == 2
+  assert stats['in_use'] == 2
+  assert stats['utilisation'] == 1
+
+  # pool is bounded
+  with pytest.raises(PoolTimeout):
+    p.acquire()
+  assert p.stats()['timeouts'] == 1
+
+  # waiting for a connection to be released
+  threading.Timer(0.01, p.release, (c2,)).start()
+  assert p.acquire() is c2
+  stats = p.stats()
+  assert stats['waits'] == 1
+  assert stats['wait_max'] > 0
+
+  # unhealthy connections are replaced
+  p.release(c1)
+  c1.healthy = False
+  c3 = p.acquire()
+  assert c3 is not c1
+  assert c1.closed
+  assert p.stats()['discarded'] == 1
+  p.release(c2)
+  p.release(c3)
+
+  p.close()
+  assert all(c.closed for c in conns)
+
+def test_pool_lifetime():
+
+  def reset(c):
+    if not c.healthy:
+      raise Exception("broken")
+
+  p = pool.Pool(FakeConnection, 1, max_lifetime=0.01, reset=reset)
+
+  # connections are not reused past their lifetime
+  c1 = p.acquire()
+  p.release(c1)
+  time.sleep(0.02)
+  c2 = p.acquire()
+  assert c2 is not c1
+  assert c1.closed
+
+  # connections failing reset are discarded on release
+  c2.healthy = False
+  p.release(c2)
+  assert c2.closed
+  assert p.stats()['size'] == 0
+
+  # connections made before invalidation are not reused, whether idle or in
+  # use at the time
+  p = pool.Pool(FakeConnection, 2)
+  c1 = p.acquire()
+  c2 = p.acquire()
+  p.release(c1)
+  p.invalidate()
+  assert c1.closed
+  p.release(c2)
+  assert c2.closed
+  c3 = p.acquire()
+  p.release(c3)
+  assert p.acquire() is c3
+
+def test_sqlite_list_parameters():
+
+  conn = db.open_db('file::memory:')
+  conn.executescript("""
+    CREATE TABLE t (name TEXT, note TEXT);
+    INSERT INTO t VALUES ('a', 'why?'), ('b', NULL), ('c', NULL);
+  """)
+
+  sql = "SELECT name FROM t WHERE (note = 'why?' OR note IS NULL) AND name IN (?) AND name != ?"
+  db_sqlite.rewrite_query.cache_clear()
+  for i in range(3):
+    res = conn.execute(sql, (['a', 'b', 'c'], 'c')).fetchall()
+    assert [rec['name'] for rec in res] == ['a', 'b']
+  res = conn.execute(sql, (('a',), 'c')).fetchall()
+  assert [rec['name'] for rec in res] == ['a']
+
+  # rewritten once per shape of parameters
+  info = db_sqlite.rewrite_query.cache_info()
+  assert (info.misses, info.hits) == (2, 2)
+
+  # placeholders in quoted strings are not counted
+  assert db_sqlite.split_query("SELECT '?' WHERE a = ? AND b IN (?)") == [
+    "SELECT '?' WHERE a = ", " AND b IN (", ")"
+  ]
+  with pytest.raises(DatabaseException):
+    conn.execute(sql, (['a'],))
+  conn.close()
+
+def test_postgres_row():
+
+  # Postgres rows behave like SQLite rows
+  conn = db.open_db('file::memory:')
+  srow = conn.execute("SELECT 'a' AS service, NULL AS icon_url, 1 AS sso").fetchone()
+  prow = db_postgres.Row(('a', None, 1), {'service': 0, 'icon_url': 1, 'sso': 2})
+  conn.close()
+
+  for row in (srow, prow):
+    assert row['service'] == 'a'
+    assert row[0] == 'a'
+    assert row['icon_url'] is None
+    assert row.keys() == ['service', 'icon_url', 'sso']
+    assert list(row) == ['a', None, 1]
+    assert len(row) == 3
+    assert dict(row) == {'service': 'a', 'icon_url': None, 'sso': 1}
+    with pytest.raises(IndexError):
+      row['snarf']
+
+  # column index is built once per result set
+  class Cursor:
+    _indexed = None
+    _column_index = None
+    _index = db_postgres.DictCursor._index
+  cursor = Cursor()
+  cursor.description = (types.SimpleNamespace(name='service'),)
+  index = cursor._index()
+  assert index == {'service': 0}
+  assert cursor._index() is index
+  cursor.description = (types.SimpleNamespace(name='name'),)
+  assert cursor._index() == {'name': 0}
+
+def test_postgres_convert_query():
+
+  # placeholders in quoted strings are left alone
+  sql = "SELECT name FROM t WHERE note = 'why?' AND name IN (?) AND name != ?"
+  assert db_postgres.convert_query(sql, ('a', 'c')) == (
+    "SELECT name FROM t WHERE note = 'why?' AND name IN (%s) AND name != %s",
+    ('a', 'c'))
+  assert db_postgres.convert_query(sql, (['a', 'b'], 'c')) == (
+    "SELECT name FROM t WHERE note = 'why?' AND name IN (%s,%s) AND name != %s",
+    ['a', 'b', 'c'])
+  assert db_postgres.convert_query(sql, ([], 'c'))[0] == (
+    "SELECT name FROM t WHERE note = 'why?' AND name IN (NULL) AND name != %s")
+
+def test_sqlite_iterate():
+
+  conn = db.open_db('file::memory:')
+  conn.execute("CREATE TABLE t (n INTEGER)")
+  conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(1000)])
+
+  itor = conn.iterate("SELECT n FROM t WHERE n >= ? ORDER BY n", (10,), batch_size=64)
+  assert next(itor)['n'] == 10
+  assert [rec['n'] for rec in itor] == list(range(11, 1000))
+
+  # list parameters work as with execute()
+  assert [
+    rec['n'] for rec in conn.iterate("SELECT n FROM t WHERE n IN (?)", ([3, 1, 2],))
+  ] == [1, 2, 3]
+  conn.close()
+
+def test_statements(app):
+
+  # placeholders are numbered for Postgres, skipping quoted strings
+  name = statements.register_statement(
+    'test_statement', "SELECT ? AS a, '?' AS b, ? AS c")
+  statement = statements.get_statement(name)
+  assert statement.psql == "SELECT $1 AS a, '?' AS b, $2 AS c"
+  assert statement.parameters == 2
+
+  # registration is idempotent but names can't be reused for other queries
+  assert statements.register_statement(name, statement.sql) == name
+  with pytest.raises(ValueError):
+    statements.register_statement(name, "SELECT 1")
+  with pytest.raises(ValueError):
+    statements.register_statement('drop table;', "SELECT 1")
+  with pytest.raises(DatabaseException):
+    statements.get_statement('snarf')
+
+  with app.app_context():
+    conn = db.get_db()
+    row = conn.execute_statement(name, (1, 2)).fetchone()
+    assert (row['a'], row['b'], row['c']) == (1, '?', 2)
+    with pytest.raises(DatabaseException):
+      conn.execute_statement(name, (1,))
+    with pytest.raises(DatabaseException):
+      conn.execute_statement(name, (1, [2, 3]))
+
+    # hot queries are registered
+    assert db.get_schema_version() == (db.SCHEMA_VERSION, db.SCHEMA_VERSION)
+    db.close_db()
+
+  stats = statements.get_statement_stats()
+  assert stats[name]['executions'] == 1
+  assert stats['get_schema_version']['executions'] >= 1
+
+def test_sqlite_profile(app):
+
+  app.config['SQLITE_PROFILE'] = 'production'
+  with app.app_context():
+    reader = db.get_db(readonly=True)
+    assert 'db' not in g
+
+    # reader is kept for this thread across application contexts
+    with app.app_context():
+      assert db.get_db(readonly=True) is reader
+
+    # but not shared with other threads
+    others = []
+    def read():
+      with app.app_context():
+        others.append(db.get_db(readonly=True))
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    assert others[0] is not reader
+
+    # writer is configured per profile and reader sees what it commits
+    writer = db.get_db()
+    assert writer is not reader
+    assert writer.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    writer.execute("UPDATE catalogue_version SET version = 1")
+    writer.commit()
+    assert reader.execute("SELECT version FROM catalogue_version").fetchone()[0] == 1
+    with pytest.raises(sqlite3.OperationalError):
+      reader.execute("UPDATE catalogue_version SET version = 2")
+
+    # once the context has a connection, it is used for reading as well
+    assert db.get_db(readonly=True) is writer
+    db.close_db()
+
+    # readers are replaced once the database is initialized again
+    db.init_db()
+    db.close_db()
+    assert db.get_db(readonly=True) is not reader
+    with pytest.raises(sqlite3.ProgrammingError):
+      reader.execute("SELECT 1")
+
+  app.config['SQLITE_PROFILE'] = 'snarf'
+  with app.app_context():
+    with pytest.raises(DatabaseException):
+      db.get_db()
+
+def test_catalogue_maintained(app):
+
+  def check(conn):
+    # the catalogue table matches what the catalogue tables say it should be
+    assert [tuple(rec) for rec in conn.execute("SELECT * FROM all_services")] \
+      == [tuple(rec) for rec in conn.execute(
+        "SELECT * FROM catalogue_source ORDER BY sortkey, service")]
+
+  with app.app_context():
+    conn = db.get_db()
+    services = populate_catalogue(conn, ['key1=value1', None, None])
+    conn.executescript("""
+      INSERT INTO categories (name, ordr) VALUES ('other', 0);
+      INSERT INTO titles (name, language, title) VALUES ('other', 'en', 'Other');
+    """)
+    assert len(conn.execute("SELECT * FROM all_services").fetchall()) == 3
+    check(conn)
+
+    conn.execute("UPDATE service_access SET category = 'other' WHERE service = ?",
+      (services[2],))
+    conn.execute("UPDATE titles SET title = 'Everything' WHERE name = 'general'")
+    conn.execute("UPDATE services SET sso = 1 WHERE name = ?", (services[0],))
+    check(conn)
+    assert conn.execute("SELECT service FROM all_services").fetchone()[0] == services[2]
+
+    conn.execute("DELETE FROM service_access WHERE service = ?", (services[1],))
+    conn.execute("DELETE FROM service_definitions WHERE service = ?", (services[1],))
+    check(conn)
+    assert len(conn.execute("SELECT * FROM all_services").fetchall()) == 2
+    db.close_db()
+
+def test_query_stats(app, caplog):
+
+  assert querystats.normalize_query(
+    "SELECT *\n  FROM t\n  WHERE a = 'x' AND b IN (?, ?,?) AND c > 10"
+  ) == "SELECT * FROM t WHERE a = ? AND b IN (?, ...) AND c > ?"
+
+  querystats.reset_query_stats()
+  querystats.enable_query_stats(slow_threshold=0)
+  try:
+    with app.app_context():
+      conn = db.get_db()
+      for language in ('en', 'fr'):
+        conn.execute("SELECT * FROM services WHERE name IN (?) AND 'x' = ?",
+          (['a', 'b', 'c'], language)).fetchall()
+      conn.executemany("INSERT INTO services (name) VALUES (?)", [('a',), ('b',)])
+      db.close_db()
+  finally:
+    querystats.enable_query_stats(False)
+
+  stats = querystats.get_query_stats()
+  select = stats['queries']["SELECT * FROM services WHERE name IN (?) AND ? = ?"]
+  assert select['count'] == 2
+  assert sum(select['histogram'].values()) == 2
+  insert = stats['queries']["INSERT INTO services (name) VALUES (?)"]
+  assert insert['rows'] == 2
+  assert stats['count'] == 3
+  assert "Slow query" in caplog.text
+
+  # nothing recorded when disabled
+  with app.app_context():
+    db.get_db().execute("SELECT 1")
+    db.close_db()
+  assert querystats.get_query_stats()['count'] == 3
+  querystats.reset_query_stats()
+
+def test_replicas(app, tmp_path):
+
+  # replica has the same schema but distinct contents
+  replica_uri = f'file://{tmp_path}/replica.sqlite'
+  replica_app = Flask('drax')
+  replica_app.config['DATABASE_URI'] = replica_uri
+  with replica_app.app_context():
+    db.init_db()
+    db.get_db().execute("INSERT INTO services (name) VALUES ('replicated')")
+    db.get_db().commit()
+    db.close_db()
+
+  def read():
+    rec = db.get_db(readonly=True).execute("SELECT name FROM services").fetchone()
+    return rec['name'] if rec else None
+
+  missing_uri = f'file://{tmp_path}/missing.sqlite'
+  app.config['DATABASE_REPLICA_URIS'] = f'{missing_uri}, {replica_uri}'
+  for i in range(3):
+    with app.app_context():
+      assert read() == 'replicated'
+
+      # writes go to primary, after which reads do as well
+      db.get_db().execute("SELECT 1")
+      assert read() is None
+      db.close_db()
+
+  # missing replica was tried once then skipped
+  with app.app_context():
+    stats = db.get_replica_stats()
+  assert stats['replicas'][missing_uri] == {'healthy': False, 'selected': 0, 'failures': 1}
+  assert stats['replicas'][replica_uri]['selected'] == 3
+
+  # with no replica available, read from primary
+  app.config['DATABASE_REPLICA_URIS'] = missing_uri
+  app.config['DATABASE_REPLICA_RETRY'] = 0
+  with app.app_context():
+    assert read() is None
+    db.close_db()
+    assert db.get_replica_stats()['fallbacks'] == 1
+
+def test_replica_selection():
+
+  selector = replicas.Replicas(['a', 'b', 'c'], retry_after=60)
+  assert selector.candidates() == ['a', 'b', 'c']
+  assert selector.candidates() == ['b', 'c', 'a']
+  selector.failed('c')
+  assert selector.candidates() == ['a', 'b']
+  selector.succeeded('c')
+  assert selector.candidates() == ['a', 'b', 'c']
+
+def test_catalogue_import_export(app, tmp_path):
+
+  with app.app_context():
+    populate_catalogue(db.get_db(), ['key1=value1', None, '|(key2=value2)(key3=value3)'])
+    lines = list(catalogue.export_catalogue())
+    listing = [tuple(rec) for rec in db.get_db().execute("SELECT * FROM all_services")]
+    db.close_db()
+  assert len(lines) == 3 * 3 + 2
+
+  other = Flask('drax')
+  other.config['DATABASE_URI'] = f'file://{tmp_path}/other.sqlite'
+  with other.app_context():
+    db.init_db()
+    counts = catalogue.import_catalogue(lines, batch_size=2)
+    assert counts['service_definitions'] == 3
+    conn = db.get_db()
+    assert [tuple(rec) for rec in conn.execute("SELECT * FROM all_services")] == listing
+
+    # records are updated in place
+    changed = [line.replace('"title": "service00001"', '"title": "Changed"') for line in lines]
+    catalogue.import_catalogue(changed)
+    assert conn.execute(
+      "SELECT COUNT(*) FROM service_definitions WHERE title = 'Changed'").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM all_services").fetchone()[0] == 3
+
+    # bad records and bad access strings roll back the whole import
+    for bad in (['{"table": "snarf"}', 'not json'],
+                ['{"table": "service_access", "service": "service00000", '
+                 '"category": "general", "url": "x", "access": "(("}']):
+      with pytest.raises(InvalidCatalogue):
+        catalogue.import_catalogue(changed[:1] + bad)
+    assert conn.execute("SELECT COUNT(*) FROM all_services").fetchone()[0] == 3
+    assert conn.execute(
+      "SELECT COUNT(*) FROM service_access WHERE access = '(('").fetchone()[0] == 0
+
+    # records lacking required columns are rejected and reported
+    with pytest.raises(InvalidCatalogue) as e:
+      catalogue.import_catalogue(changed[:1] + [
+        '{"table": "services", "name": "new"}',
+        '{"table": "service_access", "service": "service00000", '
+        '"category": "general", "url": null}',
+      ])
+    assert e.value.errors == [
+      "line 2: bad record (services record lacks sso)",
+      "line 3: bad record (service_access record lacks url)",
+    ]
+    assert conn.execute(
+      "SELECT COUNT(*) FROM services WHERE name = 'new'").fetchone()[0] == 0
+    db.close_db()
+
+def test_catalogue_sync(app):
+
+  with app.app_context():
+    conn = db.get_db()
+    services = populate_catalogue(conn, ['key1=value1', None, None])
+    lines = list(catalogue.export_catalogue())
+    version = catalogue.get_catalogue_version()
+
+    # nothing changes if nothing differs
+    diff = catalogue.sync_catalogue(lines)
+    assert not diff
+    assert catalogue.get_catalogue_version() == version
+
+    # change one service, drop one and add one
+    declared = [
+      line.replace('"title": "service00000"', '"title": "Changed"') for line in lines
+      if services[1] not in line
+    ] + [
+      '{"table": "services", "name": "new", "sso": true}',
+      '{"table": "service_definitions", "service": "new", "language": "en", "title": "New"}',
+      '{"table": "service_access", "service": "new", "category": "general", "url": "x"}',
+    ]
+    diff = catalogue.sync_catalogue(declared, dry_run=True)
+    assert len(diff) == 7
+    assert diff.changed['service_definitions'] == [(services[0], 'en', 'Changed', None)]
+    assert diff.removed['services'] == [(services[1],)]
+    assert diff.added['services'] == [('new', True)]
+    assert '- service_access service00001 general' in list(diff.report())
+    assert catalogue.get_catalogue_version() == version
+
+    catalogue.sync_catalogue(declared)
+    assert catalogue.get_catalogue_version() != version
+    assert [(rec['service'], rec['title']) for rec in conn.execute(
+      "SELECT service, title FROM all_services")] == [
+        ('new', 'New'), (services[0], 'Changed'), (services[2], services[2])
+      ]
+    assert not catalogue.sync_catalogue(declared)
+
+    # duplicate records are rejected
+    with pytest.raises(InvalidCatalogue):
+      catalogue.sync_catalogue(declared + declared[-1:])
+    db.close_db()
+
+def test_split_script():
+
+  assert db_sqlite.split_script("""
+    CREATE TABLE t (a TEXT); -- comment; with semicolon
+    INSERT INTO t VALUES ('a;b'); INSERT INTO t VALUES ('c');
+    CREATE TRIGGER t_ins AFTER INSERT ON t
+      BEGIN DELETE FROM t WHERE a = 'x'; UPDATE t SET a = 'y'; END;
+  """) == [
+    "\n    CREATE TABLE t (a TEXT);",
+    " -- comment; with semicolon\n    INSERT INTO t VALUES ('a;b');",
+    " INSERT INTO t VALUES ('c');",
+    "\n    CREATE TRIGGER t_ins AFTER INSERT ON t\n"
+    "      BEGIN DELETE FROM t WHERE a = 'x'; UPDATE t SET a = 'y'; END;",
+  ]
+
+def test_upgrade_schema(app):
+
+  def downgrade():
+    # undo the last upgrades
+    conn = db.get_db()
+    conn.executescript("""
+      DROP TABLE people;
+      DROP INDEX service_definitions_service;
+      CREATE INDEX service_definitions_service ON service_definitions (service, language);
+      DROP INDEX service_access_service;
+      CREATE INDEX service_access_service ON service_access (service);
+      DROP INDEX catalogue_service;
+      DROP INDEX catalogue_category;
+      UPDATE schemalog SET version = '20261019';
+    """)
+
+  with app.app_context():
+    downgrade()
+    db.close_db()
+
+  # processes starting at once upgrade only once
+  results = []
+  def upgrade():
+    with app.app_context():
+      results.append(db.upgrade_schema())
+      db.close_db()
+  threads = [threading.Thread(target=upgrade) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(results) == 4
+  assert len([actions for (_, _, actions) in results if actions]) == 1
+
+  with app.app_context():
+    assert db.get_schema_version() == ('20261021', '20261021')
+    assert db.upgrade_schema() == ('20261021', '20261021', None)
+
+    # failed upgrade is rolled back entirely, and a transaction already open
+    # does not stop the upgrade being tried
+    db.get_db().execute("DELETE FROM schemalog WHERE version = '20261021'")
+    assert db.get_schema_version() == ('20261020', '20261021')
+    assert db.get_db().in_transaction
+    with pytest.raises(sqlite3.OperationalError, match='already exists'):
+      db.upgrade_schema()
+    assert db.get_schema_version() == ('20261020', '20261021')
+    db.close_db()
+
+def test_ttl_cache():
+
+  loads = []
+  def loader(value):
+    def load():
+      loads.append(value)
+      return value
+    return load
+
+  ttl = cache.TtlCache(2, ttl=60, negative_ttl=0.05)
+  assert ttl.get_or_load('a', loader({'cn': 'A'})) == {'cn': 'A'}
+  assert ttl.get_or_load('a', loader({'cn': 'other'})) == {'cn': 'A'}
+
+  # negative results are cached for their own, shorter time
+  assert ttl.get_or_load('nobody', loader(None)) is None
+  assert ttl.get_or_load('nobody', loader({'cn': 'Nobody'})) is None
+  time.sleep(0.1)
+  assert ttl.get_or_load('nobody', loader({'cn': 'Nobody'})) == {'cn': 'Nobody'}
+
+  # least recently used entry evicted when full
+  ttl.get_or_load('b', loader({'cn': 'B'}))
+  assert ttl.get_or_load('a', loader({'cn': 'A2'})) == {'cn': 'A2'}
+  assert len(ttl) == 2
+
+  # errors are not cached
+  def fail():
+    raise ValueError('down')
+  with pytest.raises(ValueError):
+    ttl.get_or_load('c', fail)
+  assert ttl.get_or_load('c', loader({'cn': 'C'})) == {'cn': 'C'}
+
+  stats = ttl.stats()
+  assert stats['hits'] == 1
+  assert stats['negative_hits'] == 1
+  assert stats['misses'] == 7
+  assert stats['errors'] == 1
+  assert stats['expirations'] == 1
+  assert stats['loads'] == len(loads) == 6
+
+  # concurrent lookups of the same key share one load
+  started = threading.Event()
+  release = threading.Event()
+  def slow():
+    started.set()
+    release.wait(5)
+    loads.append('slow')
+    return {'cn': 'Slow'}
+  ttl = cache.TtlCache(10, ttl=60)
+  results = []
+  threads = [
+    threading.Thread(target=lambda: results.append(ttl.get_or_load('s', slow)))
+    for i in range(5)
+  ]
+  threads[0].start()
+  started.wait(5)
+  for thread in threads[1:]:
+    thread.start()
+  while ttl.stats()['coalesced'] < 4:
+    time.sleep(0.01)
+  release.set()
+  for thread in threads:
+    thread.join()
+  assert results == [{'cn': 'Slow'}] * 5
+  assert loads.count('slow') == 1
+  assert ttl.stats()['hit_rate'] == 0.8
+
+def test_people(app):
+
+  directory = {
+    'alice': {'cn': 'Alice', 'eduPersonEntitlement': ['e1']},
+    'bob': {'cn': 'Bob', 'eduPersonEntitlement': ['e2']},
+  }
+  searches = []
+  def search(uids, attrs, page_size):
+    searches.append(uids)
+    assert attrs == people.ACCESS_ATTRIBUTES
+    return [(uid, directory[uid]) for uid in uids if uid in directory]
+
+  app.config['LDAP_SYNC_MAX_AGE'] = 3600
+  with app.app_context():
+    for uid in ('alice', 'bob', 'carol'):
+      assert people.record_login(uid)
+    db.get_db().execute("UPDATE people SET last_login = 0 WHERE uid = 'bob'")
+
+    # logins are written at most daily
+    assert not people.record_login('alice')
+
+    # not synced yet
+    assert people.get_synced_person('alice', ['eduPersonEntitlement']) is None
+
+    # active people are synced, those not in the directory or inactive dropped
+    counts = people.sync_people(search, active_days=30)
+    assert counts == {'synced': 1, 'removed': 1, 'expired': 1}
+    assert searches == [['alice', 'carol']]
+    assert people.get_synced_person('alice', ['eduPersonEntitlement']) == \
+      {'cn': 'Alice', 'eduPersonEntitlement': ['e1']}
+    assert people.get_synced_person('alice') == {'cn': 'Alice'}
+    assert people.get_synced_person('bob', ['eduPersonEntitlement']) is None
+
+    # attributes not synced are not answered for
+    assert people.get_synced_person('alice', ['mail']) is None
+
+    # details are only used while fresh, unless the directory is unavailable
+    db.get_db().execute("UPDATE people SET synced = 0")
+    assert people.get_synced_person('alice', ['eduPersonEntitlement']) is None
+    assert people.get_synced_person('alice', ['eduPersonEntitlement'], stale=True) == \
+      {'cn': 'Alice', 'eduPersonEntitlement': ['e1']}
+
+    # scheduled syncs are skipped if another process synced recently
+    db.get_db().execute("UPDATE people SET synced = ?", (int(time.time()),))
+    db.get_db().commit()
+    assert people._scheduled_sync(3600) is None
+    db.close_db()
+
+  # background syncing starts with the first request, not with the app
+  app.config['LDAP_SYNC_INTERVAL'] = 3600
+  people.init_sync_scheduler(app)
+  assert 'people_sync' not in app.extensions
+  app.test_client().get('/')
+  stop = app.extensions['people_sync']
+  app.test_client().get('/')
+  assert app.extensions['people_sync'] is stop
+  stop.set()
+
+def test_circuit_breaker():
+
+  class SlowDirectory:
+    """
+    Stub directory, such as given by LDAP_STUB, which may be made slow.
+    """
+    delay = 0
+    def get_person(self, uid):
+      time.sleep(self.delay)
+      return {'cn': uid}
+
+  directory = SlowDirectory()
+  cb = breaker.CircuitBreaker(threshold=2, reset_timeout=0.2, call_timeout=0.05)
+  assert cb.call(directory.get_person, 'alice') == {'cn': 'alice'}
+  assert cb.state == breaker.CLOSED
+
+  # slow calls time out, and enough in a row open the breaker
+  directory.delay = 0.2
+  for i in range(2):
+    start = time.monotonic()
+    with pytest.raises(CallTimeout):
+      cb.call(directory.get_person, 'alice')
+    assert time.monotonic() - start < 0.15
+  assert cb.state == breaker.OPEN
+
+  # calls then fail at once
+  with pytest.raises(CircuitOpen):
+    cb.call(directory.get_person, 'alice')
+
+  # half open after a while: a failed probe opens it again
+  time.sleep(0.25)
+  assert cb.state == breaker.HALF_OPEN
+  with pytest.raises(CallTimeout):
+    cb.call(directory.get_person, 'alice')
+  assert cb.state == breaker.OPEN
+
+  # successful probe closes it
+  directory.delay = 0
+  time.sleep(0.25)
+  assert cb.call(directory.get_person, 'bob') == {'cn': 'bob'}
+  assert cb.state == breaker.CLOSED
+
+  stats = cb.stats()
+  assert stats['failures'] == 0
+  assert stats['failed'] == stats['timeouts'] == 3
+  assert stats['opens'] == 2
+  assert stats['rejected'] == 1
+  assert stats['calls'] == 5
+
+  # only errors of the given types count as failures
+  def fail(e):
+    raise e
+  cb = breaker.CircuitBreaker(threshold=1, reset_timeout=60,
+                              failures=(ConnectionError,))
+  with pytest.raises(KeyError):
+    cb.call(fail, KeyError('alice'))
+  assert cb.state == breaker.CLOSED
+
+  # a call made while closed which succeeds after the breaker opens does not
+  # close it
+  started = threading.Event()
+  release = threading.Event()
+  def slow():
+    started.set()
+    release.wait(5)
+  thread = threading.Thread(target=cb.call, args=(slow,))
+  thread.start()
+  started.wait(5)
+  with pytest.raises(ConnectionError):
+    cb.call(fail, ConnectionError())
+  assert cb.state == breaker.OPEN
+  release.set()
+  thread.join()
+  assert cb.state == breaker.OPEN
+
+def test_catalogue_reoptimize(app):
+
+  with app.app_context():
+    conn = db.get_db()
+    conn.executescript("""
+      INSERT INTO services (name) VALUES ('rare');
+      INSERT INTO categories (name, ordr) VALUES ('general', 1);
+      INSERT INTO titles (name, language, title) VALUES ('general', 'en', 'General');
+      INSERT INTO service_definitions (service, language, title)
+        VALUES ('rare', 'en', 'Rare');
+      INSERT INTO service_access (service, category, url, access)
+        VALUES ('rare', 'general', 'https://rare', '&(key1=common)(key2=rare)');
+    """)
+    conn.commit()
+
+    rights = {'key1': ['common'], 'key2': ['other']}
+    access.enable_access_stats()
+    try:
+      def evaluations(cat):
+        before = access.get_access_stats()['evaluations']
+        for i in range(100):
+          assert not list(cat.visible(rights))
+        return access.get_access_stats()['evaluations'] - before
+
+      cat = catalogue.get_catalogue('en')
+      assert evaluations(cat) == 200
+
+      # not yet due, so the loaded catalogue is kept
+      app.config['ACCESS_REOPTIMIZE_INTERVAL'] = 3600
+      assert catalogue.get_catalogue('en') is cat
+
+      # once due, the catalogue's index is rebuilt with the predicate which
+      # always fails evaluated first
+      app.config['ACCESS_REOPTIMIZE_INTERVAL'] = 0.01
+      time.sleep(0.02)
+      reordered = catalogue.get_catalogue('en')
+      assert reordered is not cat
+      assert evaluations(reordered) == 100
+    finally:
+      access.enable_access_stats(False)
+    db.close_db()
+
+def test_ldap_pool(drax_ldap):
+
+  ldap = sys.modules['ldap']
+
+  class Directory:
+    """
+    Stand-in for a bound orgldap connection, raising queued errors.
+    """
+    def __init__(self):
+      self.errors = []
+    def get_person(self, uid):
+      if self.errors:
+        raise self.errors.pop(0)
+      return {'cn': uid}
+
+  created = []
+  def factory():
+    created.append(Directory())
+    return drax_ldap._Connection(created[-1])
+  ldap_pool = drax_ldap._LdapPool(factory, 2)
+
+  # dropped connection is discarded and the call retried on a new one
+  client = drax_ldap.PooledLdap(ldap_pool)
+  assert client.get_person('alice') == {'cn': 'alice'}
+  created[0].errors.append(ldap.SERVER_DOWN())
+  assert client.get_person('bob') == {'cn': 'bob'}
+  client.release()
+  stats = ldap_pool.stats()
+  assert (stats['created'], stats['discarded'], stats['in_use']) == (2, 1, 0)
+  assert stats['reconnects'] == 1
+
+  # connection whose operation timed out is discarded, not retried
+  client = drax_ldap.PooledLdap(ldap_pool)
+  created[-1].errors.append(ldap.TIMEOUT())
+  with pytest.raises(LdapException):
+    client.get_person('carol')
+  client.release()
+  stats = ldap_pool.stats()
+  assert (stats['created'], stats['discarded'], stats['in_use']) == (2, 2, 0)
+
+  # server down again on reconnecting gives up
+  client = drax_ldap.PooledLdap(ldap_pool)
+  factory_errors = [ldap.SERVER_DOWN(), ldap.SERVER_DOWN()]
+  def failing_factory():
+    conn = factory()
+    created[-1].errors.append(factory_errors.pop(0))
+    return conn
+  ldap_pool._factory = failing_factory
+  with pytest.raises(LdapException):
+    client.get_person('dave')
+  client.release()
+  stats = ldap_pool.stats()
+  assert (stats['created'], stats['discarded'], stats['in_use']) == (4, 4, 0)
+
+  # other errors leave the connection to be given back
+  ldap_pool._factory = factory
+  client = drax_ldap.PooledLdap(ldap_pool)
+  client.get_person('erin')
+  created[-1].errors.append(ldap.LDAPError())
+  with pytest.raises(ldap.LDAPError):
+    client.get_person('erin')
+  client.release()
+  stats = ldap_pool.stats()
+  assert (stats['in_use'], stats['idle']) == (0, 1)
+
+def test_ldap_pool_config(app, drax_ldap):
+
+  # each application has its own pool, made from its own configuration
+  other = Flask('drax')
+  app.config['LDAP_POOL_SIZE'] = 1
+  other.config['LDAP_POOL_SIZE'] = 3
+  with app.app_context():
+    ldap_pool = drax_ldap._get_pool()
+    assert drax_ldap._get_pool() is ldap_pool
+    assert ldap_pool.stats()['maxsize'] == 1
+  with other.app_context():
+    assert drax_ldap._get_pool() is not ldap_pool
+    assert drax_ldap.get_ldap_pool_stats()['maxsize'] == 3
+
+  # connections idle too long are replaced
+  p = pool.Pool(FakeConnection, 1, max_idle=0.01)
+  c1 = p.acquire()
+  p.release(c1)
+  assert p.acquire() is c1
+  p.release(c1)
+  time.sleep(0.02)
+  assert p.acquire() is not c1
+  assert c1.closed
+
+class StubDirectory:
+  """
+  Directory given with LDAP_STUB, counting lookups, which may be made slow
+  or to fail.
+  """
+
+  def __init__(self, people):
+    self.people = people
+    self.lookups = []
+    self.delay = 0
+    self.error = None
+
+  def get_person(self, uid, attrs=None):
+    self.lookups.append(uid)
+    time.sleep(self.delay)
+    if self.error:
+      raise self.error
+    person = self.people.get(uid)
+    if person is None:
+      return None
+    return {key: value for (key, value) in person.items()
+            if key in people.PERSON_ATTRIBUTES or key in (attrs or ())}
+
+def test_ldap_person_cache(app, drax_ldap):
+
+  stub = StubDirectory({'alice': {'cn': 'Alice', 'eduPersonEntitlement': ['e1']}})
+  app.config['LDAP_STUB'] = stub
+  with app.app_context():
+
+    # repeated lookups within the TTL don't reach the directory
+    for i in range(3):
+      assert drax_ldap.get_person('alice') == {'cn': 'Alice'}
+      assert drax_ldap.get_person('nobody') is None
+    assert stub.lookups == ['alice', 'nobody']
+
+    # lookups for other attributes are cached separately
+    for i in range(3):
+      assert drax_ldap.get_person('alice', ['eduPersonEntitlement']) == \
+        {'cn': 'Alice', 'eduPersonEntitlement': ['e1']}
+    assert stub.lookups == ['alice', 'nobody', 'alice']
+
+    # callers get copies, not the cached details
+    drax_ldap.get_person('alice')['cn'] = 'Mallory'
+    assert drax_ldap.get_person('alice') == {'cn': 'Alice'}
+
+    stats = drax_ldap.get_person_cache_stats()
+    assert (stats['misses'], stats['hits'], stats['negative_hits']) == (3, 6, 2)
+
+def test_ldap_status(app, drax_ldap):
+
+  stub = StubDirectory({'canary': {'cn': 'Canary'}})
+  app.config.update(LDAP_STUB=stub, LDAP_BREAKER_THRESHOLD=1)
+  status = importlib.import_module('drax.status')
+  app.register_blueprint(status.bp)
+  client = app.test_client()
+
+  # the probe asks the directory each time rather than the cache
+  for i in range(2):
+    response = client.get('/status/services/ldap')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).startswith('LDAP: Okay')
+  assert stub.lookups == ['canary', 'canary']
+
+  # so reports the directory down as soon as it is
+  stub.error = sys.modules['ldap'].SERVER_DOWN('gone')
+  response = client.get('/status/services/ldap')
+  assert response.status_code == 500
+  assert 'Circuit breaker open' in response.get_data(as_text=True)
+
+def test_ldap_breaker(app, drax_ldap):
+
+  alice = {'cn': 'Alice', 'givenName': 'Alice', 'preferredLanguage': 'en',
+           'eduPersonEntitlement': ['e1']}
+  stub = StubDirectory({'alice': alice, 'bob': {'cn': 'Bob'}})
+  app.config.update(
+    SECRET_KEY='test', LDAP_STUB=stub, LDAP_CALL_TIMEOUT=0.05,
+    LDAP_BREAKER_THRESHOLD=2, LDAP_BREAKER_RESET=60, LDAP_SYNC_MAX_AGE=3600)
+  attrs = ['eduPersonEntitlement']
+
+  auth = importlib.import_module('drax.auth')
+  app.register_blueprint(auth.bp)
+  @app.route('/whoami')
+  @auth.login_optional
+  def whoami():
+    return auth.session.get('uid', 'anonymous')
+
+  with app.app_context():
+    # alice was synced long ago, so her details are not used while the
+    # directory is available
+    people.store_people([('alice', alice)])
+    db.get_db().execute("UPDATE people SET synced = 0")
+    db.get_db().commit()
+    assert drax_ldap.get_person('bob') == {'cn': 'Bob'}
+
+    # a slow directory times out, falling back to synced details however old
+    stub.delay = 0.3
+    start = time.monotonic()
+    assert drax_ldap.get_person('alice', attrs) == \
+      {key: alice[key] for key in ('cn', 'givenName', 'preferredLanguage') + tuple(attrs)}
+    assert time.monotonic() - start < 0.2
+    with pytest.raises(LdapException):
+      drax_ldap.get_person('carol', attrs)
+    assert drax_ldap.get_breaker_stats()['state'] == breaker.OPEN
+    lookups = len(stub.lookups)
+
+    # with the breaker open the directory is not asked at all; cached and
+    # synced details are still given
+    start = time.monotonic()
+    with pytest.raises(LdapException):
+      drax_ldap.get_person('dave', attrs)
+    assert drax_ldap.get_person('bob') == {'cn': 'Bob'}
+    assert drax_ldap.get_person('alice', attrs)['eduPersonEntitlement'] == ['e1']
+    assert time.monotonic() - start < 0.1
+    assert len(stub.lookups) == lookups
+    assert drax_ldap.get_breaker_stats()['rejected'] == 2
+    db.close_db()
+
+  # logins carry on with synced rights, or anonymously
+  client = app.test_client()
+  start = time.monotonic()
+  def login_as(uid):
+    return client.get('/whoami', headers={'X_AUTHENTICATED_USER': uid}).get_data(as_text=True)
+  assert login_as('dave') == 'anonymous'
+  assert login_as('alice') == 'alice'
+  assert time.monotonic() - start < 0.2
+  assert len(stub.lookups) == lookups